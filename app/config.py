@@ -8,9 +8,91 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", logging.ERROR)
 SCRAPER_USER_AGENT = os.getenv(
     "SCRAPER_USER_AGENT", "Mozilla/5.0 (compatible; SafePlateBot/0.1)"
 )
+# The most requests in flight at once, in total and to any one host
+SCRAPER_CONCURRENCY = int(os.getenv("SCRAPER_CONCURRENCY", 32))
+SCRAPER_PER_HOST_CONCURRENCY = int(os.getenv("SCRAPER_PER_HOST_CONCURRENCY", 4))
+# The least seconds between the starts of requests to the same host
+SCRAPER_HOST_DELAY = float(os.getenv("SCRAPER_HOST_DELAY", 0.25))
+# Seconds to keep each host's robots.txt for
+SCRAPER_ROBOTS_TTL = float(os.getenv("SCRAPER_ROBOTS_TTL", 3600))
+# The processes which parse the scraped pages
+SCRAPER_PARSE_PROCESSES = int(os.getenv("SCRAPER_PARSE_PROCESSES", os.cpu_count() or 1))
+# Where the scrapers cache the pages they fetch, if anywhere, and how much of
+# the disk the cache may take
+HTTP_CACHE_DIR = os.getenv("HTTP_CACHE_DIR", "")
+HTTP_CACHE_MAX_MB = float(os.getenv("HTTP_CACHE_MAX_MB", 1024))
+# Where the scraper records the state of each URL, if anywhere, so it can
+# resume. URLs posted within the recrawl period, or which failed too many
+# times within it, are skipped.
+SCRAPER_FRONTIER_PATH = os.getenv("SCRAPER_FRONTIER_PATH", "")
+SCRAPER_RECRAWL_DAYS = float(os.getenv("SCRAPER_RECRAWL_DAYS", 7))
+SCRAPER_MAX_ATTEMPTS = int(os.getenv("SCRAPER_MAX_ATTEMPTS", 3))
+# How often a failed request is retried, and the most seconds to wait before
+# a retry. Retries may add at most SCRAPER_RETRY_BUDGET of the requests to
+# each host, so a struggling host isn't flooded with them.
+SCRAPER_RETRIES = int(os.getenv("SCRAPER_RETRIES", 3))
+SCRAPER_BACKOFF_MAX = float(os.getenv("SCRAPER_BACKOFF_MAX", 60))
+SCRAPER_RETRY_BUDGET = float(os.getenv("SCRAPER_RETRY_BUDGET", 0.2))
+# A host is given up on after this many failures in a row, and tried again
+# after this many seconds
+SCRAPER_BREAKER_THRESHOLD = int(os.getenv("SCRAPER_BREAKER_THRESHOLD", 5))
+SCRAPER_BREAKER_RESET = float(os.getenv("SCRAPER_BREAKER_RESET", 30))
 
 DATABASE_URI = os.getenv("DATABASE_URI", "mongodb://localhost:27017")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "safeplate")
 
 WEBHOOK_API_KEY = os.getenv("WEBHOOK_API_KEY", "secret")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "http://localhost:44778/api/recipes")
+WEBHOOK_BULK_URL = os.getenv(
+    "WEBHOOK_BULK_URL", "http://localhost:44778/api/recipes/bulk"
+)
+# The most recipes the bulk endpoint accepts in one request
+BULK_MAX_RECIPES = int(os.getenv("BULK_MAX_RECIPES", 1000))
+
+ALLERGEN_CACHE_SIZE = int(os.getenv("ALLERGEN_CACHE_SIZE", 10000))
+
+# Either the compiled model (a directory or .npz) or the pickled model (.pkl).
+# A model compiled next to the pickle is loaded in its place, if there is one.
+ALLERGEN_MODEL_PATH = os.getenv(
+    "ALLERGEN_MODEL_PATH", "resources/models/allergen_model.pkl"
+)
+ALLERGEN_VECTORIZER_PATH = os.getenv(
+    "ALLERGEN_VECTORIZER_PATH", "resources/models/allergen_vectorizer.pkl"
+)
+# Memory-map the model's arrays so server workers share them; empty to disable
+ALLERGEN_MMAP_MODE = os.getenv("ALLERGEN_MMAP_MODE", "r") or None
+
+# Either "thread" or "process"
+DETECTOR_EXECUTOR = os.getenv("DETECTOR_EXECUTOR", "thread")
+DETECTOR_WORKERS = int(os.getenv("DETECTOR_WORKERS", 1))
+DETECTOR_MAX_PENDING = int(os.getenv("DETECTOR_MAX_PENDING", 64))
+
+# Batching is disabled when the batch size is 1
+DETECTOR_BATCH_SIZE = int(os.getenv("DETECTOR_BATCH_SIZE", 32))
+DETECTOR_BATCH_WAIT_MS = float(os.getenv("DETECTOR_BATCH_WAIT_MS", 5))
+# The most recipes waiting to be batched at once, beyond which they're rejected
+DETECTOR_BATCH_MAX_PENDING = int(os.getenv("DETECTOR_BATCH_MAX_PENDING", 1024))
+
+# Either "ml", or "hybrid" to resolve lines of known ingredients without the model
+DETECTOR_MODE = os.getenv("DETECTOR_MODE", "ml")
+ALLERGEN_LEXICON_PATH = os.getenv(
+    "ALLERGEN_LEXICON_PATH", "resources/datasets/allergens_expanded.csv"
+)
+
+# Seconds to cache the available filters for; 0 to disable
+FACET_CACHE_TTL = float(os.getenv("FACET_CACHE_TTL", 60))
+# Either "aggregate", or "materialized" to read them from the facets collection
+FACET_SOURCE = os.getenv("FACET_SOURCE", "aggregate")
+# Seconds between the server's rebuilds of the facets collection, which correct
+# the counts of recipes upserted during the last rebuild; 0 to disable
+FACET_REBUILD_INTERVAL = float(os.getenv("FACET_REBUILD_INTERVAL", 3600))
+
+# Either "separate", or "facet" to find the page, total and filter counts at once
+RECIPE_QUERY_MODE = os.getenv("RECIPE_QUERY_MODE", "separate")
+# Estimate the total from the collection's metadata when no filters are applied
+APPROXIMATE_COUNTS = os.getenv("APPROXIMATE_COUNTS", "") not in ("", "0", "false")
+
+# Buffer single recipes in memory and save them in bulk writes, when enabled
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "") not in ("", "0", "false")
+WRITE_BEHIND_MAX_ITEMS = int(os.getenv("WRITE_BEHIND_MAX_ITEMS", 100))
+WRITE_BEHIND_MAX_WAIT_MS = float(os.getenv("WRITE_BEHIND_MAX_WAIT_MS", 1000))
@@ -0,0 +1,401 @@
+import asyncio
+import collections
+import contextlib
+import functools
+import logging
+import zlib
+from re import Pattern
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Optional,
+    TypeVar,
+)
+from urllib.parse import urlparse
+from xml.etree.ElementTree import ParseError
+
+import aiohttp
+
+from app.utils import (
+    CircuitOpen,
+    FetchError,
+    FetchPolicy,
+    HttpCache,
+    RobotsCache,
+    SitemapParser,
+    robots_delay,
+    robots_url_for,
+)
+
+T = TypeVar("T")
+
+
+class Crawler:
+    """
+    Fetch pages concurrently over a pool of keep-alive connections.
+
+    At most ``max_concurrency`` requests are in flight at once, and at most
+    ``max_per_host`` to any one host, with each host's requests starting at
+    least ``host_delay`` seconds apart, or further apart if the host's
+    robots.txt asks. Use it as an async context manager, which opens and
+    closes the connection pool.
+
+    Failed pages and sitemaps are retried as the fetch policy allows, which
+    also stops fetching from hosts which keep failing. Given an HTTP cache, pages and
+    sitemaps which were fetched before are only downloaded again if they
+    have changed.
+    """
+
+    def __init__(
+        self,
+        user_agent: str,
+        max_concurrency: int = 32,
+        max_per_host: int = 4,
+        host_delay: float = 0,
+        timeout: float = 10,
+        policy: Optional[FetchPolicy] = None,
+        robots: Optional[RobotsCache] = None,
+        cache: Optional[HttpCache] = None,
+    ):
+        self.user_agent = user_agent
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.host_delay = host_delay
+        self.timeout = timeout
+        self.policy = policy or FetchPolicy()
+        self.robots = robots or RobotsCache()
+        self.cache = cache
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.fetched = 0
+        self.failed = 0
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._host_slots = collections.defaultdict(
+            lambda: asyncio.Semaphore(max_per_host)
+        )
+        self._host_locks = collections.defaultdict(asyncio.Lock)
+        self._host_next_start: dict[str, float] = {}
+        # The delays asked for by the robots.txt of each host
+        self._host_delays: dict[str, float] = {}
+        self._robots_locks = collections.defaultdict(asyncio.Lock)
+
+    async def __aenter__(self) -> "Crawler":
+        connector = aiohttp.TCPConnector(
+            limit=self.max_concurrency, limit_per_host=self.max_per_host
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"User-Agent": self.user_agent},
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    async def fetch(self, url: str) -> str:
+        """
+        Fetch the text of a page, retrying as the fetch policy allows.
+
+        :param url: The URL of the page.
+        :return: The text of the page.
+        :raises FetchError: If the page doesn't respond with a 200.
+        :raises CircuitOpen: If the host keeps failing, so isn't fetched from.
+        """
+        return await self._with_policy(url, functools.partial(self._fetch, url))
+
+    async def allowed(self, url: str, robots_url: Optional[str] = None) -> bool:
+        """
+        Check if the robots.txt allows the user agent to fetch a URL.
+
+        Each robots.txt is fetched once, then cached, and the host's requests
+        are spaced out by the delay it asks for.
+
+        :param url: The URL to fetch.
+        :param robots_url: The URL of the robots.txt, if not the host's own.
+        """
+        robots_url = robots_url or robots_url_for(url)
+
+        rp = self.robots.get(robots_url)
+        if rp is None:
+            # Only fetch each robots.txt once, however many URLs are waiting
+            async with self._robots_locks[robots_url]:
+                rp = self.robots.get(robots_url)
+                if rp is None:
+                    rp = await self._fetch_robots(robots_url)
+
+        delay = robots_delay(rp, self.user_agent)
+        if delay:
+            self._host_delays[urlparse(url).netloc] = delay
+
+        return rp.can_fetch(self.user_agent, url)
+
+    async def crawl(
+        self,
+        urls: Iterable[str] | AsyncIterable[str],
+        scrape: Optional[Callable[[str], Awaitable]] = None,
+    ) -> AsyncIterator[tuple[str, object]]:
+        """
+        Scrape many URLs concurrently, as they're taken from an iterable.
+
+        Stopping the iteration early cancels the URLs still being scraped.
+
+        :param urls: The URLs, which are only taken as they can be scraped,
+            so they may be streamed from a sitemap.
+        :param scrape: Scrapes a URL, fetching its page by default.
+        :return: Each URL and its result, or the exception it raised, in the
+            order they finish.
+        """
+        scrape = scrape or self.fetch
+        if isinstance(urls, AsyncIterable):
+            urls = aiter(urls)
+        else:
+            urls = _aiter_sync(urls)
+        pending: dict[asyncio.Task, str] = {}
+
+        async def start_next() -> bool:
+            url = await anext(urls, None)
+            if url is None:
+                return False
+            pending[asyncio.create_task(scrape(url))] = url
+            return True
+
+        try:
+            while len(pending) < self.max_concurrency and await start_next():
+                pass
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    url = pending.pop(task)
+                    yield url, task.exception() or task.result()
+                    await start_next()
+        finally:
+            for task in pending:
+                task.cancel()
+            await urls.aclose()
+
+    async def walk_sitemap(
+        self, url: str, pattern: Optional[Pattern[str]] = None
+    ) -> AsyncIterator[str]:
+        """
+        Walk a sitemap and its child sitemaps, yielding URLs as they stream in,
+        before each sitemap has finished downloading.
+
+        :param url: The URL of the sitemap.
+        :param pattern: Only URLs matching the pattern are yielded, if given.
+        :return: The URLs of the pages in the sitemaps.
+        """
+        sitemaps = collections.deque([url])
+        seen = {url}
+
+        while sitemaps:
+            sitemap_url = sitemaps.popleft()
+            children = []
+            try:
+                parser = SitemapParser()
+                chunks = self._stream(sitemap_url)
+                async with contextlib.aclosing(chunks):
+                    async for chunk in chunks:
+                        for kind, loc in parser.feed(chunk):
+                            if kind == "sitemap":
+                                children.append(loc)
+                            elif pattern is None or pattern.match(loc):
+                                yield loc
+                for kind, loc in parser.close():
+                    if kind == "sitemap":
+                        children.append(loc)
+                    elif pattern is None or pattern.match(loc):
+                        yield loc
+            except FetchError as error:
+                logging.warning(
+                    "Skipping sitemap %s (status %s)", sitemap_url, error.status
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError, ParseError, zlib.error):
+                logging.warning("Failed to read sitemap %s", sitemap_url, exc_info=True)
+            finally:
+                # Visit the child sitemaps next, in the order they're listed
+                children = [child for child in children if child not in seen]
+                seen.update(children)
+                sitemaps.extendleft(reversed(children))
+
+    async def _with_policy(self, url: str, request: Callable[[], Awaitable[T]]) -> T:
+        """Make a request, retrying it as the fetch policy allows."""
+        attempt = 1
+        while True:
+            try:
+                self.policy.admit(url, attempt)
+            except CircuitOpen:
+                self.failed += 1
+                raise
+            try:
+                result = await request()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                wait = self.policy.failed(url, attempt)
+                if wait is None:
+                    self.failed += 1
+                    raise FetchError(url) from error
+            except FetchError as error:
+                if error.status not in FetchPolicy.RETRY_STATUSES:
+                    # The host is up, even if the page isn't
+                    self.policy.succeeded(url)
+                    self.failed += 1
+                    raise
+                wait = self.policy.failed(url, attempt, error.retry_after)
+                if wait is None:
+                    self.failed += 1
+                    raise
+            except BaseException:
+                # Cancelled, or failed unexpectedly, so free the host's trial
+                self.policy.abandoned(url)
+                raise
+            else:
+                self.policy.succeeded(url)
+                self.fetched += 1
+                return result
+            # Wait outside the connection slots, which other pages may use
+            await asyncio.sleep(wait)
+            attempt += 1
+
+    async def _fetch(self, url: str) -> str:
+        host = urlparse(url).netloc
+        headers = await self._validators(url)
+        async with self._slots, self._host_slots[host]:
+            await self._wait_turn(host)
+            response = await self.session.get(url, headers=headers)
+            try:
+                if response.status == 304 and self.cache is not None:
+                    cached = await asyncio.to_thread(
+                        self.cache.revalidated, url, response.headers
+                    )
+                    if cached is not None:
+                        return cached.text
+                    # It was evicted since its validators were read, so fetch
+                    # it afresh
+                    response.release()
+                    await self._wait_turn(host)
+                    response = await self.session.get(url)
+                if response.status != 200:
+                    raise FetchError(
+                        url, response.status, response.headers.get("Retry-After")
+                    )
+                text = await response.text()
+                if self.cache is not None:
+                    await asyncio.to_thread(
+                        self.cache.put,
+                        url,
+                        await response.read(),
+                        response.headers,
+                        response.get_encoding(),
+                    )
+            finally:
+                response.release()
+        return text
+
+    async def _stream(self, url: str) -> AsyncIterator[bytes]:
+        """
+        Stream the body of a response in chunks, from the cache if it hasn't
+        changed. Cached bodies are streamed to and from disk, so a sitemap is
+        never held in memory whole.
+
+        A sitemap is requested in the host's turn and retried as the fetch
+        policy allows, like a page, until its body starts streaming.
+
+        :raises FetchError: If the response isn't a 200.
+        :raises CircuitOpen: If the host keeps failing, so isn't fetched from.
+        """
+        headers = await self._validators(url)
+        response = await self._with_policy(
+            url, functools.partial(self._open, url, headers)
+        )
+        try:
+            if response.status == 304 and self.cache is not None:
+                cached = await asyncio.to_thread(
+                    self.cache.revalidated_stream, url, response.headers
+                )
+                if cached is not None:
+                    try:
+                        while chunk := await asyncio.to_thread(next, cached, None):
+                            yield chunk
+                    finally:
+                        cached.close()
+                    return
+                # It was evicted since its validators were read, so fetch it
+                # afresh
+                response.release()
+                response = await self._with_policy(
+                    url, functools.partial(self._open, url, None)
+                )
+            if self.cache is None:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    yield chunk
+                return
+
+            body = await asyncio.to_thread(self.cache.body)
+            try:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    await asyncio.to_thread(body.write, chunk)
+                    yield chunk
+                # Only a body which was read to the end is cached
+                await asyncio.to_thread(
+                    self.cache.put_body, url, body, response.headers
+                )
+            finally:
+                await asyncio.to_thread(body.discard)
+        finally:
+            response.release()
+
+    async def _open(
+        self, url: str, headers: Optional[dict[str, str]]
+    ) -> aiohttp.ClientResponse:
+        """
+        Make a request in the host's turn, holding its slots until the
+        response's headers arrive, so its body can be streamed without them.
+
+        :raises FetchError: If the response isn't a 200, or a 304 to a
+            conditional request.
+        """
+        host = urlparse(url).netloc
+        async with self._slots, self._host_slots[host]:
+            await self._wait_turn(host)
+            response = await self.session.get(url, headers=headers)
+        if response.status == 200 or (response.status == 304 and headers):
+            return response
+        response.release()
+        raise FetchError(url, response.status, response.headers.get("Retry-After"))
+
+    async def _validators(self, url: str) -> Optional[dict[str, str]]:
+        """Get the headers making a request for a cached page conditional."""
+        if self.cache is None:
+            return None
+        return await asyncio.to_thread(self.cache.validators, url)
+
+    async def _fetch_robots(self, robots_url: str):
+        try:
+            async with self._slots:
+                async with self.session.get(robots_url) as response:
+                    content = await response.text()
+                    return self.robots.put(robots_url, response.status, content)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return self.robots.put(robots_url, None, None)
+
+    async def _wait_turn(self, host: str):
+        """Wait until the host's next request may start."""
+        delay = max(self.host_delay, self._host_delays.get(host, 0))
+        if not delay:
+            return
+        async with self._host_locks[host]:
+            loop = asyncio.get_running_loop()
+            wait = self._host_next_start.get(host, 0) - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._host_next_start[host] = loop.time() + delay
+
+
+async def _aiter_sync(iterable: Iterable[str]) -> AsyncIterator[str]:
+    for item in iterable:
+        yield item
@@ -1,11 +1,15 @@
+import json
+from typing import Optional
+
+from pydantic import ValidationError
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 from starlette.templating import Jinja2Templates
 
-from app.config import WEBHOOK_API_KEY
-from app.ml import AllergenDetector
+from app.config import WEBHOOK_API_KEY, BULK_MAX_RECIPES
+from app.ml import DetectorPool, DetectorSaturated, BatchScheduler
 from app.models import Recipe, AllergenGroup, RecipeFilters
-from app.services import RecipeService
+from app.services import RecipeService, WriteBehindBuffer, WriteBufferFull
 from app.utils import modify_query_parameter
 
 
@@ -13,29 +17,51 @@ class Endpoints:
     def __init__(
         self,
         recipe_service: RecipeService,
-        allergen_detector: AllergenDetector,
+        allergen_detector: DetectorPool | BatchScheduler,
         templates: Jinja2Templates,
+        query_mode: str = "separate",
+        write_buffer: Optional[WriteBehindBuffer] = None,
     ):
         self.recipe_service = recipe_service
         self.allergen_detector = allergen_detector
         self.templates = templates
+        self.query_mode = query_mode
+        # When given, single recipes are saved in the background
+        self.write_buffer = write_buffer
 
     async def index(self, request: Request):
-        available_filters = await self.recipe_service.find_available_filters()
-
-        recipes = await self.recipe_service.find_all(
-            RecipeFilters.from_request(request),
-            page=int(request.query_params.get("page", 1)),
-            limit=int(request.query_params.get("limit", 30)),
-        )
+        filters = RecipeFilters.from_request(request)
+        limit = int(request.query_params.get("limit", 30))
 
         url = f"{request.url}"
         next_url = None
         prev_url = None
-        if recipes.prev_page:
-            prev_url = modify_query_parameter(url, "page", recipes.prev_page)
-        if recipes.next_page:
-            next_url = modify_query_parameter(url, "page", recipes.next_page)
+        if "page" in request.query_params:
+            # Page numbers are still supported, for links made before cursors
+            recipes = await self.recipe_service.find_all(
+                filters, page=int(request.query_params["page"]), limit=limit
+            )
+            if recipes.prev_page:
+                prev_url = modify_query_parameter(url, "page", recipes.prev_page)
+            if recipes.next_page:
+                next_url = modify_query_parameter(url, "page", recipes.next_page)
+        elif self.query_mode == "facet":
+            # Find the page, total and filter counts in a single query
+            recipes = await self.recipe_service.find_page_with_facets(
+                filters, limit=limit, cursor=request.query_params.get("cursor")
+            )
+        else:
+            recipes = await self.recipe_service.find_page(
+                filters, limit=limit, cursor=request.query_params.get("cursor")
+            )
+
+        if recipes.prev_cursor:
+            prev_url = modify_query_parameter(url, "cursor", recipes.prev_cursor)
+        if recipes.next_cursor:
+            next_url = modify_query_parameter(url, "cursor", recipes.next_cursor)
+
+        # Usually cached, and cached by the query with facets when unfiltered
+        available_filters = await self.recipe_service.find_available_filters()
 
         return self.templates.TemplateResponse(
             request,
@@ -65,14 +91,165 @@ class Endpoints:
             # Parse the recipe from the request body
             json = await request.json()
             recipe = Recipe(**json)
+            etag = f'"{self.recipe_service.content_hash(recipe)}"'
+
+            # Skip detecting and saving a recipe which hasn't changed
+            if recipe.id is not None:
+                unchanged = await self.recipe_service.find_unchanged([recipe])
+                if recipe.id in unchanged:
+                    if request.headers.get("If-None-Match") == etag:
+                        return Response(status_code=304, headers={"ETag": etag})
+                    recipe.allergens = unchanged[recipe.id]
+                    return JSONResponse(
+                        recipe.model_dump(by_alias=True), headers={"ETag": etag}
+                    )
 
-            # Detect allergens in the recipe
-            recipe.allergens = self.allergen_detector.detect(recipe.ingredients)
+            # Detect allergens in the recipe, off the event loop
+            recipe.allergens = await self.allergen_detector.detect(recipe.ingredients)
+
+            # Save the recipe, or accept it to be saved with the next write
+            if self.write_buffer:
+                await self.write_buffer.upsert(recipe)
+                return JSONResponse(
+                    recipe.model_dump(by_alias=True), 202, {"ETag": etag}
+                )
 
-            # Save the recipe
             await self.recipe_service.upsert(recipe)
 
-            return JSONResponse(recipe.model_dump(by_alias=True))
+            return JSONResponse(
+                recipe.model_dump(by_alias=True), headers={"ETag": etag}
+            )
+        except (DetectorSaturated, WriteBufferFull):
+            return JSONResponse(
+                {"error": "Too many recipes pending"}, 429, {"Retry-After": "1"}
+            )
         except Exception as e:
             print("Error updating document: ", e)
-            JSONResponse({"error": "Error updating recipe"}, 500)
+            return JSONResponse({"error": "Error updating recipe"}, 500)
+
+    async def sync_recipes(self, request: Request):
+        # Check if the request is authorized via Bearer token
+        if request.headers.get("Authorization") != f"Bearer {WEBHOOK_API_KEY}":
+            return JSONResponse({"error": "Unauthorized"}, 401)
+
+        # Parse the recipes from the body, either a JSON array or one per line
+        body = await request.body()
+        try:
+            if request.headers.get("Content-Type", "").startswith(
+                "application/x-ndjson"
+            ):
+                items = [json.loads(line) for line in body.splitlines() if line.strip()]
+            else:
+                items = json.loads(body)
+                if not isinstance(items, list):
+                    raise ValueError("Expected a JSON array")
+        except ValueError:
+            return JSONResponse({"error": "Expected a JSON array or NDJSON"}, 400)
+        if len(items) > BULK_MAX_RECIPES:
+            return JSONResponse(
+                {"error": f"Too many recipes, send at most {BULK_MAX_RECIPES}"}, 413
+            )
+
+        results = [None] * len(items)
+        recipes = []
+        positions = []
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[i] = {"status": "invalid", "error": "Expected a recipe"}
+                continue
+            try:
+                recipe = Recipe(**item)
+            except ValidationError as e:
+                fields = sorted({f"{error['loc'][0]}" for error in e.errors()})
+                results[i] = {
+                    "status": "invalid",
+                    "error": f"Invalid fields: {', '.join(fields)}",
+                }
+                continue
+            if recipe.id is None:
+                results[i] = {"status": "invalid", "error": "Recipe has no _id"}
+                continue
+            recipes.append(recipe)
+            positions.append(i)
+
+        # Only the last recipe with each ID is saved, as upserting them one by
+        # one would leave it, so the earlier ones are reported as duplicates
+        last = {recipe.id: i for i, recipe in zip(positions, recipes)}
+        for i, recipe in zip(positions, recipes):
+            if last[recipe.id] != i:
+                results[i] = {"_id": recipe.id, "status": "duplicate"}
+        kept = [
+            (i, recipe) for i, recipe in zip(positions, recipes) if results[i] is None
+        ]
+        positions = [i for i, _ in kept]
+        recipes = [recipe for _, recipe in kept]
+
+        try:
+            # Skip detecting and saving the recipes which haven't changed
+            unchanged = await self.recipe_service.find_unchanged(recipes)
+            for i, recipe in zip(positions, recipes):
+                if recipe.id in unchanged:
+                    results[i] = {
+                        "_id": recipe.id,
+                        "status": "unchanged",
+                        "allergens": unchanged[recipe.id],
+                    }
+            changed = [
+                (i, recipe)
+                for i, recipe in zip(positions, recipes)
+                if recipe.id not in unchanged
+            ]
+            positions = [i for i, _ in changed]
+            recipes = [recipe for _, recipe in changed]
+
+            errors = {}
+            if recipes:
+                # Detect allergens in every recipe at once, off the event loop
+                detected = await self.allergen_detector.detect_many(
+                    [recipe.ingredients for recipe in recipes]
+                )
+                for recipe, allergens in zip(recipes, detected):
+                    recipe.allergens = allergens
+
+                # Save the recipes in a single bulk write
+                errors = await self.recipe_service.upsert_many(recipes)
+        except DetectorSaturated:
+            return JSONResponse(
+                {"error": "Too many recipes pending"}, 429, {"Retry-After": "1"}
+            )
+        except Exception as e:
+            print("Error updating documents: ", e)
+            return JSONResponse({"error": "Error updating recipes"}, 500)
+
+        for j, (i, recipe) in enumerate(zip(positions, recipes)):
+            if j in errors:
+                results[i] = {"_id": recipe.id, "status": "error", "error": errors[j]}
+            else:
+                results[i] = {
+                    "_id": recipe.id,
+                    "status": "saved",
+                    "allergens": recipe.allergens,
+                }
+
+        return JSONResponse({"results": results})
+
+    async def metrics(self, request: Request):
+        # Check if the request is authorized via Bearer token
+        if request.headers.get("Authorization") != f"Bearer {WEBHOOK_API_KEY}":
+            return JSONResponse({"error": "Unauthorized"}, 401)
+
+        stats = {
+            "allergen_detector": self.allergen_detector.stats(),
+            "facets": await self.recipe_service.facet_stats(),
+        }
+        if self.write_buffer:
+            stats["write_buffer"] = self.write_buffer.stats()
+
+        return JSONResponse(stats)
+
+    async def ready(self, request: Request):
+        # Ready once the allergen detector has been loaded
+        if not self.allergen_detector.ready:
+            return JSONResponse({"ready": False}, 503)
+
+        return JSONResponse({"ready": True})
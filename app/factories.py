@@ -1,6 +1,29 @@
+from typing import Optional
+
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from app.frontier import Frontier
+from app.utils import HttpCache
+
 
 def get_db_connection(uri: str, db_name: str) -> AsyncIOMotorClient:
     """Return a connection to the database."""
     return AsyncIOMotorClient(uri).get_database(db_name)
+
+
+def get_http_cache(path: str, max_mb: float) -> Optional[HttpCache]:
+    """Return the HTTP cache in a directory, or None if there's no directory."""
+    if not path:
+        return None
+    return HttpCache(path, max_bytes=int(max_mb * 1024 * 1024))
+
+
+def get_frontier(
+    path: str, recrawl_days: float, max_attempts: int
+) -> Optional[Frontier]:
+    """Return the crawl frontier at a path, or None if there's no path."""
+    if not path:
+        return None
+    return Frontier(
+        path, recrawl_after=recrawl_days * 24 * 3600, max_attempts=max_attempts
+    )
@@ -0,0 +1,156 @@
+import threading
+import time
+from hashlib import sha256
+from typing import Iterable, Optional
+
+
+def url_id(url: str) -> str:
+    """Get the ID of the page at a URL, which is also the ID of its recipe."""
+    return sha256(url.encode("utf-8")).hexdigest()
+
+
+class Frontier:
+    """
+    Track the state of each URL of a crawl in a SQLite database, so a crawl
+    which stops part way can resume where it left off.
+
+    A URL is ``seen`` once it's taken from a sitemap, then ``fetched``,
+    ``parsed`` and ``posted`` as its recipe makes its way to the server, or
+    ``failed`` at any step, which counts an attempt. URLs posted recently,
+    or which have failed too many times recently, are settled, and skipped
+    until ``recrawl_after`` seconds have passed.
+
+    The frontier may be used from any thread, so its queries can run off the
+    event loop.
+    """
+
+    STATES = ("seen", "fetched", "parsed", "posted", "failed")
+
+    def __init__(
+        self, path: str, recrawl_after: float = 7 * 24 * 3600, max_attempts: int = 3
+    ):
+        # Only the scraper has a frontier, so the server doesn't import this
+        import sqlite3
+
+        self.recrawl_after = recrawl_after
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Commits needn't wait for the disk, as losing the last few only
+        # means those URLs are scraped again
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS urls (
+                id TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                site_name TEXT,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS urls_site_name_state ON urls (site_name, state);
+            """)
+
+    def settled(self, url: str) -> Optional[str]:
+        """
+        Check if a URL should be skipped.
+
+        :param url: The URL.
+        :return: "posted" or "failed" if the URL is settled, or None if it
+            should be scraped.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state, attempts, updated_at FROM urls WHERE id = ?",
+                (url_id(url),),
+            ).fetchone()
+        if row is None:
+            return None
+        state, attempts, updated_at = row
+        if updated_at < time.time() - self.recrawl_after:
+            return None
+        if state == "posted":
+            return state
+        if state == "failed" and attempts >= self.max_attempts:
+            return state
+        return None
+
+    def mark(
+        self,
+        url: str,
+        state: str,
+        site_name: Optional[str] = None,
+        error: Optional[str] = None,
+    ):
+        """
+        Record the state of a URL.
+
+        :param url: The URL.
+        :param state: One of ``STATES``.
+        :param site_name: The site the URL belongs to, if it's known.
+        :param error: Why the URL failed, if it did.
+        """
+        self.mark_many([url], state, site_name, error)
+
+    def mark_many(
+        self,
+        urls: Iterable[str],
+        state: str,
+        site_name: Optional[str] = None,
+        error: Optional[str] = None,
+    ):
+        """Record the same state of many URLs at once."""
+        if state not in self.STATES:
+            raise ValueError(f"Unknown state {state!r}")
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                """
+                INSERT INTO urls (id, url, site_name, state, attempts, error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    state = excluded.state,
+                    site_name = COALESCE(excluded.site_name, site_name),
+                    attempts = CASE excluded.state
+                        WHEN 'failed' THEN attempts + 1
+                        WHEN 'posted' THEN 0
+                        ELSE attempts
+                    END,
+                    error = excluded.error,
+                    updated_at = excluded.updated_at
+                """,
+                [
+                    (
+                        url_id(url),
+                        url,
+                        site_name,
+                        state,
+                        int(state == "failed"),
+                        error,
+                        now,
+                    )
+                    for url in urls
+                ],
+            )
+            self._db.commit()
+
+    def counts(self, site_name: Optional[str] = None) -> dict[str, int]:
+        """Count the URLs in each state, of a site or of every site."""
+        with self._lock:
+            if site_name is None:
+                rows = self._db.execute(
+                    "SELECT state, COUNT(*) FROM urls GROUP BY state"
+                )
+            else:
+                rows = self._db.execute(
+                    "SELECT state, COUNT(*) FROM urls WHERE site_name = ? GROUP BY state",
+                    (site_name,),
+                )
+            counts = dict(rows.fetchall())
+        return {state: 0 for state in self.STATES} | counts
+
+    def close(self):
+        with self._lock:
+            self._db.close()
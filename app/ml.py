@@ -1,37 +1,1082 @@
+import asyncio
+import bisect
+import csv
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import sha256
+from typing import Callable, Optional
+
+import numpy as np
+
 from app.models import AllergenGroup
 
 
+class IngredientCache:
+    """
+    A bounded LRU cache of allergen bitmasks keyed by normalised ingredient line.
+
+    Bit ``i`` of a mask is set when the allergen at index ``i`` of
+    ``AllergenGroup.to_list()`` was predicted for the ingredient.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalise(ingredient: str) -> str:
+        """
+        Normalise an ingredient line so trivially different lines share an entry.
+
+        Only case and whitespace are normalised, which the TF-IDF vectorizer
+        ignores anyway, so the normalised line predicts the same allergens.
+        """
+        return " ".join(ingredient.lower().split())
+
+    def get(self, ingredient: str) -> Optional[int]:
+        """Get the allergen bitmask of a normalised ingredient, if cached."""
+        with self._lock:
+            mask = self._entries.get(ingredient)
+            if mask is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(ingredient)
+            self.hits += 1
+            return mask
+
+    def put(self, ingredient: str, mask: int):
+        """Cache the allergen bitmask of a normalised ingredient."""
+        with self._lock:
+            self._entries[ingredient] = mask
+            self._entries.move_to_end(ingredient)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Get the size and hit/miss counters of the cache."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class KeywordMatcher:
+    """
+    Resolve ingredient lines made up entirely of known ingredients.
+
+    The lexicon of labelled ingredients is compiled into a trie of words,
+    which is scanned for the longest known ingredient at each position of
+    a line. A line is only resolved when every word is part of a known
+    ingredient or is a quantity or preparation word, so anything it is
+    unsure about is left for the model.
+    """
+
+    FILLER_WORDS = frozenset(
+        {
+            # Quantities and units
+            *("a", "an", "g", "kg", "mg", "ml", "l", "cl", "oz", "lb", "lbs"),
+            *("tsp", "tbsp", "teaspoon", "teaspoons", "tablespoon", "tablespoons"),
+            *("cup", "cups", "pint", "pints", "litre", "litres", "liter", "liters"),
+            *("pound", "pounds", "ounce", "ounces", "gram", "grams", "x"),
+            *("pinch", "handful", "bunch", "can", "tin", "jar", "pack", "packet"),
+            # Sizes and preparation
+            *("large", "medium", "small", "fresh", "freshly", "ground", "to"),
+            *("chopped", "finely", "roughly", "diced", "sliced", "minced", "taste"),
+            *("grated", "peeled", "crushed", "halved", "beaten", "softened"),
+            *("melted", "and", "or", "of", "for", "the", "into", "plus", "about"),
+        }
+    )
+
+    # The key marking the end of a known ingredient in the trie
+    _END = ""
+
+    def __init__(self, lexicon: dict[str, int]):
+        self.hits = 0
+        self.misses = 0
+        # Lines are matched by every detector thread at once
+        self._lock = threading.Lock()
+        self._trie: dict = {}
+        for ingredient, mask in lexicon.items():
+            node = self._trie
+            for word in self.words(ingredient):
+                node = node.setdefault(word, {})
+            node[self._END] = mask
+
+    @staticmethod
+    def from_csv(path: str) -> "KeywordMatcher":
+        """
+        Build a matcher from a CSV of ingredients labelled with allergens.
+
+        Ingredients listed more than once with different allergens are
+        ambiguous, so they are left out of the lexicon.
+        """
+        allergen_columns = AllergenGroup.to_list()
+        lexicon: dict[str, int] = {}
+        ambiguous = set()
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                ingredient = " ".join(KeywordMatcher.words(row["Ingredient"]))
+                mask = sum(
+                    1 << i
+                    for i, allergen in enumerate(allergen_columns)
+                    if row[allergen] == "1"
+                )
+                if lexicon.get(ingredient, mask) != mask:
+                    ambiguous.add(ingredient)
+                lexicon[ingredient] = mask
+
+        return KeywordMatcher(
+            {
+                ingredient: mask
+                for ingredient, mask in lexicon.items()
+                if ingredient and ingredient not in ambiguous
+            }
+        )
+
+    @staticmethod
+    def words(line: str) -> list[str]:
+        """Split a line into lower-case words, dropping numbers and punctuation."""
+        return re.findall(r"[a-z]+", line.lower())
+
+    def match(self, line: str) -> Optional[int]:
+        """
+        Get the allergen bitmask of a line, if it can be resolved confidently.
+
+        :param line: The ingredient line.
+        :return: The allergen bitmask, or None if the model should decide.
+        """
+        mask = self._match(line)
+        with self._lock:
+            if mask is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return mask
+
+    def _match(self, line: str) -> Optional[int]:
+        words = self.words(line)
+        mask = 0
+        matched = False
+        i = 0
+        while i < len(words):
+            # Find the longest known ingredient starting at this word
+            node = self._trie
+            longest = None
+            for j in range(i, len(words)):
+                node = node.get(words[j])
+                if node is None:
+                    break
+                if self._END in node:
+                    longest = (j, node[self._END])
+
+            if longest is not None:
+                end, ingredient_mask = longest
+                mask |= ingredient_mask
+                matched = True
+                i = end + 1
+            elif words[i] in self.FILLER_WORDS:
+                i += 1
+            else:
+                return None
+
+        return mask if matched else None
+
+    def stats(self) -> dict:
+        """Get the number of lines resolved, and left for the model."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
 class AllergenDetector:
-    def __init__(self, model, vectorizer):
+    def __init__(
+        self,
+        model,
+        vectorizer,
+        cache: Optional[IngredientCache] = None,
+        matcher: Optional[KeywordMatcher] = None,
+    ):
         self.model = model
         self.vectorizer = vectorizer
+        self.cache = cache
+        # When given, lines the matcher resolves never reach the model
+        self.matcher = matcher
 
     def detect(self, ingredients: list[str]) -> list[str]:
         """Detect allergens in a recipe."""
-        if not ingredients:
-            return []
+        return self.detect_many([ingredients])[0]
 
-        # Transform the ingredients into a TF-IDF vector
-        input_tfidf = self.vectorizer.transform(ingredients)
-        predictions = self.model.predict(input_tfidf)
+    def detect_many(self, recipes: list[list[str]]) -> list[list[str]]:
+        """
+        Detect allergens in many recipes at once.
 
-        # Get the allergen columns from the model
-        allergen_columns = AllergenGroup.to_list()
+        :param recipes: A list of recipes, each given as its list of ingredients.
+        :return: The sorted allergens of each recipe, in the same order.
+        """
+        return [AllergenGroup.from_mask(mask) for mask in self.detect_masks(recipes)]
+
+    def detect_masks(self, recipes: list[list[str]]) -> list[int]:
+        """
+        Detect allergens in many recipes at once, as bitmasks.
+
+        The ingredient lines of every recipe are stacked into a single
+        TF-IDF matrix so the model is only invoked once, which avoids
+        the per-call overhead of the vectorizer and the classifier.
+
+        :param recipes: A list of recipes, each given as its list of ingredients.
+        :return: The allergen bitmask of each recipe, as from
+            ``AllergenGroup.to_mask``, in the same order.
+        """
+        # Empty recipes contribute no rows, so they are reduced separately
+        lengths = np.array([len(ingredients) for ingredients in recipes], dtype=int)
+        non_empty = lengths > 0
+        if not non_empty.any():
+            return [0 for _ in recipes]
+
+        # Get the allergen bitmask of every ingredient line
+        lines = [ingredient for ingredients in recipes for ingredient in ingredients]
+        line_masks = self._predict_masks(lines)
+
+        # Reduce the ingredient bitmasks into one bitmask per recipe
+        offsets = np.concatenate(([0], np.cumsum(lengths[non_empty])[:-1]))
+        recipe_masks = np.zeros(len(recipes), dtype=line_masks.dtype)
+        recipe_masks[non_empty] = np.bitwise_or.reduceat(line_masks, offsets)
+
+        return recipe_masks.tolist()
+
+    def _predict_masks(self, lines: list[str]) -> np.ndarray:
+        """Get the allergen bitmask of each ingredient line."""
+        if self.cache is None and self.matcher is None:
+            return self._predict(lines)
+
+        # Look up every line in the cache, and collect the distinct unseen lines
+        keys = [IngredientCache.normalise(line) for line in lines]
+        masks = np.zeros(len(lines), dtype=np.uint16)
+        unseen = {}
+        for i, key in enumerate(keys):
+            mask = None
+            if self.cache is not None and key not in unseen:
+                mask = self.cache.get(key)
+            if mask is None:
+                unseen.setdefault(key, []).append(i)
+            else:
+                masks[i] = mask
+
+        # Resolve what the matcher can, and send only the rest to the model
+        resolved = {}
+        if self.matcher is not None:
+            for key in unseen:
+                mask = self.matcher.match(key)
+                if mask is not None:
+                    resolved[key] = mask
+        unresolved = [key for key in unseen if key not in resolved]
+        if unresolved:
+            resolved.update(zip(unresolved, self._predict(unresolved).tolist()))
+
+        for key, indices in unseen.items():
+            if self.cache is not None:
+                self.cache.put(key, resolved[key])
+            masks[indices] = resolved[key]
+
+        return masks
+
+    def stats(self) -> dict:
+        """Get the counters of the cache and the matcher."""
+        stats = {}
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        if self.matcher is not None:
+            stats["matcher"] = self.matcher.stats()
+        return stats
+
+    def _predict(self, lines: list[str]) -> np.ndarray:
+        """Predict the allergen bitmask of each ingredient line with the model."""
+        input_tfidf = self.vectorizer.transform(lines)
+        predictions = np.asarray(self.model.predict(input_tfidf)) == 1
+
+        bits = np.left_shift(1, np.arange(predictions.shape[1], dtype=np.uint16))
+        return np.bitwise_or.reduce(predictions * bits, axis=1).astype(np.uint16)
+
+
+class CompiledForest:
+    """
+    A one-vs-rest random forest flattened into array-backed node tables.
+
+    The nodes of every tree are stored in shared arrays, with a leaf's
+    children pointing back at the leaf itself. It is a drop-in replacement
+    for the fitted ``OneVsRestClassifier(RandomForestClassifier)`` when
+    predicting.
+
+    Rows are evaluated sparsely: a zero feature always takes the same branch
+    of a node, so each node's all-zero path to a leaf is precomputed, and a
+    row only needs visiting at the nodes where one of its few non-zero
+    features sends it the other way.
+    """
+
+    # Rows are evaluated in chunks to bound the number of visited nodes
+    CHUNK_SIZE = 1024
+
+    # The arrays describing the trees
+    NODE_TABLES = ("feature", "threshold", "left", "right", "value", "roots", "n_trees")
+    # The arrays derived from the node tables to evaluate rows sparsely
+    INDEX_TABLES = (
+        "flip_child",
+        "zero_leaf",
+        "depth",
+        "tree_roots",
+        "tree_of",
+        "feature_nodes",
+        "feature_offsets",
+    )
+
+    def __init__(
+        self,
+        feature: np.ndarray,
+        threshold: np.ndarray,
+        left: np.ndarray,
+        right: np.ndarray,
+        value: np.ndarray,
+        roots: np.ndarray,
+        n_trees: np.ndarray,
+        index: Optional[dict[str, np.ndarray]] = None,
+    ):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        # The root node of each tree, as a matrix of labels by trees
+        self.roots = roots
+        # The number of trees in each label's forest
+        self.n_trees = n_trees
+
+        if index is None:
+            index = CompiledForest.build_index(feature, threshold, left, right, roots)
+        self._flip_child = index["flip_child"]
+        self._zero_leaf = index["zero_leaf"]
+        self._depth = index["depth"]
+        self._tree_roots = index["tree_roots"]
+        self._tree_of = index["tree_of"]
+        self._feature_nodes = index["feature_nodes"]
+        self._feature_offsets = index["feature_offsets"]
+
+    @staticmethod
+    def build_index(
+        feature: np.ndarray,
+        threshold: np.ndarray,
+        left: np.ndarray,
+        right: np.ndarray,
+        roots: np.ndarray,
+    ) -> dict[str, np.ndarray]:
+        """Derive the lookup tables used to evaluate rows sparsely."""
+        node_ids = np.arange(len(feature))
+        is_leaf = left == node_ids
+
+        # The branch taken by a zero feature, and the branch taken otherwise
+        zero_goes_left = 0 <= threshold
+        zero_child = np.where(zero_goes_left, left, right)
+        flip_child = np.where(zero_goes_left, right, left)
+
+        # The leaf reached from each node when every feature is zero
+        zero_leaf = zero_child
+        while True:
+            next_leaf = zero_leaf[zero_leaf]
+            if np.array_equal(next_leaf, zero_leaf):
+                break
+            zero_leaf = next_leaf
+
+        # The depth of each node within its tree
+        parent = node_ids.copy()
+        parent[left[~is_leaf]] = node_ids[~is_leaf]
+        parent[right[~is_leaf]] = node_ids[~is_leaf]
+        depth = (parent != node_ids).astype(np.int32)
+        while True:
+            next_parent = parent[parent]
+            if np.array_equal(next_parent, parent):
+                break
+            depth = depth + depth[parent]
+            parent = next_parent
+
+        # The tree of each node, as trees are stored contiguously
+        tree_roots = np.unique(roots)
+        tree_of = np.searchsorted(tree_roots, node_ids, side="right") - 1
+
+        # The split nodes grouped by feature, to look up a row's nodes quickly
+        split_nodes = node_ids[~is_leaf]
+        order = np.argsort(feature[split_nodes], kind="stable")
+        feature_nodes = split_nodes[order]
+        feature_offsets = np.searchsorted(
+            feature[feature_nodes], np.arange(feature.max(initial=0) + 2)
+        )
+
+        return {
+            "flip_child": flip_child,
+            "zero_leaf": zero_leaf,
+            "depth": depth,
+            "tree_roots": tree_roots,
+            "tree_of": tree_of,
+            "feature_nodes": feature_nodes,
+            "feature_offsets": feature_offsets,
+        }
+
+    @staticmethod
+    def from_sklearn(model) -> "CompiledForest":
+        """Flatten a fitted one-vs-rest random forest."""
+        features, thresholds, lefts, rights, values = [], [], [], [], []
+        forests = []
+        offset = 0
+
+        def add_tree(feature, threshold, left, right, value) -> int:
+            nonlocal offset
+            node_ids = np.arange(offset, offset + len(feature))
+            is_leaf = left < 0
+            features.append(np.where(is_leaf, 0, feature).astype(np.int32))
+            thresholds.append(threshold.astype(np.float64))
+            lefts.append(np.where(is_leaf, node_ids, left + offset).astype(np.int32))
+            rights.append(np.where(is_leaf, node_ids, right + offset).astype(np.int32))
+            values.append(value.astype(np.float64))
+            root = offset
+            offset += len(feature)
+            return root
+
+        for estimator in model.estimators_:
+            if not hasattr(estimator, "estimators_"):
+                # A label with a single class in the training data always
+                # predicts that class, which is a tree with a single leaf
+                leaf = np.array([-1])
+                constant = np.array([float(np.ravel(estimator.y_)[0])])
+                forests.append([add_tree(leaf, np.zeros(1), leaf, leaf, constant)])
+                continue
+
+            positive = list(estimator.classes_).index(1)
+            roots = []
+            for tree in estimator.estimators_:
+                tree_ = tree.tree_
+                proba = tree_.value[:, 0, :]
+                normalizer = proba.sum(axis=1, keepdims=True)
+                if not np.allclose(normalizer, 1):
+                    normalizer[normalizer == 0] = 1
+                    proba = proba / normalizer
+                roots.append(
+                    add_tree(
+                        tree_.feature,
+                        tree_.threshold,
+                        tree_.children_left,
+                        tree_.children_right,
+                        proba[:, positive],
+                    )
+                )
+            forests.append(roots)
+
+        # Pad smaller forests with the root of their first tree; the padding
+        # is masked out when averaging so it never affects predictions
+        n_trees = np.array([len(roots) for roots in forests], dtype=np.int32)
+        padded = np.array(
+            [roots + [roots[0]] * (n_trees.max() - len(roots)) for roots in forests],
+            dtype=np.int32,
+        )
+
+        return CompiledForest(
+            np.concatenate(features),
+            np.concatenate(thresholds),
+            np.concatenate(lefts),
+            np.concatenate(rights),
+            np.concatenate(values),
+            padded,
+            n_trees,
+        )
+
+    @staticmethod
+    def load(path: str, mmap_mode: Optional[str] = None) -> "CompiledForest":
+        """
+        Load a compiled forest saved with ``save``.
+
+        :param path: The ``.npz`` file, or the directory of ``.npy`` files.
+        :param mmap_mode: How to memory-map a directory of ``.npy`` files, for
+            example "r" so every process loading it shares the same pages.
+        :return: The compiled forest.
+        """
+        if os.path.isdir(path):
+            arrays = {
+                name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+                for name in CompiledForest.NODE_TABLES + CompiledForest.INDEX_TABLES
+                if os.path.exists(os.path.join(path, f"{name}.npy"))
+            }
+        else:
+            with np.load(path) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+
+        index = None
+        if all(name in arrays for name in CompiledForest.INDEX_TABLES):
+            index = {name: arrays[name] for name in CompiledForest.INDEX_TABLES}
+
+        return CompiledForest(
+            *[arrays[name] for name in CompiledForest.NODE_TABLES], index=index
+        )
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        """Get the node tables and their index, keyed by name."""
+        return {
+            "feature": self.feature,
+            "threshold": self.threshold,
+            "left": self.left,
+            "right": self.right,
+            "value": self.value,
+            "roots": self.roots,
+            "n_trees": self.n_trees,
+            "flip_child": self._flip_child,
+            "zero_leaf": self._zero_leaf,
+            "depth": self._depth,
+            "tree_roots": self._tree_roots,
+            "tree_of": self._tree_of,
+            "feature_nodes": self._feature_nodes,
+            "feature_offsets": self._feature_offsets,
+        }
+
+    def save(self, path: str):
+        """
+        Save the node tables and their index.
+
+        A path ending in ``.npz`` saves a single NumPy archive; any other path
+        is a directory of ``.npy`` files, which can be memory-mapped on load.
+        """
+        arrays = self.arrays()
+        if path.endswith(".npz"):
+            np.savez(path, **arrays)
+            return
+
+        os.makedirs(path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), array)
+
+    def predict_proba(self, X) -> np.ndarray:
+        """Get the probability of each label for each row of X."""
+        from scipy import sparse
+
+        X = sparse.csr_matrix(X)
+        proba = np.zeros((X.shape[0], self.roots.shape[0]), dtype=np.float64)
+        for start in range(0, X.shape[0], self.CHUNK_SIZE):
+            end = start + self.CHUNK_SIZE
+            proba[start:end] = self._predict_chunk(X[start:end])
+        return proba
+
+    def predict(self, X) -> np.ndarray:
+        """Predict the labels of each row of X, as a binary indicator matrix."""
+        return (self.predict_proba(X) > 0.5).astype(int)
+
+    def _predict_chunk(self, X) -> np.ndarray:
+        n_rows = X.shape[0]
+        n_trees = len(self._tree_roots)
+
+        # Every row starts at the leaf its all-zero path leads to
+        leaves = np.tile(self._zero_leaf[self._tree_roots], (n_rows, 1))
+
+        # Find the split nodes on each non-zero feature of each row. The
+        # trees compare features as 32-bit floats, like scikit-learn does
+        rows = np.repeat(np.arange(n_rows), np.diff(X.indptr))
+        features = X.indices
+        values = X.data.astype(np.float32)
+
+        # Features beyond the last one used by any split can be ignored
+        used = features < len(self._feature_offsets) - 1
+        rows, features, values = rows[used], features[used], values[used]
+        starts = self._feature_offsets[features]
+        counts = self._feature_offsets[features + 1] - starts
+        entries = np.repeat(np.arange(len(features)), counts)
+        positions = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        nodes = self._feature_nodes[starts[entries] + positions]
+
+        # Only nodes where the row leaves the all-zero path matter
+        values = values[entries]
+        flips = (values > self.threshold[nodes]) != (0 > self.threshold[nodes])
+        nodes = nodes[flips]
+        pairs = rows[entries[flips]] * n_trees + self._tree_of[nodes]
+
+        # Group the nodes by row and tree, shallowest first
+        order = np.lexsort((self._depth[nodes], pairs))
+        nodes = nodes[order]
+        pairs, groups = np.unique(pairs[order], return_inverse=True)
+        current = self._tree_roots[pairs % n_trees]
+
+        # Follow each path, taking the other branch at the shallowest node
+        # that's still ahead on the current all-zero path, until none are
+        while nodes.size:
+            at = current[groups]
+            ahead = (self._zero_leaf[nodes] == self._zero_leaf[at]) & (
+                self._depth[nodes] >= self._depth[at]
+            )
+            if not ahead.any():
+                break
+            first = np.flatnonzero(ahead)
+            flipped_groups, index = np.unique(groups[first], return_index=True)
+            current[flipped_groups] = self._flip_child[nodes[first[index]]]
+
+            # Nodes above the new position can never be reached again
+            keep = self._depth[nodes] >= self._depth[current[groups]]
+            nodes, groups = nodes[keep], groups[keep]
+
+        np.put(leaves, pairs, self._zero_leaf[current])
+
+        # Average the leaf values of each label's trees in order
+        slots = np.searchsorted(self._tree_roots, self.roots)
+        leaf_values = self.value[leaves[:, slots]]
+        proba = np.zeros((n_rows, self.roots.shape[0]), dtype=np.float64)
+        for i in range(self.roots.shape[1]):
+            proba += np.where(i < self.n_trees, leaf_values[:, :, i], 0.0)
+        return proba / self.n_trees
+
+
+def load_model(path: str, mmap_mode: Optional[str] = None):
+    """
+    Load an allergen model, either compiled or pickled with joblib.
+
+    :param path: A compiled forest (``.npz`` or a directory), or a pickle.
+    :param mmap_mode: The memory-map mode for the model's arrays, if any.
+    :return: The model.
+    """
+    if path.endswith(".npz") or os.path.isdir(path):
+        return CompiledForest.load(path, mmap_mode=mmap_mode)
+
+    import joblib
+
+    return joblib.load(path, mmap_mode=mmap_mode)
+
+
+def resolve_model_path(path: str) -> str:
+    """
+    Find the model to load for a pickled model's path, preferring the model
+    ``bin/train_model.py`` compiled next to it, if there is one.
+
+    :param path: The model's path.
+    :return: The compiled model's path, or the path given if it isn't a
+        pickle or there's no compiled model.
+    """
+    if path.endswith(".pkl"):
+        stem = path[: -len(".pkl")]
+        if os.path.isdir(stem):
+            return stem
+        if os.path.isfile(f"{stem}.npz"):
+            return f"{stem}.npz"
+    return path
+
+
+def detector_version(
+    model_path: str, vectorizer_path: str, lexicon_path: Optional[str] = None
+) -> str:
+    """
+    Get a version of the allergen detector, from the name, size and
+    modification time of the files it loads, so it changes whenever the model
+    is retrained or replaced, without reading the model.
+
+    :param model_path: The compiled or pickled model, as for ``load_detector``.
+    :param vectorizer_path: The pickled TF-IDF vectorizer.
+    :param lexicon_path: The labelled ingredients for the keyword fast path, if any.
+    :return: The version.
+    """
+    digest = sha256()
+    for path in [resolve_model_path(model_path), vectorizer_path, lexicon_path]:
+        if path is None or not os.path.exists(path):
+            continue
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if os.path.isfile(os.path.join(path, name))
+            )
+        else:
+            files = [path]
+        for file in files:
+            stat = os.stat(file)
+            digest.update(
+                f"{os.path.abspath(file)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode(
+                    "utf-8"
+                )
+            )
+    return digest.hexdigest()[:16]
+
+
+def load_detector(
+    model_path: str,
+    vectorizer_path: str,
+    cache_size: int = 0,
+    lexicon_path: Optional[str] = None,
+    mmap_mode: Optional[str] = None,
+) -> AllergenDetector:
+    """
+    Load the model, vectorizer and lexicon into an allergen detector.
+
+    :param model_path: The compiled or pickled model. For a pickle, the model
+        compiled next to it is loaded instead, if there is one.
+    :param vectorizer_path: The pickled TF-IDF vectorizer.
+    :param cache_size: The number of ingredient lines to cache, or 0 for none.
+    :param lexicon_path: The labelled ingredients for the keyword fast path, if any.
+    :param mmap_mode: The memory-map mode for the model's arrays, if any.
+    :return: The detector.
+    """
+    import joblib
+
+    model = load_model(resolve_model_path(model_path), mmap_mode=mmap_mode)
+    vectorizer = joblib.load(vectorizer_path, mmap_mode=mmap_mode)
+    if not model or not vectorizer:
+        raise Exception("Failed to load model or vectorizer")
+
+    return AllergenDetector(
+        model,
+        vectorizer,
+        cache=IngredientCache(cache_size) if cache_size else None,
+        matcher=KeywordMatcher.from_csv(lexicon_path) if lexicon_path else None,
+    )
+
+
+class LazyDetector:
+    """
+    An allergen detector which is only loaded when it's first needed.
+
+    Loading the detector imports scikit-learn and reads the model from disk,
+    so deferring it lets the server start serving pages straight away.
+    """
+
+    def __init__(self, load: Callable[[], AllergenDetector]):
+        self._load = load
+        self._detector: Optional[AllergenDetector] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._detector is not None
+
+    def load(self) -> AllergenDetector:
+        """Load the detector, unless it has been already."""
+        if self._detector is None:
+            with self._lock:
+                if self._detector is None:
+                    self._detector = self._load()
+        return self._detector
+
+    def detect_many(self, recipes: list[list[str]]) -> list[list[str]]:
+        """Detect allergens in many recipes at once, loading the detector first."""
+        return self.load().detect_many(recipes)
+
+    def stats(self) -> dict:
+        """Get the counters of the detector, once it's loaded."""
+        return self._detector.stats() if self._detector is not None else {}
+
+
+class DetectorSaturated(Exception):
+    """Raised when the detector pool has no capacity left for more recipes."""
+
+
+class DetectorPool:
+    """
+    Run allergen detection in an executor so it doesn't block the event loop.
+
+    At most ``max_pending`` calls may be running or queued at once; any
+    further call fails fast with ``DetectorSaturated`` instead of queueing
+    without bound.
+
+    The pool is ready once ``warm_up`` has loaded the detector in each
+    worker, or once a detection has succeeded.
+    """
+
+    def __init__(
+        self,
+        executor: Executor,
+        detect_many: Callable[[list[list[str]]], list[list[str]]],
+        max_pending: int = 64,
+        detector: Optional[AllergenDetector | LazyDetector] = None,
+        warm_up: Optional[Callable[[], object]] = None,
+        workers: int = 1,
+    ):
+        self.executor = executor
+        self.max_pending = max_pending
+        self.pending = 0
+        # The shared detector, if any, whose counters are reported in stats
+        self.detector = detector
+        self.workers = workers
+        self.ready = warm_up is None
+        self._detect_many = detect_many
+        self._warm_up = warm_up
+
+    @staticmethod
+    def threaded(
+        detector: AllergenDetector | LazyDetector,
+        workers: int = 1,
+        max_pending: int = 64,
+    ) -> "DetectorPool":
+        """Create a pool which shares the given detector between threads."""
+        return DetectorPool(
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="detector"),
+            detector.detect_many,
+            max_pending,
+            detector,
+            warm_up=detector.load if isinstance(detector, LazyDetector) else None,
+            workers=workers,
+        )
+
+    @staticmethod
+    def multiprocess(
+        model_path: str,
+        vectorizer_path: str,
+        cache_size: int = 0,
+        lexicon_path: Optional[str] = None,
+        mmap_mode: Optional[str] = None,
+        workers: int = 1,
+        max_pending: int = 64,
+    ) -> "DetectorPool":
+        """Create a pool of processes which each preload their own detector."""
+        return DetectorPool(
+            ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker_detector,
+                initargs=(
+                    model_path,
+                    vectorizer_path,
+                    cache_size,
+                    lexicon_path,
+                    mmap_mode,
+                ),
+            ),
+            _detect_many_in_worker,
+            max_pending,
+            warm_up=_warm_up_worker,
+            workers=workers,
+        )
+
+    async def detect(self, ingredients: list[str]) -> list[str]:
+        """Detect allergens in a recipe."""
+        return (await self.detect_many([ingredients]))[0]
+
+    async def detect_many(self, recipes: list[list[str]]) -> list[list[str]]:
+        """Detect allergens in many recipes at once."""
+        if self.pending >= self.max_pending:
+            raise DetectorSaturated(f"{self.pending} detections already pending")
+
+        loop = asyncio.get_running_loop()
+        job = self.executor.submit(self._detect_many, recipes)
+        self.pending += 1
+        # A job keeps running when its caller is cancelled, so it's pending
+        # until the job itself is done
+        job.add_done_callback(lambda _: self._call_soon(loop, self._job_done))
+        results = await asyncio.wrap_future(job)
+        self.ready = True
+        return results
+
+    async def warm_up(self):
+        """Load the detector in every worker ahead of the first recipe."""
+        if self._warm_up is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                await asyncio.gather(
+                    *[
+                        loop.run_in_executor(self.executor, self._warm_up)
+                        for _ in range(self.workers)
+                    ]
+                )
+            except Exception:
+                logging.exception("Failed to warm up the allergen detector")
+                return
+        self.ready = True
+
+    def stats(self) -> dict:
+        """Get the number of pending detections, and the detector's counters."""
+        stats = {
+            "ready": self.ready,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+        }
+        if self.detector is not None:
+            stats["detector"] = self.detector.stats()
+        return stats
+
+    def shutdown(self):
+        """Shut down the executor, waiting for pending detections to finish."""
+        self.executor.shutdown(wait=True)
+
+    def _job_done(self):
+        self.pending -= 1
+
+    @staticmethod
+    def _call_soon(loop: asyncio.AbstractEventLoop, callback: Callable[[], None]):
+        """Call back on the event loop from a worker thread, unless it has closed."""
+        try:
+            loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass
+
+
+class Histogram:
+    """A histogram of observed values over fixed bucket upper bounds."""
+
+    def __init__(self, bounds: list[float]):
+        self.bounds = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Record a value in the first bucket whose bound is at least the value."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict:
+        """Get the bucket counts, keyed by upper bound, with the count and sum."""
+        labels = [f"{bound:g}" for bound in self.bounds] + ["+Inf"]
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+class BatchScheduler:
+    """
+    Coalesce concurrent detections into batches for a detector pool.
+
+    Recipes are collected until ``max_batch_size`` are waiting or the first
+    of them has waited ``max_wait_ms``, then the whole batch is detected in
+    a single ``detect_many`` call and each result handed back to its caller.
+    """
+
+    def __init__(
+        self,
+        pool: DetectorPool,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5,
+        max_pending: int = 1024,
+    ):
+        self.pool = pool
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_pending = max_pending
+        self.batch_sizes = Histogram([1, 2, 4, 8, 16, 32, 64, 128, 256])
+        self.latencies_ms = Histogram([1, 2, 5, 10, 25, 50, 100, 250, 500, 1000])
+        self._queue: list[tuple[list[str], asyncio.Future, float]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._batches: set[asyncio.Task] = set()
+
+    async def detect(self, ingredients: list[str]) -> list[str]:
+        """Detect allergens in a recipe, as part of the next batch."""
+        if len(self._queue) >= self.max_pending:
+            raise DetectorSaturated(f"{len(self._queue)} recipes already queued")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((ingredients, future, time.perf_counter()))
+
+        if len(self._queue) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait_ms / 1000, self._flush)
+
+        return await future
+
+    async def detect_many(self, recipes: list[list[str]]) -> list[list[str]]:
+        """Detect allergens in many recipes, which are already a batch."""
+        return await self.pool.detect_many(recipes)
+
+    @property
+    def ready(self) -> bool:
+        return self.pool.ready
+
+    async def warm_up(self):
+        """Load the detector of the pool ahead of the first recipe."""
+        await self.pool.warm_up()
+
+    async def drain(self):
+        """Detect every queued recipe and wait for all batches to finish."""
+        while self._queue:
+            self._flush()
+        if self._batches:
+            await asyncio.wait(self._batches)
+
+    def stats(self) -> dict:
+        """Get the batch size and latency histograms."""
+        return {
+            "queued": len(self._queue),
+            "batch_size": self.batch_sizes.to_dict(),
+            "latency_ms": self.latencies_ms.to_dict(),
+            "pool": self.pool.stats(),
+        }
+
+    def _flush(self):
+        """Start detecting the next batch of queued recipes."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch = self._queue[: self.max_batch_size]
+        del self._queue[: self.max_batch_size]
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+        # Recipes beyond the batch wait for the next one
+        if self._queue:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.max_wait_ms / 1000, self._flush)
+
+    async def _run(self, batch: list[tuple[list[str], asyncio.Future, float]]):
+        """Detect a batch of recipes and hand each result back to its caller."""
+        self.batch_sizes.observe(len(batch))
+        try:
+            results = await self.pool.detect_many(
+                [ingredients for ingredients, _, _ in batch]
+            )
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        finished_at = time.perf_counter()
+        for (_, future, enqueued_at), allergens in zip(batch, results):
+            self.latencies_ms.observe((finished_at - enqueued_at) * 1000)
+            if not future.done():
+                future.set_result(allergens)
+
+
+# The detector of the current worker process, loaded by the pool initializer
+_WORKER_DETECTOR: Optional[AllergenDetector] = None
+
+
+def _init_worker_detector(
+    model_path: str,
+    vectorizer_path: str,
+    cache_size: int,
+    lexicon_path: Optional[str],
+    mmap_mode: Optional[str],
+):
+    """Load the detector once per worker process."""
+    global _WORKER_DETECTOR
+    _WORKER_DETECTOR = load_detector(
+        model_path,
+        vectorizer_path,
+        cache_size=cache_size,
+        lexicon_path=lexicon_path,
+        mmap_mode=mmap_mode,
+    )
 
-        # Get the allergens from the predictions
-        unique_allergens = set()
-        for prediction in predictions:
-            allergens = [
-                allergen_columns[i]
-                for i in range(len(allergen_columns))
-                if prediction[i] == 1
-            ]
-            unique_allergens.update(allergens)
 
-        # Convert the set to a list
-        allergens = list(unique_allergens)
+def _warm_up_worker():
+    """Do nothing, as the pool initializer has loaded the detector already."""
 
-        # Sort the allergens alphabetically
-        allergens.sort()
 
-        return allergens
+def _detect_many_in_worker(recipes: list[list[str]]) -> list[list[str]]:
+    return _WORKER_DETECTOR.detect_many(recipes)
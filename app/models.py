@@ -1,4 +1,5 @@
 import json
+from hashlib import sha256
 from enum import StrEnum, auto
 from re import Pattern
 from typing import Annotated, Optional
@@ -53,6 +54,17 @@ class Recipe(BaseModel):
     def to_json(self) -> str:
         return json.dumps(self.model_dump(by_alias=True))
 
+    def content_hash(self, detector_version: Optional[str] = None) -> str:
+        """
+        Get a hash of what the allergens depend on: the scraped content, and
+        the version of the detector which detects them, if given.
+        """
+        content = self.model_dump(exclude={"id", "allergens"})
+        if detector_version is not None:
+            content["detector_version"] = detector_version
+        serialized = json.dumps(content, sort_keys=True, separators=(",", ":"))
+        return sha256(serialized.encode("utf-8")).hexdigest()
+
 
 class AllergenGroup(StrEnum):
     GLUTEN = auto()
@@ -76,3 +88,24 @@ class AllergenGroup(StrEnum):
     @staticmethod
     def to_list() -> list[str]:
         return [f"{allergen}" for allergen in AllergenGroup]
+
+    @staticmethod
+    def to_mask(allergens: list[str]) -> int:
+        """
+        Get the bitmask of the allergens, where bit i is set for the allergen
+        at position i in ``AllergenGroup.to_list()``. Unknown names are ignored.
+        """
+        bits = {allergen: 1 << i for i, allergen in enumerate(AllergenGroup.to_list())}
+        mask = 0
+        for allergen in allergens:
+            mask |= bits.get(allergen, 0)
+        return mask
+
+    @staticmethod
+    def from_mask(mask: int) -> list[str]:
+        """Get the allergens in a bitmask from ``to_mask``, sorted by name."""
+        return sorted(
+            allergen
+            for i, allergen in enumerate(AllergenGroup.to_list())
+            if mask & (1 << i)
+        )
@@ -0,0 +1,262 @@
+import asyncio
+import collections
+import contextlib
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from app.crawler import Crawler
+from app.frontier import Frontier, url_id
+from app.models import Recipe, RecipeWebsite
+from app.parsers import SchemaOrgParser
+
+
+class ScrapePipeline:
+    """
+    Scrape the recipes of sites in three stages, which run at the same time.
+
+    The crawler downloads pages, an executor parses them into recipes, and
+    the recipes are saved in batches by the sink. The stages are connected
+    by bounded queues, so a stage that falls behind holds back the stages
+    before it, instead of the pages or recipes piling up in memory.
+
+    Given a frontier, the state of each URL is recorded as it goes, and the
+    URLs the frontier has settled are skipped, so a crawl can resume where
+    it left off.
+    """
+
+    def __init__(
+        self,
+        crawler: Crawler,
+        sink: Callable[[list[Recipe]], Awaitable[list[Recipe]]],
+        executor: Executor,
+        parse: Callable[[str], Optional[Recipe]],
+        workers: int = 1,
+        batch_size: int = 100,
+        frontier: Optional[Frontier] = None,
+    ):
+        """
+        :param crawler: Downloads the pages.
+        :param sink: Saves a batch of recipes, returning those it couldn't save.
+        :param executor: Runs ``parse``.
+        :param parse: Parses a page into a recipe, if it has one.
+        :param workers: The number of workers of the executor.
+        :param batch_size: The most recipes given to the sink at once.
+        :param frontier: Records the state of each URL, if given.
+        """
+        self.crawler = crawler
+        self.sink = sink
+        self.executor = executor
+        self.workers = workers
+        self.batch_size = batch_size
+        self.frontier = frontier
+        self.stats: dict[str, collections.Counter] = collections.defaultdict(
+            collections.Counter
+        )
+        self._parse = parse
+        # Enough pages to keep every worker busy while the next ones download
+        self._pages = asyncio.Queue(maxsize=workers * 4)
+        self._recipes = asyncio.Queue(maxsize=batch_size * 2)
+        # The recipes saved of each site, including those posted before it
+        # resumed
+        self._found = collections.Counter()
+        # The sites which have saved as many recipes as they need
+        self._finished: set[str] = set()
+
+    @staticmethod
+    def multiprocess(
+        crawler: Crawler,
+        sink: Callable[[list[Recipe]], Awaitable[list[Recipe]]],
+        workers: int = 1,
+        batch_size: int = 100,
+        fast: bool = True,
+        frontier: Optional[Frontier] = None,
+    ) -> "ScrapePipeline":
+        """Create a pipeline which parses pages in a pool of processes."""
+        return ScrapePipeline(
+            crawler,
+            sink,
+            ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker_parser,
+                initargs=(fast,),
+            ),
+            _parse_in_worker,
+            workers,
+            batch_size,
+            frontier,
+        )
+
+    async def run(self, sites: list[RecipeWebsite]) -> dict[str, collections.Counter]:
+        """
+        Scrape the sites, until each has saved ``max_links`` recipes or its
+        sitemap runs out.
+
+        :return: The number of recipes parsed, saved as "scraped", failed, and
+            skipped as the frontier had settled them, by site.
+        """
+        sites = {site.name: site for site in sites}
+        async with asyncio.TaskGroup() as group:
+            group.create_task(self._fetch(sites.values()))
+            group.create_task(self._parse_pages())
+            group.create_task(self._save(sites))
+        return self.stats
+
+    def shutdown(self):
+        """Shut down the executor."""
+        self.executor.shutdown(wait=True)
+
+    async def _fetch(self, sites):
+        """Download the pages of the sites, queueing them to be parsed."""
+        try:
+            await asyncio.gather(*(self._fetch_site(site) for site in sites))
+        finally:
+            for _ in range(self.workers):
+                await self._pages.put(None)
+
+    async def _fetch_site(self, site: RecipeWebsite):
+        async def fetch(url: str) -> Optional[str]:
+            if not await self.crawler.allowed(url, site.robots_url):
+                logging.info("Skipping %s, disallowed by robots.txt", url)
+                return None
+            return await self.crawler.fetch(url)
+
+        urls = self.crawler.walk_sitemap(site.sitemap_url, site.recipe_url_pattern)
+        if self.frontier is not None:
+            urls = self._unsettled(site, urls)
+        async with contextlib.aclosing(self.crawler.crawl(urls, fetch)) as pages:
+            async for url, content in pages:
+                if site.name in self._finished:
+                    break
+                if isinstance(content, Exception):
+                    self.stats[site.name]["failed"] += 1
+                    await self._mark(url, "failed", error=str(content))
+                elif content is not None:
+                    await self._mark(url, "fetched")
+                    await self._pages.put((site.name, url, content))
+
+    async def _unsettled(
+        self, site: RecipeWebsite, urls: AsyncIterator[str]
+    ) -> AsyncIterator[str]:
+        """Skip the URLs the frontier has settled."""
+        async with contextlib.aclosing(urls):
+            async for url in urls:
+                settled = await asyncio.to_thread(self._claim, url, site.name)
+                if settled is None:
+                    yield url
+                    continue
+                self.stats[site.name]["skipped"] += 1
+                if settled == "posted":
+                    self._found_recipe(site)
+                if site.name in self._finished:
+                    return
+
+    async def _parse_pages(self):
+        """Parse the queued pages with one task per worker, queueing the recipes."""
+        try:
+            await asyncio.gather(*(self._parse_worker() for _ in range(self.workers)))
+        finally:
+            await self._recipes.put(None)
+
+    async def _parse_worker(self):
+        loop = asyncio.get_running_loop()
+        while (page := await self._pages.get()) is not None:
+            site_name, url, content = page
+            if site_name in self._finished:
+                continue
+            try:
+                recipe = await loop.run_in_executor(self.executor, self._parse, content)
+            except Exception as error:
+                logging.warning("Failed to parse %s", url, exc_info=True)
+                self.stats[site_name]["failed"] += 1
+                await self._mark(url, "failed", error=str(error))
+                continue
+            if not recipe:
+                await self._mark(url, "failed", error="No recipe found")
+                continue
+            # The site may have finished while the page was parsed
+            if site_name in self._finished:
+                continue
+            recipe.site_name = site_name
+            recipe.id = url_id(url)
+            recipe.url = url
+            self.stats[site_name]["parsed"] += 1
+            await self._mark(url, "parsed")
+            await self._recipes.put(recipe)
+
+    async def _save(self, sites: dict[str, RecipeWebsite]):
+        """Give the queued recipes to the sink in batches."""
+        batch = []
+        batched = collections.Counter()
+        while (recipe := await self._recipes.get()) is not None:
+            site = sites[recipe.site_name]
+            # Recipes parsed while the site's last batch was saved aren't needed
+            if site.name in self._finished:
+                continue
+            batch.append(recipe)
+            batched[site.name] += 1
+            # Save a site's recipes as soon as they may be all it needs, so
+            # it stops being crawled once they're saved
+            if (
+                len(batch) == self.batch_size
+                or self._found[site.name] + batched[site.name] >= site.max_links
+            ):
+                await self._save_batch(batch, sites)
+                batch = []
+                batched.clear()
+        await self._save_batch(batch, sites)
+
+    async def _save_batch(self, batch: list[Recipe], sites: dict[str, RecipeWebsite]):
+        if not batch:
+            return
+        failed = {id(recipe) for recipe in await self.sink(batch)}
+        for recipe in batch:
+            if id(recipe) in failed:
+                self.stats[recipe.site_name]["failed"] += 1
+            else:
+                self.stats[recipe.site_name]["scraped"] += 1
+                # Only saved recipes count towards the site's max_links
+                self._found_recipe(sites[recipe.site_name])
+        if self.frontier is not None:
+            await asyncio.to_thread(
+                self.frontier.mark_many,
+                [recipe.url for recipe in batch if id(recipe) not in failed],
+                "posted",
+            )
+            await asyncio.to_thread(
+                self.frontier.mark_many,
+                [recipe.url for recipe in batch if id(recipe) in failed],
+                "failed",
+                error="Not saved",
+            )
+
+    def _found_recipe(self, site: RecipeWebsite):
+        """Count a recipe of a site, which is finished once it has enough."""
+        self._found[site.name] += 1
+        if self._found[site.name] == site.max_links:
+            self._finished.add(site.name)
+
+    def _claim(self, url: str, site_name: str) -> Optional[str]:
+        """Check if the frontier has settled a URL, recording it as seen if not."""
+        settled = self.frontier.settled(url)
+        if settled is None:
+            self.frontier.mark(url, "seen", site_name)
+        return settled
+
+    async def _mark(self, url: str, state: str, error: Optional[str] = None):
+        # The frontier's queries wait on the disk, so run them off the loop
+        if self.frontier is not None:
+            await asyncio.to_thread(self.frontier.mark, url, state, error=error)
+
+
+# The parser of the current worker process, created by the pool initializer
+_WORKER_PARSER: Optional[SchemaOrgParser] = None
+
+
+def _init_worker_parser(fast: bool):
+    global _WORKER_PARSER
+    _WORKER_PARSER = SchemaOrgParser(fast=fast)
+
+
+def _parse_in_worker(content: str) -> Optional[Recipe]:
+    return _WORKER_PARSER.parse(content)
@@ -1,8 +1,17 @@
+import asyncio
+import base64
+import collections
+import datetime
+import json
+import logging
+import time
 from typing import Optional
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 
-from app.models import RecipeFilters, Recipe
+from app.models import RecipeFilters, Recipe, AllergenGroup
 
 
 class PagedResults:
@@ -10,27 +19,189 @@ class PagedResults:
         self,
         results: list,
         total: int,
-        page: int,
+        page: Optional[int],
         next_page: Optional[int],
         prev_page: Optional[int],
+        next_cursor: Optional[str] = None,
+        prev_cursor: Optional[str] = None,
+        facets: Optional[dict[str, dict[str, int]]] = None,
     ):
         self.results = results
         self.total = total
         self.page = page
         self.next_page = next_page
         self.prev_page = prev_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.facets = facets
+
+
+def encode_cursor(direction: str, recipe_id: str) -> str:
+    """
+    Encode an opaque pagination cursor.
+
+    :param direction: Either "after" or "before" the given recipe.
+    :param recipe_id: The ID of the recipe the page starts after or ends before.
+    :return: The cursor, safe to use in a URL.
+    """
+    payload = json.dumps({direction: recipe_id}).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Optional[tuple[str, str]]:
+    """
+    Decode a pagination cursor from ``encode_cursor``.
+
+    :param cursor: The cursor.
+    :return: The direction and recipe ID, or None if the cursor is invalid.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+        ((direction, recipe_id),) = payload.items()
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if direction not in ("after", "before") or not isinstance(recipe_id, str):
+        return None
+    return direction, recipe_id
+
+
+# The recipe field each of the available filters is drawn from
+FACET_FIELDS = {
+    "site_names": "site_name",
+    "cuisines": "cuisine",
+    "cook_times": "cook_time",
+    "diets": "diet",
+}
+
+
+class FacetCache:
+    """
+    Keep the available filters in memory for a while, along with the count of
+    each value and the total among every recipe, if they were counted.
+    """
+
+    def __init__(self, ttl: float = 60):
+        self.ttl = ttl
+        self.filters: Optional[dict] = None
+        self.counts: Optional[dict[str, dict[str, int]]] = None
+        self.total: Optional[int] = None
+        self.fetched_at: Optional[float] = None
+
+    @property
+    def age(self) -> Optional[float]:
+        """The seconds since the filters were fetched, or None if they weren't."""
+        if self.fetched_at is None:
+            return None
+        return time.monotonic() - self.fetched_at
+
+    def get(self) -> Optional[dict]:
+        """Get the filters, or None if they've expired."""
+        age = self.age
+        if age is None or age > self.ttl:
+            return None
+        return self.filters
+
+    def get_counts(self) -> Optional[dict[str, dict[str, int]]]:
+        """
+        Get the count of each value, or None if they've expired or weren't
+        counted. Upserts don't change the counts until they expire.
+        """
+        if self.get() is None:
+            return None
+        return self.counts
+
+    def get_total(self) -> Optional[int]:
+        """Get the number of recipes, or None if it has expired or wasn't counted."""
+        if self.get() is None:
+            return None
+        return self.total
+
+    def put(
+        self,
+        filters: dict,
+        counts: Optional[dict[str, dict[str, int]]] = None,
+        total: Optional[int] = None,
+    ):
+        self.filters = filters
+        self.counts = counts
+        self.total = total
+        self.fetched_at = time.monotonic()
+
+    def add(self, values: dict[str, set]):
+        """
+        Add a recipe's values to the cached filters.
+
+        Values no recipe has any more are only dropped once the filters expire.
+        """
+        if self.filters is None:
+            return
+        for key, new_values in values.items():
+            missing = new_values.difference(self.filters.get(key, []))
+            if missing:
+                self.filters[key] = [*self.filters.get(key, []), *missing]
+
+    def invalidate(self):
+        self.filters = None
+        self.counts = None
+        self.total = None
+        self.fetched_at = None
 
 
 class RecipeService:
-    def __init__(self, db: AsyncIOMotorClient):
+    # Each filter is paired with the sort key, so a page can be read in order
+    # from the index without sorting every matching recipe
+    INDEXES = [
+        IndexModel([("site_name", ASCENDING), ("_id", DESCENDING)]),
+        IndexModel([("cuisine", ASCENDING), ("_id", DESCENDING)]),
+        IndexModel([("diet", ASCENDING), ("_id", DESCENDING)]),
+        IndexModel([("cook_time", ASCENDING), ("_id", DESCENDING)]),
+        # Bitmask tests can't narrow an index scan, but with the mask alongside
+        # the sort key, recipes are excluded without being fetched
+        IndexModel([("_id", DESCENDING), ("allergen_mask", ASCENDING)]),
+    ]
+
+    def __init__(
+        self,
+        db: AsyncIOMotorClient,
+        facet_cache: Optional[FacetCache] = None,
+        materialized_facets: bool = False,
+        approximate_counts: bool = False,
+        detector_version: Optional[str] = None,
+    ):
+        """
+        :param db: The database.
+        :param facet_cache: Caches the available filters, if given.
+        :param materialized_facets: Whether to read the available filters from
+            the facets collection, which upserts keep up to date, rather than
+            aggregating them from every recipe.
+        :param approximate_counts: Whether to estimate the total when no
+            filters are applied, from the collection's metadata.
+        :param detector_version: The version of the allergen detector, so
+            recipes are only unchanged if it detected their allergens.
+        """
         self.db = db
+        self.facet_cache = facet_cache
+        self.materialized_facets = materialized_facets
+        self.approximate_counts = approximate_counts
+        self.detector_version = detector_version
 
-    async def find_all(
-        self, filters: RecipeFilters, page: int, limit: int
-    ) -> PagedResults:
+    async def create_indexes(self) -> list[str]:
+        """
+        Create the indexes the recipe queries need, if they don't exist.
+
+        :return: The names of the indexes.
+        """
+        return await self.db["recipes"].create_indexes(self.INDEXES)
+
+    @staticmethod
+    def _matchers(filters: RecipeFilters) -> dict:
+        """Build the query matching the recipes selected by the filters."""
         matchers = {}
         if filters.allergen:
-            matchers["allergens"] = {"$nin": filters.allergen}
+            # Exclude the allergens with a single test of the recipe's bitmask
+            mask = AllergenGroup.to_mask(filters.allergen)
+            matchers["allergen_mask"] = {"$bitsAllClear": mask}
         if filters.site_name:
             matchers["site_name"] = {"$in": filters.site_name}
         if filters.cuisine:
@@ -39,43 +210,477 @@ class RecipeService:
             matchers["diet"] = {"$in": filters.diet}
         if filters.cook_time:
             matchers["cook_time"] = {"$in": filters.cook_time}
+        return matchers
+
+    async def find_all(
+        self, filters: RecipeFilters, page: int, limit: int
+    ) -> PagedResults:
+        """
+        Find a page of recipes by page number.
+
+        Deep pages are slow, as the database has to skip every recipe before
+        them, so prefer ``find_page`` which pages with cursors.
+        """
+        matchers = self._matchers(filters)
 
         # Get the total count of matching documents
-        total_count = await self.db["recipes"].count_documents(matchers)
+        total_count = await self._count(matchers)
 
         # Initialize pagination variables
         limit = limit or 10
         next_page = page + 1 if page * limit < total_count else None
         prev_page = page - 1 if page > 1 else None
 
-        # Get the paged recipes and also the total number of results before pagination
+        # Get the paged recipes
         recipes = (
             await self.db["recipes"]
-            .aggregate(
-                [
-                    {"$match": matchers},
-                    {"$skip": (page - 1) * limit},
-                    {"$limit": limit},
-                    {"$sort": {"_id": -1}},
-                ]
-            )
+            .aggregate(self._skip_pipeline(matchers, page, limit))
             .to_list(length=limit)
         )
 
         return PagedResults(recipes, total_count, page, next_page, prev_page)
 
+    @staticmethod
+    def _skip_pipeline(matchers: dict, page: int, limit: int) -> list:
+        """Build the pipeline finding a page of recipes by page number."""
+        # Sort before paging so the order is stable
+        return [
+            {"$match": matchers},
+            {"$sort": {"_id": -1}},
+            {"$skip": (page - 1) * limit},
+            {"$limit": limit},
+        ]
+
+    async def _count(self, matchers: dict) -> int:
+        """Count the recipes matching the query."""
+        if not matchers and self.approximate_counts:
+            # Read the count from the collection's metadata, without a scan
+            return await self.db["recipes"].estimated_document_count()
+        return await self.db["recipes"].count_documents(matchers)
+
+    @staticmethod
+    def _seek(cursor: Optional[str]) -> tuple[Optional[str], dict, int]:
+        """
+        Get where a page of recipes starts from its cursor.
+
+        :return: The cursor's direction, the query seeking to the cursor, and
+            the order to sort the recipes by ID in.
+        """
+        # A malformed or stale cursor starts from the first page
+        decoded = decode_cursor(cursor) if cursor else None
+        if decoded is None:
+            return None, {}, -1
+        direction, recipe_id = decoded
+        if direction == "before":
+            # Walk backwards from the cursor, then restore the page order
+            return direction, {"_id": {"$gt": recipe_id}}, 1
+        return direction, {"_id": {"$lt": recipe_id}}, -1
+
+    @classmethod
+    def _page_pipeline(
+        cls, matchers: dict, cursor: Optional[str], limit: int
+    ) -> tuple[Optional[str], list]:
+        """
+        Build the pipeline finding a page of recipes by cursor.
+
+        :return: The cursor's direction, and the pipeline, which finds one
+            recipe more than needed, to tell if there's another page.
+        """
+        direction, seek, sort = cls._seek(cursor)
+        pipeline = [
+            {"$match": {**matchers, **seek}},
+            {"$sort": {"_id": sort}},
+            {"$limit": limit + 1},
+        ]
+        return direction, pipeline
+
+    @staticmethod
+    def _cursor_page(
+        recipes: list, total: int, direction: Optional[str], limit: int
+    ) -> PagedResults:
+        """Build the page from one recipe more than it holds, sorted by ``_seek``."""
+        has_more = len(recipes) > limit
+        recipes = recipes[:limit]
+        if direction == "before":
+            recipes.reverse()
+
+        next_cursor = None
+        prev_cursor = None
+        if recipes:
+            if direction == "before" or has_more:
+                next_cursor = encode_cursor("after", recipes[-1]["_id"])
+            if direction == "after" or (direction == "before" and has_more):
+                prev_cursor = encode_cursor("before", recipes[0]["_id"])
+
+        return PagedResults(recipes, total, None, None, None, next_cursor, prev_cursor)
+
+    async def find_page(
+        self, filters: RecipeFilters, limit: int, cursor: Optional[str] = None
+    ) -> PagedResults:
+        """
+        Find a page of recipes by cursor, in descending order of ID.
+
+        Each page is found by seeking to the ID in the cursor, so finding a
+        deep page costs the same as finding the first one.
+
+        :param filters: The filters selecting the recipes.
+        :param limit: The number of recipes per page.
+        :param cursor: A cursor from a previous page, or None for the first page.
+        :return: The page of recipes, with cursors to the pages either side.
+        """
+        matchers = self._matchers(filters)
+        limit = limit or 10
+
+        # Get the total count of matching documents
+        total_count = await self._count(matchers)
+
+        direction, pipeline = self._page_pipeline(matchers, cursor, limit)
+        recipes = await self.db["recipes"].aggregate(pipeline).to_list(length=limit + 1)
+
+        return self._cursor_page(recipes, total_count, direction, limit)
+
+    async def find_page_with_facets(
+        self, filters: RecipeFilters, limit: int, cursor: Optional[str] = None
+    ) -> PagedResults:
+        """
+        Find a page of recipes by cursor, like ``find_page``, along with the
+        total and the count of each filter value.
+
+        The page seeks to the cursor with the index, while the total and the
+        counts are found in a single query beside it. Without filters, they're
+        read from the facet cache or the facets collection where they can be,
+        rather than counted from every recipe.
+
+        :param filters: The filters selecting the recipes.
+        :param limit: The number of recipes per page.
+        :param cursor: A cursor from a previous page, or None for the first page.
+        :return: The page of recipes, with the count of each filter value among
+            the matching recipes in ``facets``.
+        """
+        matchers = self._matchers(filters)
+        limit = limit or 10
+
+        direction, pipeline = self._page_pipeline(matchers, cursor, limit)
+        unfiltered = None if matchers else await self._unfiltered_facet_counts()
+        if unfiltered is not None:
+            counts, total_count = unfiltered
+            recipes = (
+                await self.db["recipes"].aggregate(pipeline).to_list(length=limit + 1)
+            )
+            page = self._cursor_page(recipes, total_count, direction, limit)
+            page.facets = counts
+            return page
+
+        # Without filters, the total can be read from the collection's metadata
+        estimate = not matchers and self.approximate_counts
+        recipes, result = await asyncio.gather(
+            self.db["recipes"].aggregate(pipeline).to_list(length=limit + 1),
+            self.db["recipes"]
+            .aggregate(self._facet_pipeline(matchers, total=not estimate))
+            .to_list(length=1),
+        )
+        result = result[0]
+
+        if estimate:
+            total_count = await self.db["recipes"].estimated_document_count()
+        else:
+            total_count = result["total"][0]["count"] if result["total"] else 0
+        counts = {
+            key: {
+                group["_id"]: group["count"]
+                for group in result[key]
+                if group["_id"] is not None
+            }
+            for key in FACET_FIELDS
+        }
+        # Without filters, the counts cover every available filter
+        if not matchers and self.facet_cache:
+            self.facet_cache.put(
+                {key: list(values) for key, values in counts.items()},
+                counts,
+                total_count,
+            )
+
+        page = self._cursor_page(recipes, total_count, direction, limit)
+        page.facets = counts
+        return page
+
+    @staticmethod
+    def _facet_pipeline(matchers: dict, total: bool = True) -> list:
+        """
+        Build the pipeline counting each filter value among the matching
+        recipes, and the total, unless it's estimated.
+        """
+        facets = {
+            key: [
+                {"$unwind": f"${field}"},
+                {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+            ]
+            for key, field in FACET_FIELDS.items()
+        }
+        if total:
+            facets["total"] = [{"$count": "count"}]
+        return [{"$match": matchers}, {"$facet": facets}]
+
+    async def _unfiltered_facet_counts(
+        self,
+    ) -> Optional[tuple[dict[str, dict[str, int]], int]]:
+        """
+        Get the count of each filter value, and the total, among every recipe,
+        from the facet cache or the facets collection, or None if neither has
+        them.
+        """
+        if self.facet_cache:
+            counts = self.facet_cache.get_counts()
+            total = self.facet_cache.get_total()
+            if counts is not None and total is not None:
+                return counts, total
+        if not self.materialized_facets:
+            return None
+
+        read = await self._read_facet_counts()
+        if read is not None and self.facet_cache:
+            counts, total = read
+            self.facet_cache.put(
+                {key: list(values) for key, values in counts.items()}, counts, total
+            )
+        return read
+
     async def upsert(self, recipe: Recipe) -> Recipe:
         """Upsert a recipe into the database."""
-        await self.db["recipes"].update_one(
-            {"_id": recipe.id},
-            {"$set": recipe.model_dump(by_alias=True, exclude=set("id"))},
+        document = self._document(recipe)
+
+        if self.materialized_facets:
+            previous = await self._upsert_returning_previous(recipe.id, document)
+            await self._update_facets([(previous, document)])
+        else:
+            await self.db["recipes"].update_one(
+                {"_id": recipe.id},
+                {"$set": document},
+                upsert=True,
+            )
+
+        if self.facet_cache:
+            self.facet_cache.add(self._facet_values(document))
+
+        return recipe
+
+    async def upsert_many(self, recipes: list[Recipe]) -> dict[int, str]:
+        """
+        Upsert many recipes into the database, in a single unordered bulk write.
+
+        With materialized facets, each recipe is upserted by its own write
+        instead, all at once, so each returns the recipe it replaced.
+
+        :param recipes: The recipes. Where several have the same ID, the last
+            one is saved, as it would be by upserting them one by one.
+        :return: The error of each recipe which couldn't be saved, by position.
+        """
+        # Keep the position of the last recipe with each ID
+        positions = list({recipe.id: i for i, recipe in enumerate(recipes)}.values())
+        documents = [self._document(recipes[i]) for i in positions]
+
+        errors = {}
+        saved = []
+        if self.materialized_facets:
+            results = await asyncio.gather(
+                *(
+                    self._upsert_returning_previous(recipes[i].id, document)
+                    for i, document in zip(positions, documents)
+                ),
+                return_exceptions=True,
+            )
+            for i, document, result in zip(positions, documents, results):
+                if isinstance(result, PyMongoError):
+                    errors[i] = str(result)
+                elif isinstance(result, BaseException):
+                    raise result
+                else:
+                    saved.append((result, document))
+            await self._update_facets(saved)
+        elif documents:
+            try:
+                await self.db["recipes"].bulk_write(
+                    [
+                        UpdateOne(
+                            {"_id": recipes[i].id}, {"$set": document}, upsert=True
+                        )
+                        for i, document in zip(positions, documents)
+                    ],
+                    ordered=False,
+                )
+            except BulkWriteError as e:
+                for error in e.details["writeErrors"]:
+                    errors[positions[error["index"]]] = error["errmsg"]
+
+            saved = [
+                (None, document)
+                for i, document in zip(positions, documents)
+                if i not in errors
+            ]
+
+        if self.facet_cache:
+            for _, document in saved:
+                self.facet_cache.add(self._facet_values(document))
+
+        return errors
+
+    async def _upsert_returning_previous(
+        self, recipe_id: str, document: dict
+    ) -> Optional[dict]:
+        """
+        Upsert a recipe, getting it as it was within the same write, so its
+        counts are moved from the values it really had, however many upserts
+        of it run at once.
+
+        :return: The facet fields of the recipe as it was, or None if it's new.
+        """
+        return await self.db["recipes"].find_one_and_update(
+            {"_id": recipe_id},
+            {"$set": document},
+            projection={field: True for field in FACET_FIELDS.values()},
             upsert=True,
+            return_document=ReturnDocument.BEFORE,
         )
 
-        return recipe
+    async def find_unchanged(self, recipes: list[Recipe]) -> dict[str, list[str]]:
+        """
+        Find the recipes already saved with the same content, whose allergens
+        were detected by the same version of the detector.
+
+        :param recipes: The recipes, as scraped.
+        :return: The saved allergens of each unchanged recipe, by ID.
+        """
+        hashes = {recipe.id: self.content_hash(recipe) for recipe in recipes}
+        unchanged = {}
+        async for saved in self.db["recipes"].find(
+            {"_id": {"$in": list(hashes)}},
+            projection={"content_hash": True, "allergens": True},
+        ):
+            if saved.get("content_hash") == hashes[saved["_id"]]:
+                unchanged[saved["_id"]] = saved["allergens"]
+        return unchanged
+
+    def content_hash(self, recipe: Recipe) -> str:
+        """Get the hash of a recipe's content and the detector's version."""
+        return recipe.content_hash(self.detector_version)
+
+    def _document(self, recipe: Recipe) -> dict:
+        """Get the fields saved for a recipe."""
+        document = recipe.model_dump(by_alias=True, exclude=set("id"))
+        document["allergen_mask"] = AllergenGroup.to_mask(recipe.allergens)
+        document["content_hash"] = self.content_hash(recipe)
+        return document
+
+    @staticmethod
+    def _facet_values(document: Optional[dict]) -> dict[str, set]:
+        """Get the values a recipe adds to each of the available filters."""
+        values = {}
+        for key, field in FACET_FIELDS.items():
+            value = (document or {}).get(field)
+            if value is None:
+                value = []
+            elif isinstance(value, str):
+                value = [value]
+            values[key] = {v for v in value if v is not None}
+        return values
+
+    async def _update_facets(self, changes: list[tuple[Optional[dict], dict]]):
+        """
+        Move the counts in the facets collection from recipes as they were to
+        their new values.
+
+        :param changes: Each recipe as it was, or None if it's new, and as it is.
+        """
+        increments = collections.Counter()
+        for previous, document in changes:
+            old_values = self._facet_values(previous)
+            new_values = self._facet_values(document)
+            for key in FACET_FIELDS:
+                for value in new_values[key] - old_values[key]:
+                    increments[key, value] += 1
+                for value in old_values[key] - new_values[key]:
+                    increments[key, value] -= 1
+
+        updates = [
+            self._facet_update(key, value, increment)
+            for (key, value), increment in increments.items()
+            if increment
+        ]
+        added = sum(previous is None for previous, _ in changes)
+        if updates or added:
+            updates.append(
+                UpdateOne(
+                    {"_id": "_meta"},
+                    {
+                        "$set": {"updated_at": datetime.datetime.now(datetime.UTC)},
+                        "$inc": {"total": added},
+                    },
+                    upsert=True,
+                )
+            )
+            await self.db["facets"].bulk_write(updates, ordered=False)
+
+    @staticmethod
+    def _facet_update(key: str, value: str, increment: int) -> UpdateOne:
+        return UpdateOne(
+            {"_id": f"{key}:{value}"},
+            {
+                "$inc": {"count": increment},
+                "$setOnInsert": {"key": key, "value": value},
+            },
+            upsert=True,
+        )
 
     async def find_available_filters(self) -> dict:
         """Get the available filters for the recipes."""
+        if self.facet_cache:
+            filters = self.facet_cache.get()
+            if filters is not None:
+                return filters
+
+        filters = None
+        if self.materialized_facets:
+            filters = await self._read_facets()
+            if filters is None:
+                logging.warning("The facets collection hasn't been built, rebuild it")
+        if filters is None:
+            filters = await self._aggregate_facets()
+
+        if self.facet_cache:
+            self.facet_cache.put(filters)
+
+        return filters
+
+    async def _read_facets(self) -> Optional[dict]:
+        """Read the available filters from the facets collection."""
+        read = await self._read_facet_counts()
+        if read is None:
+            return None
+        counts, _ = read
+        return {key: list(values) for key, values in counts.items()}
+
+    async def _read_facet_counts(
+        self,
+    ) -> Optional[tuple[dict[str, dict[str, int]], int]]:
+        """
+        Read the count of each filter value, and the total, from the facets
+        collection, or None if it hasn't been built.
+        """
+        counts = {key: {} for key in FACET_FIELDS}
+        total = None
+        async for facet in self.db["facets"].find():
+            if facet["_id"] == "_meta":
+                # Upserts keep the counts up to date, but only once rebuilt
+                if "rebuilt_at" in facet:
+                    total = facet.get("total")
+            elif facet["count"] > 0:
+                counts[facet["key"]][facet["value"]] = facet["count"]
+
+        return (counts, total) if total is not None else None
+
+    async def _aggregate_facets(self) -> dict:
+        """Aggregate the available filters from every recipe."""
         pipeline = [
             # Unwind the arrays with preservation of null and empty arrays
             {"$unwind": {"path": "$cuisine", "preserveNullAndEmptyArrays": True}},
@@ -94,4 +699,168 @@ class RecipeService:
 
         result = await self.db["recipes"].aggregate(pipeline).to_list(length=1)
 
-        return result[0]
+        return result[0] if result else {key: [] for key in FACET_FIELDS}
+
+    async def rebuild_facets(self) -> dict[str, int]:
+        """
+        Rebuild the facets collection from every recipe.
+
+        The new collection is built to the side, then replaces the old one in
+        a single step. Recipes upserted while it's being built may be missed
+        or counted twice, so the server rebuilds it every
+        ``FACET_REBUILD_INTERVAL`` seconds, which corrects them.
+
+        :return: The number of values of each of the available filters.
+        """
+        result = (
+            await self.db["recipes"]
+            .aggregate(self._facet_pipeline({}))
+            .to_list(length=1)
+        )
+        counts = result[0] if result else {key: [] for key in FACET_FIELDS}
+        total = counts.pop("total", None)
+        total = total[0]["count"] if total else 0
+
+        facets = [
+            {
+                "_id": f"{key}:{group['_id']}",
+                "key": key,
+                "value": group["_id"],
+                "count": group["count"],
+            }
+            for key, groups in counts.items()
+            for group in groups
+            if group["_id"] is not None
+        ]
+        now = datetime.datetime.now(datetime.UTC)
+        facets.append(
+            {"_id": "_meta", "rebuilt_at": now, "updated_at": now, "total": total}
+        )
+
+        await self.db["facets_rebuild"].drop()
+        await self.db["facets_rebuild"].insert_many(facets)
+        await self.db["facets_rebuild"].rename("facets", dropTarget=True)
+
+        if self.facet_cache:
+            self.facet_cache.invalidate()
+
+        return {key: len(groups) for key, groups in counts.items()}
+
+    async def facet_stats(self) -> dict:
+        """Get how stale the available filters may be."""
+        stats = {
+            "source": "materialized" if self.materialized_facets else "aggregate",
+        }
+        if self.facet_cache:
+            stats["cache_ttl"] = self.facet_cache.ttl
+            stats["cache_age"] = self.facet_cache.age
+        if self.materialized_facets:
+            meta = await self.db["facets"].find_one({"_id": "_meta"}) or {}
+            for field in ["rebuilt_at", "updated_at"]:
+                stats[field] = meta[field].isoformat() if field in meta else None
+        return stats
+
+
+class WriteBufferFull(Exception):
+    """Raised when the write buffer holds as many recipes as it may."""
+
+
+class WriteBehindBuffer:
+    """
+    Buffer recipe upserts in memory, and save them in bulk writes.
+
+    Recipes are collected until ``max_items`` are buffered or the first of
+    them has waited ``max_wait_ms``, then saved with a single ``upsert_many``.
+    A recipe upserted again while buffered replaces the buffered version, so
+    only its latest version is written. Recipes which fail to save are logged
+    and dropped, as the next crawl will send them again.
+    """
+
+    def __init__(
+        self,
+        recipe_service: RecipeService,
+        max_items: int = 100,
+        max_wait_ms: float = 1000,
+        max_buffered: int = 10000,
+    ):
+        self.recipe_service = recipe_service
+        self.max_items = max_items
+        self.max_wait_ms = max_wait_ms
+        self.max_buffered = max_buffered
+        self.saved = 0
+        self.replaced = 0
+        self.failed = 0
+        self._buffer: dict[str, Recipe] = {}
+        # The recipes of the writes started but not finished
+        self._writing = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._writes: set[asyncio.Task] = set()
+        # Writes run one at a time, so an older version never lands last
+        self._lock = asyncio.Lock()
+
+    async def upsert(self, recipe: Recipe) -> Recipe:
+        """Buffer a recipe to be upserted with the next write."""
+        if recipe.id in self._buffer:
+            self.replaced += 1
+            del self._buffer[recipe.id]
+        elif len(self._buffer) + self._writing >= self.max_buffered:
+            # Writes waiting on a slow database count too, so they can't pile up
+            raise WriteBufferFull(
+                f"{len(self._buffer) + self._writing} recipes already buffered"
+            )
+        self._buffer[recipe.id] = recipe
+
+        if len(self._buffer) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.max_wait_ms / 1000, self._flush)
+
+        return recipe
+
+    async def drain(self):
+        """Save every buffered recipe and wait for all writes to finish."""
+        self._flush()
+        if self._writes:
+            await asyncio.wait(self._writes)
+
+    def stats(self) -> dict:
+        """Count the recipes buffered, being written, saved, replaced and failed."""
+        return {
+            "buffered": len(self._buffer),
+            "writing": self._writing,
+            "saved": self.saved,
+            "replaced": self.replaced,
+            "failed": self.failed,
+        }
+
+    def _flush(self):
+        """Start saving the buffered recipes."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        recipes = list(self._buffer.values())
+        self._buffer = {}
+        if recipes:
+            self._writing += len(recipes)
+            task = asyncio.create_task(self._write(recipes))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, recipes: list[Recipe]):
+        """Save a batch of recipes, after the batches before it."""
+        try:
+            async with self._lock:
+                errors = await self.recipe_service.upsert_many(recipes)
+        except Exception:
+            logging.exception("Failed to save %d recipes", len(recipes))
+            self.failed += len(recipes)
+            return
+        finally:
+            self._writing -= len(recipes)
+
+        for i, error in errors.items():
+            logging.error("Failed to save recipe %s: %s", recipes[i].id, error)
+        self.failed += len(errors)
+        self.saved += len(recipes) - len(errors)
@@ -1,16 +1,169 @@
-import gzip
+import collections
+import functools
+import html
+import os
+import random
+import tempfile
+import threading
 import time
-from typing import Optional
+import zlib
+from email.utils import parsedate_to_datetime
+from re import Pattern
+from html.entities import html5
+from html.parser import HTMLParser
+from hashlib import sha256
+from typing import BinaryIO, Callable, Iterator, Mapping, Optional
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+from urllib.robotparser import RobotFileParser
+from xml.etree.ElementTree import ParseError, XMLPullParser
 
-import inflect
 import isodate
 import requests
-from bs4 import BeautifulSoup
 
-# Initialize the inflector as a singleton. We do this because
-# initializing the inflector is a relatively expensive operation.
-_INFLECTOR = inflect.engine()
+
+@functools.cache
+def _inflector():
+    """
+    Get the inflector as a singleton.
+
+    We do this because importing and initializing the inflector is a
+    relatively expensive operation, which the server never needs.
+    """
+    import inflect
+
+    return inflect.engine()
+
+
+# The text of these tags isn't part of a page's text, as BeautifulSoup sees it
+_HIDDEN_TEXT_TAGS = frozenset({"script", "style", "template", "rt", "rp"})
+
+# The whitespace of these tags is kept as it is
+_PREFORMATTED_TAGS = frozenset({"pre", "textarea"})
+
+# These tags are never left open, so they don't contain anything
+_VOID_TAGS = frozenset(
+    {
+        "area",
+        "base",
+        "basefont",
+        "bgsound",
+        "br",
+        "col",
+        "command",
+        "embed",
+        "frame",
+        "hr",
+        "image",
+        "img",
+        "input",
+        "isindex",
+        "keygen",
+        "link",
+        "menuitem",
+        "meta",
+        "nextid",
+        "param",
+        "source",
+        "spacer",
+        "track",
+        "wbr",
+    }
+)
+
+# Named character references, without their semicolons, as html.parser reports them
+_ENTITIES = {name.rstrip(";"): character for name, character in html5.items()}
+
+_ASCII_SPACES = str.maketrans("", "", " \t\n\f\r")
+
+
+class _TextExtractor(HTMLParser):
+    """
+    Collect the text of HTML, as BeautifulSoup's ``get_text`` would, but
+    without building a tree.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.text = []
+        self.open_tags = []
+        self._data = []
+
+    def close(self):
+        super().close()
+        self._end_data()
+
+    def handle_starttag(self, tag, attrs):
+        self._end_data()
+        if tag not in _VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._end_data()
+
+    def handle_endtag(self, tag):
+        self._end_data()
+        if tag in self.open_tags:
+            # Close any tags left open inside it too
+            last = len(self.open_tags) - self.open_tags[::-1].index(tag) - 1
+            del self.open_tags[last:]
+
+    def handle_data(self, data):
+        self._data.append(data)
+
+    def handle_entityref(self, name):
+        self._data.append(_ENTITIES.get(name, f"&{name}"))
+
+    def handle_charref(self, name):
+        self._data.append(_character_reference(name))
+
+    def handle_comment(self, data):
+        self._end_data()
+
+    def handle_decl(self, decl):
+        self._end_data()
+
+    def handle_pi(self, data):
+        self._end_data()
+
+    def unknown_decl(self, data):
+        self._end_data()
+        if data.startswith("CDATA["):
+            # CDATA is text, even inside the tags that hide their text
+            self._data.append(data[len("CDATA[") :])
+            self._end_data(hidden=False)
+
+    def _end_data(self, hidden: Optional[bool] = None):
+        """End a run of text, as it would be a single string in a tree."""
+        if not self._data:
+            return
+        data = "".join(self._data)
+        self._data = []
+        preformatted = any(tag in _PREFORMATTED_TAGS for tag in self.open_tags)
+        if not preformatted and not data.translate(_ASCII_SPACES):
+            # Whitespace between tags is collapsed
+            data = "\n" if "\n" in data else " "
+        if hidden is None:
+            hidden = any(tag in _HIDDEN_TEXT_TAGS for tag in self.open_tags)
+        if not hidden:
+            self.text.append(data)
+
+
+def _character_reference(name: str) -> str:
+    """
+    Get the character of a numeric character reference, as BeautifulSoup does.
+
+    :param name: The number of the reference, in hex if it starts with "x".
+    """
+    number = int(name[1:], 16) if name[0] in "xX" else int(name)
+    if number == 0 or number > 0x10FFFF or 0xD800 <= number <= 0xDFFF:
+        return "\ufffd"
+    if 0x80 <= number <= 0x9F:
+        # Assume the reference was to a windows-1252 character
+        try:
+            return bytes([number]).decode("cp1252")
+        except UnicodeDecodeError:
+            pass
+    return chr(number)
 
 
 def strip_html(html_content: str) -> str:
@@ -23,10 +176,18 @@ def strip_html(html_content: str) -> str:
     :param html_content: The HTML content from which to strip the tags.
     :return: The stripped text without the HTML tags.
     """
-    from bs4 import BeautifulSoup
+    # Most text has no markup at all, though whitespace alone is collapsed
+    if (
+        "<" not in html_content
+        and "&" not in html_content
+        and html_content.translate(_ASCII_SPACES)
+    ):
+        return html_content
 
-    soup = BeautifulSoup(html_content, "html.parser")
-    return soup.get_text()
+    parser = _TextExtractor()
+    parser.feed(html_content)
+    parser.close()
+    return "".join(parser.text)
 
 
 def toggle_plural(word: str) -> str:
@@ -39,14 +200,15 @@ def toggle_plural(word: str) -> str:
     :param word: The word to toggle the plural form of.
     :return: The toggled plural form of the word.
     """
-    if word == _INFLECTOR.plural(word):
-        singular = _INFLECTOR.singular_noun(word)
+    inflector = _inflector()
+    if word == inflector.plural(word):
+        singular = inflector.singular_noun(word)
         if word == singular:
             return word
         else:
             return f"{singular}"
     else:
-        return _INFLECTOR.plural(word)
+        return inflector.plural(word)
 
 
 def remove_accents(input_str: str) -> str:
@@ -101,28 +263,788 @@ def iso_duration_to_text(duration: str | None) -> str:
     return "Under 10 minutes"
 
 
+class RobotsCache:
+    """
+    Cache the parsed robots.txt of each host for a while.
+
+    A robots.txt which couldn't be fetched is cached for ``error_ttl``
+    instead, so a host which is briefly down isn't skipped for long.
+    """
+
+    def __init__(self, ttl: float = 3600, error_ttl: float = 60):
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict[str, tuple[RobotFileParser, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, robots_url: str) -> Optional[RobotFileParser]:
+        """Get a parsed robots.txt, or None if it isn't cached or has expired."""
+        with self._lock:
+            entry = self._entries.get(robots_url)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(
+        self, robots_url: str, status: Optional[int], content: Optional[str]
+    ) -> RobotFileParser:
+        """
+        Parse and cache a robots.txt, as ``RobotFileParser.read`` would.
+
+        :param robots_url: The URL of the robots.txt.
+        :param status: The HTTP status it was fetched with, or None if the
+            request failed.
+        :param content: The robots.txt.
+        :return: The parsed robots.txt.
+        """
+        rp = RobotFileParser(robots_url)
+        ttl = self.ttl
+        if status == 200:
+            rp.parse((content or "").splitlines())
+        elif status in (401, 403):
+            rp.disallow_all = True
+        elif status is not None and 400 <= status < 500:
+            rp.allow_all = True
+        else:
+            # Nothing is allowed until the robots.txt can be read
+            rp.disallow_all = True
+            ttl = self.error_ttl
+        rp.modified()
+
+        with self._lock:
+            self._entries[robots_url] = (rp, time.monotonic() + ttl)
+        return rp
+
+    def fetch(self, user_agent: str, robots_url: str) -> RobotFileParser:
+        """Get a parsed robots.txt, fetching it if it isn't cached."""
+        rp = self.get(robots_url)
+        if rp is not None:
+            return rp
+
+        try:
+            response = requests.get(
+                robots_url, timeout=10, headers={"User-Agent": user_agent}
+            )
+            return self.put(robots_url, response.status_code, response.text)
+        except requests.RequestException:
+            return self.put(robots_url, None, None)
+
+
+def robots_url_for(url: str) -> str:
+    """Get the URL of the robots.txt which applies to a URL."""
+    parsed_url = urlparse(url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}/robots.txt"
+
+
+def robots_delay(rp: RobotFileParser, user_agent: str) -> Optional[float]:
+    """
+    Get the seconds to wait between requests from a robots.txt, from its
+    Crawl-delay or Request-rate, whichever is longer.
+    """
+    delays = []
+    crawl_delay = rp.crawl_delay(user_agent)
+    if crawl_delay:
+        delays.append(float(crawl_delay))
+    request_rate = rp.request_rate(user_agent)
+    if request_rate and request_rate.requests:
+        delays.append(request_rate.seconds / request_rate.requests)
+    return max(delays) if delays else None
+
+
+# Shared by every check, so each robots.txt is only fetched once in a while
+_robots_cache = RobotsCache()
+
+
 def check_robots(user_agent: str, robots_url: str, subject_url: str) -> bool:
     """Check if the robots.txt file disallows the user agent."""
-    import urllib.robotparser
-
-    rp = urllib.robotparser.RobotFileParser()
-    rp.set_url(robots_url)
-    rp.read()
+    rp = _robots_cache.fetch(user_agent, robots_url)
     return rp.can_fetch(user_agent, subject_url)
 
 
-def scrape_html(user_agent: str, url: str) -> str:
-    """Scrape the HTML content of a URL."""
-    import requests
+def crawl_delay(user_agent: str, robots_url: str) -> float:
+    """Get the seconds the robots.txt file asks to wait between requests."""
+    rp = _robots_cache.fetch(user_agent, robots_url)
+    return robots_delay(rp, user_agent) or 0
+
+
+class CachedResponse:
+    """A successful response, as the HTTP cache stores it."""
+
+    def __init__(
+        self,
+        url: str,
+        body: bytes,
+        content_type: Optional[str] = None,
+        encoding: Optional[str] = None,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ):
+        self.url = url
+        self.body = body
+        self.content_type = content_type
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def text(self) -> str:
+        """The body, decoded as it was when it was fetched."""
+        return self.body.decode(self.encoding or "utf-8", errors="replace")
+
+
+class CachedBody:
+    """
+    A body being streamed into the HTTP cache, compressed into a temporary
+    file as it's written, so it's never held in memory whole.
+    """
+
+    def __init__(self, directory: str):
+        self._file = tempfile.NamedTemporaryFile(
+            dir=directory, suffix=".tmp", delete=False
+        )
+        self._compressor = zlib.compressobj()
+        self._digest = sha256()
+        self.path = self._file.name
+
+    def write(self, chunk: bytes):
+        """Add a chunk to the end of the body."""
+        self._digest.update(chunk)
+        self._file.write(self._compressor.compress(chunk))
+
+    def close(self) -> str:
+        """
+        Finish writing the body.
+
+        :return: The hash of the body's content.
+        """
+        if not self._file.closed:
+            self._file.write(self._compressor.flush())
+            self._file.close()
+        return self._digest.hexdigest()
+
+    def discard(self):
+        """Delete the body, unless it has been cached."""
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class HttpCache:
+    """
+    Cache responses on disk, so pages which haven't changed since they were
+    last fetched are read from disk instead of downloaded again.
+
+    The bodies are compressed, and stored by the hash of their content, so
+    pages with the same content share a file. The URLs, and the ETag and
+    Last-Modified of their responses, are kept in a SQLite index. Once the
+    bodies take more than ``max_bytes``, those least recently used are
+    evicted.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        # Only the scrapers cache responses, so the server doesn't import this
+        import sqlite3
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.join(path, "bodies"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(path, "index.sqlite"), check_same_thread=False
+        )
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                content_type TEXT,
+                encoding TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+            CREATE INDEX IF NOT EXISTS responses_digest ON responses (digest);
+            CREATE TABLE IF NOT EXISTS bodies (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL
+            );
+            """)
+        (self.size,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM bodies"
+        ).fetchone()
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        """Get the cached response for a URL, or None if it isn't cached."""
+        opened = self._open(url)
+        if opened is None:
+            return None
+        file, content_type, encoding, etag, last_modified = opened
+        with file:
+            compressed = file.read()
+
+        return CachedResponse(
+            url,
+            zlib.decompress(compressed),
+            content_type,
+            encoding,
+            etag,
+            last_modified,
+        )
+
+    def stream(
+        self, url: str, chunk_size: int = 64 * 1024
+    ) -> Optional[Iterator[bytes]]:
+        """
+        Stream the cached body of a URL in chunks, decompressing it as it's
+        read, so it's never held in memory whole.
+
+        :param url: The URL which was fetched.
+        :param chunk_size: The bytes of the stored body read at a time.
+        :return: The chunks of the body, or None if it isn't cached.
+        """
+        opened = self._open(url)
+        if opened is None:
+            return None
+        return _decompressed(opened[0], chunk_size)
+
+    def validators(self, url: str) -> dict[str, str]:
+        """
+        Get the headers which ask the server for the page only if it has
+        changed since it was cached.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT etag, last_modified FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+        headers = {}
+        if row and row[0]:
+            headers["If-None-Match"] = row[0]
+        if row and row[1]:
+            headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def put(
+        self,
+        url: str,
+        body: bytes,
+        headers: Mapping[str, str],
+        encoding: Optional[str] = None,
+    ) -> CachedResponse:
+        """
+        Cache a successful response.
+
+        :param url: The URL which was fetched.
+        :param body: The body of the response.
+        :param headers: The headers of the response.
+        :param encoding: The encoding the body was decoded with.
+        :return: The cached response.
+        """
+        digest = sha256(body).hexdigest()
+        path = self._body_path(digest)
+        response = CachedResponse(
+            url,
+            body,
+            headers.get("Content-Type"),
+            encoding,
+            headers.get("ETag"),
+            headers.get("Last-Modified"),
+        )
+
+        with self._lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write the whole body before it can be read
+                with open(f"{path}.tmp", "wb") as file:
+                    file.write(zlib.compress(body))
+                os.replace(f"{path}.tmp", path)
+            self._index(url, digest, headers, encoding)
+        return response
+
+    def body(self) -> CachedBody:
+        """Start streaming a body into the cache, to be stored by ``put_body``."""
+        return CachedBody(os.path.join(self.path, "bodies"))
+
+    def put_body(
+        self,
+        url: str,
+        body: CachedBody,
+        headers: Mapping[str, str],
+        encoding: Optional[str] = None,
+    ):
+        """
+        Cache a successful response whose body was streamed into the cache.
+
+        :param url: The URL which was fetched.
+        :param body: The body of the response, written to the end.
+        :param headers: The headers of the response.
+        :param encoding: The encoding the body was decoded with.
+        """
+        digest = body.close()
+        path = self._body_path(digest)
+        with self._lock:
+            if os.path.exists(path):
+                body.discard()
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(body.path, path)
+            self._index(url, digest, headers, encoding)
+
+    def revalidated(
+        self, url: str, headers: Mapping[str, str]
+    ) -> Optional[CachedResponse]:
+        """
+        Get the cached response for a URL the server says hasn't changed.
+
+        :param url: The URL which was fetched.
+        :param headers: The headers of the 304 response, which may update the
+            cached ones.
+        :return: The cached response, or None if it has been evicted since.
+        """
+        self._refresh(url, headers)
+        response = self.get(url)
+        if response is not None:
+            with self._lock:
+                self.hits += 1
+        return response
+
+    def revalidated_stream(
+        self, url: str, headers: Mapping[str, str], chunk_size: int = 64 * 1024
+    ) -> Optional[Iterator[bytes]]:
+        """
+        Stream the cached body of a URL the server says hasn't changed, as
+        ``stream`` does.
+
+        :param url: The URL which was fetched.
+        :param headers: The headers of the 304 response, which may update the
+            cached ones.
+        :param chunk_size: The bytes of the stored body read at a time.
+        :return: The chunks of the body, or None if it has been evicted since.
+        """
+        self._refresh(url, headers)
+        chunks = self.stream(url, chunk_size)
+        if chunks is not None:
+            with self._lock:
+                self.hits += 1
+        return chunks
+
+    def close(self):
+        self._db.close()
+
+    def _refresh(self, url: str, headers: Mapping[str, str]):
+        """Update the validators of a response from the headers of a 304."""
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if etag or last_modified:
+            with self._lock:
+                self._db.execute(
+                    "UPDATE responses SET etag = COALESCE(?, etag), "
+                    "last_modified = COALESCE(?, last_modified) WHERE url = ?",
+                    (etag, last_modified, url),
+                )
+                self._db.commit()
+
+    def _open(self, url: str) -> Optional[tuple[BinaryIO, str, str, str, str]]:
+        """
+        Open the compressed body of a URL's cached response, marking it used.
+
+        :return: The open body, and the content type, encoding, ETag and
+            Last-Modified of the response, or None if it isn't cached.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest, content_type, encoding, etag, last_modified "
+                "FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            digest, *fields = row
+            try:
+                file = open(self._body_path(digest), "rb")
+            except FileNotFoundError:
+                # The body was removed behind our back, so forget the response
+                self._db.execute("DELETE FROM responses WHERE url = ?", (url,))
+                self._drop_body(digest)
+                self._db.commit()
+                return None
+            self._db.execute(
+                "UPDATE responses SET used_at = ? WHERE url = ?", (time.time(), url)
+            )
+            self._db.commit()
+        return file, *fields
+
+    def _index(
+        self,
+        url: str,
+        digest: str,
+        headers: Mapping[str, str],
+        encoding: Optional[str],
+    ):
+        """Point a URL at its stored body, evicting others if the cache is full."""
+        path = self._body_path(digest)
+        self.misses += 1
+        stored = self._db.execute(
+            "INSERT OR IGNORE INTO bodies (digest, size) VALUES (?, ?)",
+            (digest, os.path.getsize(path)),
+        )
+        if stored.rowcount:
+            self.size += os.path.getsize(path)
+
+        previous = self._db.execute(
+            "SELECT digest FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                url,
+                digest,
+                headers.get("Content-Type"),
+                encoding,
+                headers.get("ETag"),
+                headers.get("Last-Modified"),
+                time.time(),
+            ),
+        )
+        if previous and previous[0] != digest:
+            self._drop_body(previous[0])
+        if self.size > self.max_bytes:
+            self._evict()
+        self._db.commit()
+
+    def _body_path(self, digest: str) -> str:
+        return os.path.join(self.path, "bodies", digest[:2], digest)
+
+    def _drop_body(self, digest: str):
+        """Delete a body, unless another response still has it."""
+        in_use = self._db.execute(
+            "SELECT 1 FROM responses WHERE digest = ? LIMIT 1", (digest,)
+        ).fetchone()
+        if in_use:
+            return
+        row = self._db.execute(
+            "SELECT size FROM bodies WHERE digest = ?", (digest,)
+        ).fetchone()
+        self._db.execute("DELETE FROM bodies WHERE digest = ?", (digest,))
+        if row:
+            self.size -= row[0]
+        try:
+            os.remove(self._body_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        """Evict the least recently used responses, until the bodies fit."""
+        rows = self._db.execute(
+            "SELECT url, digest FROM responses ORDER BY used_at"
+        ).fetchall()
+        for url, digest in rows:
+            if self.size <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE url = ?", (url,))
+            self._drop_body(digest)
+
+
+def _decompressed(file: BinaryIO, chunk_size: int) -> Iterator[bytes]:
+    """Read a compressed body in chunks, decompressing each as it's read."""
+    with file:
+        decompressor = zlib.decompressobj()
+        while compressed := file.read(chunk_size):
+            if chunk := decompressor.decompress(compressed):
+                yield chunk
+        if chunk := decompressor.flush():
+            yield chunk
+
+
+class FetchError(Exception):
+    """Raised when a page can't be fetched."""
+
+    def __init__(
+        self,
+        url: str,
+        status: Optional[int] = None,
+        retry_after: Optional[str] = None,
+    ):
+        super().__init__(f"Failed to fetch {url} (status {status})")
+        self.url = url
+        self.status = status
+        # The Retry-After header of the response, if it had one
+        self.retry_after = retry_after
+
+
+class CircuitOpen(FetchError):
+    """Raised instead of fetching from a host which keeps failing."""
+
+    def __str__(self) -> str:
+        return f"Not fetching {self.url}, as its host keeps failing"
+
+
+class _HostHealth:
+    """The failures and retry budget of a host."""
+
+    def __init__(self, retry_tokens: float):
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+        self.retry_tokens = retry_tokens
+
+
+class FetchPolicy:
+    """
+    Decide whether and how long to wait before retrying a failed request, and
+    stop sending requests to hosts which keep failing.
+
+    Retries wait a random time up to an exponentially growing delay, capped
+    at ``max_delay``, or as long as the server's Retry-After asks, if that's
+    longer. Each first attempt to a host earns ``retry_ratio`` of a retry, up
+    to ``max_retry_tokens``, so a degraded host can't turn every request into
+    ``max_retries`` more.
+
+    After ``failure_threshold`` failures in a row, a host's circuit opens,
+    and its requests fail fast with ``CircuitOpen`` for ``reset_after``
+    seconds. Then a single trial request is let through, which closes the
+    circuit if it succeeds, or opens it again if it fails.
+    """
+
+    # The statuses which may succeed if the request is made again
+    RETRY_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+    def __init__(
+        self,
+        max_retries: int = 3,
+        base_delay: float = 1,
+        max_delay: float = 60,
+        retry_ratio: float = 0.2,
+        max_retry_tokens: float = 10,
+        failure_threshold: int = 5,
+        reset_after: float = 30,
+        clock: Callable[[], float] = time.monotonic,
+        jitter: Callable[[], float] = random.random,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_ratio = retry_ratio
+        self.max_retry_tokens = max_retry_tokens
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.counts = collections.Counter()
+        self._clock = clock
+        self._jitter = jitter
+        self._hosts = collections.defaultdict(lambda: _HostHealth(max_retry_tokens))
+        self._lock = threading.Lock()
+
+    def admit(self, url: str, attempt: int = 1):
+        """
+        Check a request may be made.
+
+        :param url: The URL to request.
+        :param attempt: The attempt at the request, counting from 1.
+        :raises CircuitOpen: If the host's circuit is open.
+        """
+        with self._lock:
+            host = self._hosts[urlparse(url).netloc]
+            if host.opened_at is not None:
+                if (
+                    host.trial_in_flight
+                    or self._clock() - host.opened_at < self.reset_after
+                ):
+                    self.counts["shed"] += 1
+                    raise CircuitOpen(url)
+                host.trial_in_flight = True
+
+            self.counts["requests"] += 1
+            if attempt == 1:
+                host.retry_tokens = min(
+                    self.max_retry_tokens, host.retry_tokens + self.retry_ratio
+                )
+
+    def succeeded(self, url: str):
+        """Record that the host of a URL responded, closing its circuit."""
+        with self._lock:
+            host = self._hosts[urlparse(url).netloc]
+            host.consecutive_failures = 0
+            host.opened_at = None
+            host.trial_in_flight = False
+            self.counts["successes"] += 1
 
+    def abandoned(self, url: str):
+        """
+        Record that a request ended without an outcome, e.g. as it was
+        cancelled, so another trial may be made if it was the host's trial.
+        """
+        with self._lock:
+            self._hosts[urlparse(url).netloc].trial_in_flight = False
+
+    def failed(
+        self,
+        url: str,
+        attempt: int,
+        retry_after: Optional[str] = None,
+    ) -> Optional[float]:
+        """
+        Record that a request failed, with a timeout, a connection error or
+        one of ``RETRY_STATUSES``.
+
+        :param url: The URL which was requested.
+        :param attempt: The attempt which failed, counting from 1.
+        :param retry_after: The Retry-After header of the response, if any.
+        :return: The seconds to wait before retrying, or None to give up.
+        """
+        with self._lock:
+            host = self._hosts[urlparse(url).netloc]
+            self.counts["failures"] += 1
+            host.consecutive_failures += 1
+            host.trial_in_flight = False
+            if (
+                host.opened_at is not None
+                or host.consecutive_failures >= self.failure_threshold
+            ):
+                if host.opened_at is None:
+                    self.counts["circuits_opened"] += 1
+                host.opened_at = self._clock()
+                return None
+
+            if attempt > self.max_retries:
+                return None
+            wait = retry_after_seconds(retry_after) or 0
+            if wait > self.max_delay:
+                self.counts["retry_after_too_long"] += 1
+                return None
+            if host.retry_tokens < 1:
+                self.counts["budget_exhausted"] += 1
+                return None
+            host.retry_tokens -= 1
+            self.counts["retries"] += 1
+
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return max(wait, self._jitter() * backoff)
+
+    def stats(self) -> dict:
+        """Get the counters, and the hosts whose circuits are open."""
+        with self._lock:
+            return {
+                **self.counts,
+                "open_circuits": sorted(
+                    name
+                    for name, host in self._hosts.items()
+                    if host.opened_at is not None
+                ),
+            }
+
+
+def retry_after_seconds(retry_after: Optional[str]) -> Optional[float]:
+    """
+    Get the seconds a Retry-After header asks to wait.
+
+    :param retry_after: The header, in seconds or as an HTTP date.
+    :return: The seconds, or None if there's no header or it can't be read.
+    """
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
     try:
-        response = requests.get(url, timeout=10, headers={"User-Agent": user_agent})
-        if response.status_code != 200:
-            raise Exception(f"Failed to fetch {url}")
-        return response.text
-    except requests.ReadTimeout:
-        time.sleep(5)
-        return scrape_html(user_agent, url)
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+# Shared by every fetch, so each host's failures are counted together
+_fetch_policy = FetchPolicy()
+
+
+def http_get(
+    user_agent: str,
+    url: str,
+    cache: Optional[HttpCache] = None,
+    timeout: float = 10,
+    policy: Optional[FetchPolicy] = None,
+) -> CachedResponse:
+    """
+    Fetch a page, unless the cache has it and the server says it hasn't
+    changed, retrying as the fetch policy allows.
+
+    :param user_agent: The user agent to fetch the page as.
+    :param url: The URL of the page.
+    :param cache: The cache to revalidate and store the page in, if any.
+    :param timeout: Seconds to wait for the server.
+    :param policy: Decides when to retry, the shared policy by default.
+    :return: The response.
+    :raises FetchError: If the page can't be fetched.
+    """
+    policy = policy or _fetch_policy
+    headers = {"User-Agent": user_agent}
+    if cache is not None:
+        headers.update(cache.validators(url))
+
+    response = _get_with_retries(url, headers, timeout, policy)
+    if response.status_code == 304 and cache is not None:
+        cached = cache.revalidated(url, response.headers)
+        if cached is not None:
+            return cached
+        # The page was evicted since it was revalidated, so fetch it afresh
+        response = _get_with_retries(url, {"User-Agent": user_agent}, timeout, policy)
+    if response.status_code != 200:
+        raise FetchError(url, response.status_code)
+
+    if cache is not None:
+        return cache.put(url, response.content, response.headers, response.encoding)
+    return CachedResponse(
+        url,
+        response.content,
+        response.headers.get("Content-Type"),
+        response.encoding,
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+    )
+
+
+def _get_with_retries(
+    url: str, headers: dict[str, str], timeout: float, policy: FetchPolicy
+) -> requests.Response:
+    """
+    Make a request, retrying it as the fetch policy allows.
+
+    :raises FetchError: If the request keeps failing.
+    """
+    attempt = 1
+    while True:
+        policy.admit(url, attempt)
+        try:
+            response = requests.get(url, timeout=timeout, headers=headers)
+        except (requests.Timeout, requests.ConnectionError) as error:
+            wait = policy.failed(url, attempt)
+            if wait is None:
+                raise FetchError(url) from error
+        except BaseException:
+            policy.abandoned(url)
+            raise
+        else:
+            retry_after = response.headers.get("Retry-After")
+            if response.status_code not in FetchPolicy.RETRY_STATUSES:
+                policy.succeeded(url)
+                return response
+            wait = policy.failed(url, attempt, retry_after)
+            if wait is None:
+                raise FetchError(url, response.status_code, retry_after)
+        time.sleep(wait)
+        attempt += 1
+
+
+def scrape_html(user_agent: str, url: str, cache: Optional[HttpCache] = None) -> str:
+    """Scrape the HTML content of a URL."""
+    return http_get(user_agent, url, cache).text
 
 
 def modify_query_parameter(url, param_name, param_value):
@@ -154,30 +1076,110 @@ def modify_query_parameter(url, param_name, param_value):
     return new_url
 
 
-def crawl_sitemap(user_agent: str, url: str) -> Optional[str]:
-    """Recursively crawl a sitemap and yield URLs."""
-    with requests.Session() as session:
-        response = session.get(
-            url,
-            headers={"User-Agent": user_agent},
-            timeout=10,
-        )
+class SitemapParser:
+    """
+    Parse a sitemap incrementally, as its chunks arrive.
+
+    Gzipped sitemaps are recognised from their first bytes and decompressed
+    as they stream, and each entry is dropped from the tree once it's read,
+    so memory stays flat however large the sitemap is.
+    """
+
+    def __init__(self):
+        self._head = b""
+        self._decompressor = None
+        self._parser = XMLPullParser(events=("start", "end"))
+        self._root = None
+
+    def feed(self, chunk: bytes) -> list[tuple[str, str]]:
+        """
+        Parse the next chunk of the sitemap.
+
+        :param chunk: The next bytes of the sitemap, as downloaded.
+        :return: The entries completed by the chunk, each either ``("url", loc)``
+            for a page or ``("sitemap", loc)`` for a child sitemap.
+        """
+        if self._head is not None:
+            # Wait for enough bytes to tell if the sitemap is gzipped
+            self._head += chunk
+            if len(self._head) < 2:
+                return []
+            chunk, self._head = self._head, None
+            if chunk[:2] == b"\x1f\x8b":
+                self._decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
 
-        if response.status_code == 200:
-            xml = response.text
+        if self._decompressor is not None:
+            chunk = self._decompressor.decompress(chunk)
+        self._parser.feed(chunk)
+        return self._read_entries()
 
-            # If the sitemap is gzipped, decompress it
-            if response.headers.get("content-type") == "application/x-gzip":
-                xml = gzip.decompress(response.content)
+    def close(self) -> list[tuple[str, str]]:
+        """Parse the end of the sitemap, and get the last entries."""
+        if self._head:
+            self._parser.feed(self._head)
+        elif self._decompressor is not None:
+            self._parser.feed(self._decompressor.flush())
+        self._parser.close()
+        return self._read_entries()
 
-            # Parse the sitemap
-            soup = BeautifulSoup(xml, features="xml")
+    def _read_entries(self) -> list[tuple[str, str]]:
+        entries = []
+        for event, element in self._parser.read_events():
+            if event == "start":
+                if self._root is None:
+                    self._root = element
+                continue
+            kind = element.tag.rsplit("}", 1)[-1]
+            if kind not in ("url", "sitemap"):
+                continue
+            for child in element:
+                if child.tag.rsplit("}", 1)[-1] == "loc" and child.text:
+                    entries.append((kind, child.text.strip()))
+                    break
+            # Drop the entries read so far, which are children of the root
+            self._root.clear()
+        return entries
 
-            # Look for sitemap elements
-            for sitemap in soup.find_all("sitemap"):
-                yield from crawl_sitemap(user_agent, sitemap.find("loc").text)
 
-            # Look for urlset elements
-            for urlset in soup.find_all("urlset"):
-                for url in urlset.find_all("url"):
-                    yield url.find("loc").text
+def crawl_sitemap(
+    user_agent: str, url: str, pattern: Optional[Pattern[str]] = None
+) -> Iterator[str]:
+    """
+    Crawl a sitemap and its child sitemaps, yielding URLs as they stream in.
+
+    :param user_agent: The user agent to fetch the sitemaps with.
+    :param url: The URL of the sitemap.
+    :param pattern: Only URLs matching the pattern are yielded, if given.
+    :return: The URLs of the pages in the sitemaps.
+    """
+    sitemaps = collections.deque([url])
+    seen = {url}
+
+    with requests.Session() as session:
+        session.headers["User-Agent"] = user_agent
+        while sitemaps:
+            sitemap_url = sitemaps.popleft()
+            children = []
+            try:
+                with session.get(sitemap_url, timeout=10, stream=True) as response:
+                    if response.status_code != 200:
+                        continue
+                    parser = SitemapParser()
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        for kind, loc in parser.feed(chunk):
+                            if kind == "sitemap":
+                                children.append(loc)
+                            elif pattern is None or pattern.match(loc):
+                                yield loc
+                    for kind, loc in parser.close():
+                        if kind == "sitemap":
+                            children.append(loc)
+                        elif pattern is None or pattern.match(loc):
+                            yield loc
+            except (requests.RequestException, ParseError, zlib.error):
+                pass
+            finally:
+                # Visit the child sitemaps next, in the order they're listed
+                children = [child for child in children if child not in seen]
+                seen.update(children)
+                sitemaps.extendleft(reversed(children))
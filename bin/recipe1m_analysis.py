@@ -1,30 +1,101 @@
+import argparse
+import itertools
+import json
+import resource
+import time
+from typing import Iterator, Optional
+
+import numpy as np
 import pandas as pd
 
+from app import utils
+from app.config import HTTP_CACHE_DIR, HTTP_CACHE_MAX_MB
+from app.factories import get_http_cache
+from app.utils import HttpCache
 
-def extract_domain_from_url(url: str) -> str:
+CSV_PATH = "resources/datasets/recipe1m.csv"
+MAX_DOMAINS = 100
+LINK_SAMPLE_SIZE = 5
+MAX_RECIPES_PER_DOMAIN = 1000
+
+# The scheme and host of a URL, skipping any user info, as urlparse finds them
+DOMAIN_PATTERN = (
+    r"^(?P<scheme>[A-Za-z][A-Za-z0-9+.-]*)://(?:[^/?#@]*@)?(?P<host>[^:/?#]*)"
+)
+
+
+def read_chunks(
+    path: str, columns: list[str], chunk_size: int
+) -> Iterator[pd.DataFrame]:
+    """Read only the given columns of the CSV, a chunk of rows at a time."""
+    return pd.read_csv(path, usecols=columns, chunksize=chunk_size)
+
+
+def with_domains(chunk: pd.DataFrame) -> pd.DataFrame:
     """
-    Extract the domain from a URL in the format [http(s)://](subdomain.)domain.com[/path]
+    Add the protocol to the links missing it, and the domain of each link in the
+    format scheme://host.
     """
-    from urllib.parse import urlparse
+    links = chunk["link"]
+    links = links.where(links.str.contains("://", regex=False), "https://" + links)
+    parts = links.str.extract(DOMAIN_PATTERN)
+    return chunk.assign(
+        link=links,
+        domain=parts["scheme"].str.lower() + "://" + parts["host"].str.lower(),
+    )
+
 
-    parsed_url = urlparse(url)
-    return f"{parsed_url.scheme}://{parsed_url.hostname}"
+def count_domains(path: str, chunk_size: int) -> pd.Series:
+    """Count the recipes of each domain, the most common first."""
+    counts = pd.Series(dtype="int64")
+    for chunk in read_chunks(path, ["link"], chunk_size):
+        counts = counts.add(with_domains(chunk)["domain"].value_counts(), fill_value=0)
+    return counts.astype("int64").sort_values(ascending=False, kind="stable")
 
 
-def url_with_protocol(url: str) -> str:
+def scan_domains(
+    path: str, domains: pd.Index, chunk_size: int, rng: np.random.Generator
+) -> tuple[pd.DataFrame, pd.DataFrame, set[str]]:
     """
-    Add the protocol to a URL if it is missing
+    Scan the recipes of the domains.
+
+    :return: A random sample of the links of each domain, the first recipes of
+        each domain, and their lower-cased ingredients.
     """
-    if "://" not in url:
-        return f"https://{url}"
-    return url
+    columns = ["link", "domain"]
+    samples = pd.DataFrame(columns=columns + ["key"])
+    recipes = pd.DataFrame(columns=columns)
+    ingredients = set()
+    for chunk in read_chunks(path, ["link", "NER"], chunk_size):
+        chunk = with_domains(chunk)
+        chunk = chunk[chunk["domain"].isin(domains)]
+        # Keep the links with the smallest random keys, which are a uniform
+        # sample of all the links seen so far
+        samples = (
+            pd.concat([samples, chunk[columns].assign(key=rng.random(len(chunk)))])
+            .sort_values("key")
+            .groupby("domain")
+            .head(LINK_SAMPLE_SIZE)
+        )
+        recipes = (
+            pd.concat([recipes, chunk[columns]])
+            .groupby("domain", sort=False)
+            .head(MAX_RECIPES_PER_DOMAIN)
+        )
+        # Parse the chunk's ingredient lists as one JSON array
+        names = set(
+            itertools.chain.from_iterable(
+                json.loads("[" + ",".join(chunk["NER"]) + "]")
+            )
+        )
+        ingredients.update(name.lower() for name in names)
+    return samples, recipes, ingredients
 
 
 def html_contains_recipe_microformat(html: str) -> bool:
     """
     Check if the HTML contains recipe microformat data
     """
-    import json
     from bs4 import BeautifulSoup
 
     soup = BeautifulSoup(html, "html.parser")
@@ -40,18 +111,15 @@ def html_contains_recipe_microformat(html: str) -> bool:
     return False
 
 
-def url_is_healthy(url: str) -> bool:
+def url_is_healthy(url: str, cache: Optional[HttpCache] = None) -> bool:
     """
     Check if the URL is healthy by making sure it returns a 200 status code and is a
     HTML document which includes recipe microformat data.
     """
-    import requests
-
     try:
-        response = requests.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=5)
+        response = utils.http_get("Mozilla/5.0", url, cache, timeout=5)
         return (
-            response.status_code == 200
-            and "text/html" in response.headers["Content-Type"]
+            "text/html" in response.content_type
             and html_contains_recipe_microformat(response.text)
         )
     except:
@@ -59,71 +127,71 @@ def url_is_healthy(url: str) -> bool:
 
 
 def main():
-    import json
-
-    # Load the CSV
-    df = pd.read_csv("resources/datasets/recipe1m.csv")
-    # Cleanup the links to ensure they are valid URLs
-    df["link"] = df["link"].apply(url_with_protocol)
-    # Augment the dataframe with the domain
-    df["domain"] = df["link"].apply(extract_domain_from_url)
-    # Count the number of recipes per domain
-    domain_counts = df["domain"].value_counts()
-    max_domains = 100
-    link_sample_size = 5
+    parser = argparse.ArgumentParser(
+        description="Find the domains of the Recipe1M dataset with healthy recipe "
+        "pages, and the ingredients of their recipes."
+    )
+    parser.add_argument("--csv", default=CSV_PATH)
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=100_000,
+        help="The rows of the CSV read at once.",
+    )
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    cache = get_http_cache(HTTP_CACHE_DIR, HTTP_CACHE_MAX_MB)
+
+    # Count the recipes per domain, then take the recipes of the top domains
+    # in a second pass, so only one chunk of the CSV is in memory at a time
+    domain_counts = count_domains(args.csv, args.chunk_size).head(MAX_DOMAINS)
+    counted = time.perf_counter()
+    samples, recipes, ingredients = scan_domains(
+        args.csv, domain_counts.index, args.chunk_size, np.random.default_rng()
+    )
+    scanned = time.perf_counter()
+
     # Create a dataframe of the top domains, the counts and
     # the number of healthy links from a sampling of links
+    healthy_counts = samples.groupby("domain")["link"].agg(
+        lambda links: sum(url_is_healthy(link, cache) for link in links)
+    )
     top_domains = pd.DataFrame(
         {
-            "domain": domain_counts.head(max_domains).index,
-            "count": domain_counts.head(max_domains).values,
-            "healthy_count": [
-                sum(
-                    [
-                        url_is_healthy(link)
-                        for link in df[df["domain"] == domain]["link"].sample(
-                            link_sample_size
-                        )
-                    ]
-                )
-                for domain in domain_counts.head(max_domains).index
-            ],
+            "domain": domain_counts.index,
+            "count": domain_counts.values,
+            "healthy_count": healthy_counts.reindex(domain_counts.index, fill_value=0)
+            .astype("int64")
+            .values,
         }
     )
+    checked = time.perf_counter()
+    healthy_domains = top_domains[top_domains["healthy_count"] == LINK_SAMPLE_SIZE][
+        "domain"
+    ]
+
     # Save the top domains to a file
     top_domains.to_csv("resources/datasets/recipe1m_top_domains.csv", index=False)
     # Save the healthy domains to a file
-    top_domains[top_domains["healthy_count"] == link_sample_size]["domain"].to_csv(
+    healthy_domains.to_csv(
         "resources/datasets/recipe1m_healthy_domains.csv", index=False
     )
-    # Save a filtered CSV of the recipes belonging where the domain is found in the healthy domains.
-    # Take only 1000 recipes from each domain.
-    df[
-        df["domain"].isin(
-            top_domains[top_domains["healthy_count"] == link_sample_size]["domain"]
-        )
-    ].groupby("domain").head(1000)[["link", "domain"]].to_csv(
+    # Save a filtered CSV of the first recipes of the healthy domains
+    recipes[recipes["domain"].isin(healthy_domains)].to_csv(
         "resources/datasets/recipe1m_filtered.csv", index=False
     )
-    # Create a unique list of all lower-cased ingredients, sorted alphabetically,
-    # first having parsed the JSON value into a list of ingredients. We use
-    # only the records belonging to the top domains.
-    ingredients = sorted(
-        list(
-            set(
-                [
-                    ingredient.lower()
-                    for ingredients in df[df["domain"].isin(top_domains["domain"])][
-                        "NER"
-                    ].apply(json.loads)
-                    for ingredient in ingredients
-                ]
-            )
-        )
-    )
-    # Save the ingredients to a file
+    # Save the ingredients of the top domains' recipes, sorted alphabetically
     with open("resources/datasets/recipe1m_ingredients.txt", "w") as f:
-        f.write("\n".join(ingredients))
+        f.write("\n".join(sorted(ingredients)))
+
+    print(f"Counting domains took {counted - started:.1f}s")
+    print(f"Scanning the top domains took {scanned - counted:.1f}s")
+    print(f"Checking sample links took {checked - scanned:.1f}s")
+    print(f"Total runtime: {time.perf_counter() - started:.1f}s")
+    # ru_maxrss is in kilobytes on Linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Peak memory: {peak_mb:.0f}MB")
 
 
 if __name__ == "__main__":
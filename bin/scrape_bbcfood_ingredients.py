@@ -1,19 +1,27 @@
 import math
 import string
+import time
+from typing import Optional
 
 from bs4 import BeautifulSoup
 
 from app import utils
+from app.config import HTTP_CACHE_DIR, HTTP_CACHE_MAX_MB
+from app.factories import get_http_cache
+from app.utils import HttpCache
 
 BASE_URI = "https://www.bbc.co.uk/food/ingredients/a-z"
+ROBOTS_URL = "https://www.bbc.co.uk/robots.txt"
 USER_AGENT = "SafePlate/1.0 (+https://safeplate.billgrant.dev)"
 ITEMS_PER_PAGE = 4 * 6
 
 
-def extract_category_urls(category_name: str) -> list[str]:
+def extract_category_urls(
+    category_name: str, cache: Optional[HttpCache] = None
+) -> list[str]:
     """Find the links to the pages for a given category."""
     try:
-        html = utils.scrape_html(USER_AGENT, f"{BASE_URI}/{category_name}/1")
+        html = utils.scrape_html(USER_AGENT, f"{BASE_URI}/{category_name}/1", cache)
         soup = BeautifulSoup(html, "html.parser")
 
         # Find the pagination summary and extract the number of items and pages
@@ -27,9 +35,9 @@ def extract_category_urls(category_name: str) -> list[str]:
         return []
 
 
-def extract_ingredients(url: str) -> list[str]:
+def extract_ingredients(url: str, cache: Optional[HttpCache] = None) -> list[str]:
     """Extract the ingredients from a given page."""
-    html = utils.scrape_html(USER_AGENT, url)
+    html = utils.scrape_html(USER_AGENT, url, cache)
     soup = BeautifulSoup(html, "html.parser")
 
     ingredients = []
@@ -104,21 +112,23 @@ def main():
     ]
 
     ingredients = []
+    cache = get_http_cache(HTTP_CACHE_DIR, HTTP_CACHE_MAX_MB)
 
     for category in categories:
-        urls = extract_category_urls(category)
+        urls = extract_category_urls(category, cache)
         if not urls:
             continue
 
         for url in urls:
-            if not utils.check_robots(
-                USER_AGENT, "https://www.bbc.co.uk/robots.txt", url
-            ):
+            if not utils.check_robots(USER_AGENT, ROBOTS_URL, url):
                 print(f"Skipping {url} because it is disallowed by robots.txt")
                 continue
 
+            # Wait between pages as long as robots.txt asks
+            time.sleep(utils.crawl_delay(USER_AGENT, ROBOTS_URL))
+
             # Add the ingredient to the list
-            ingredients.extend(extract_ingredients(url))
+            ingredients.extend(extract_ingredients(url, cache))
 
     # Extend the ingredients by adding pluralised and accented versions
     ingredients = extend_ingredients(ingredients)
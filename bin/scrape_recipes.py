@@ -1,15 +1,39 @@
 import argparse
-from hashlib import sha256
+import asyncio
 
-import requests
+import aiohttp
 
-from app.config import SCRAPER_USER_AGENT, WEBHOOK_URL, WEBHOOK_API_KEY
-from app.models import RecipeWebsite
-from app.parsers import SchemaOrgParser
-from app.utils import check_robots, scrape_html, crawl_sitemap
+from app.config import (
+    SCRAPER_USER_AGENT,
+    SCRAPER_CONCURRENCY,
+    SCRAPER_PER_HOST_CONCURRENCY,
+    SCRAPER_HOST_DELAY,
+    SCRAPER_ROBOTS_TTL,
+    SCRAPER_PARSE_PROCESSES,
+    HTTP_CACHE_DIR,
+    HTTP_CACHE_MAX_MB,
+    SCRAPER_FRONTIER_PATH,
+    SCRAPER_RECRAWL_DAYS,
+    SCRAPER_MAX_ATTEMPTS,
+    SCRAPER_RETRIES,
+    SCRAPER_BACKOFF_MAX,
+    SCRAPER_RETRY_BUDGET,
+    SCRAPER_BREAKER_THRESHOLD,
+    SCRAPER_BREAKER_RESET,
+    WEBHOOK_BULK_URL,
+    WEBHOOK_API_KEY,
+)
+from app.crawler import Crawler
+from app.factories import get_frontier, get_http_cache
+from app.models import Recipe, RecipeWebsite
+from app.pipeline import ScrapePipeline
+from app.utils import FetchPolicy, RobotsCache
 
 MAX_LINKS = 1000
 
+# The number of recipes sent to the server at once
+BATCH_SIZE = 100
+
 RECIPE_SITES = [
     RecipeWebsite(
         name="NYTimes Cooking",
@@ -54,6 +78,101 @@ RECIPE_SITES = [
 ]
 
 
+async def sync_recipes(
+    session: aiohttp.ClientSession, recipes: list[Recipe]
+) -> list[Recipe]:
+    """
+    Send recipes to the server in a single request.
+
+    :return: The recipes which couldn't be saved.
+    """
+    if not recipes:
+        return []
+    try:
+        async with session.post(
+            WEBHOOK_BULK_URL,
+            data="\n".join(recipe.to_json() for recipe in recipes),
+            headers={
+                "Content-Type": "application/x-ndjson",
+                "Authorization": f"Bearer {WEBHOOK_API_KEY}",
+            },
+        ) as response:
+            response.raise_for_status()
+            results = (await response.json())["results"]
+    except Exception:
+        return recipes
+    return [
+        recipe
+        for recipe, result in zip(recipes, results)
+        if result["status"] not in ("saved", "unchanged")
+    ]
+
+
+async def scrape_sites(sites: list[RecipeWebsite]):
+    """
+    Scrape the sites at the same time, sharing one pool of connections, and
+    parsing the pages in a pool of processes.
+    """
+    cache = get_http_cache(HTTP_CACHE_DIR, HTTP_CACHE_MAX_MB)
+    frontier = get_frontier(
+        SCRAPER_FRONTIER_PATH, SCRAPER_RECRAWL_DAYS, SCRAPER_MAX_ATTEMPTS
+    )
+    policy = FetchPolicy(
+        max_retries=SCRAPER_RETRIES,
+        max_delay=SCRAPER_BACKOFF_MAX,
+        retry_ratio=SCRAPER_RETRY_BUDGET,
+        failure_threshold=SCRAPER_BREAKER_THRESHOLD,
+        reset_after=SCRAPER_BREAKER_RESET,
+    )
+    async with Crawler(
+        SCRAPER_USER_AGENT,
+        max_concurrency=SCRAPER_CONCURRENCY,
+        max_per_host=SCRAPER_PER_HOST_CONCURRENCY,
+        host_delay=SCRAPER_HOST_DELAY,
+        policy=policy,
+        robots=RobotsCache(ttl=SCRAPER_ROBOTS_TTL),
+        cache=cache,
+    ) as crawler:
+        pipeline = ScrapePipeline.multiprocess(
+            crawler,
+            lambda recipes: sync_recipes(crawler.session, recipes),
+            workers=SCRAPER_PARSE_PROCESSES,
+            batch_size=BATCH_SIZE,
+            frontier=frontier,
+        )
+        try:
+            stats = await pipeline.run(sites)
+        finally:
+            pipeline.shutdown()
+            if frontier is not None:
+                frontier.close()
+
+    for site in sites:
+        links_scraped = stats[site.name]["scraped"]
+        failed_attempts = stats[site.name]["failed"]
+        total_attempts = links_scraped + failed_attempts
+        failure_rate = failed_attempts / total_attempts if total_attempts > 0 else 0
+
+        print(f"Benchmark for {site.name}:")
+        print(f"Total Links Found: {links_scraped}")
+        print(f"Failed Attempts: {failed_attempts}")
+        print(f"Failure Rate: {failure_rate:.2f}")
+        if frontier is not None:
+            print(f"Skipped As Already Scraped: {stats[site.name]['skipped']}")
+
+    fetch_stats = policy.stats()
+    print(f"Retries: {fetch_stats.get('retries', 0)}")
+    print(f"Retries Refused By The Budget: {fetch_stats.get('budget_exhausted', 0)}")
+    print(f"Requests Shed By Open Circuits: {fetch_stats.get('shed', 0)}")
+    if fetch_stats["open_circuits"]:
+        print(f"Hosts Still Failing: {', '.join(fetch_stats['open_circuits'])}")
+
+    if cache is not None:
+        print(f"Pages unchanged since they were cached: {cache.hits}")
+        print(f"Pages downloaded: {cache.misses}")
+        cache.close()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -69,47 +188,7 @@ def main():
         else [site for site in RECIPE_SITES if site.name == args.site_name]
     )
 
-    schema_parser = SchemaOrgParser()
-
-    for site in sites_to_crawl:
-        links_scraped = 0
-        failed_attempts = 0
-
-        for url in crawl_sitemap(SCRAPER_USER_AGENT, site.sitemap_url):
-            try:
-                if not check_robots(SCRAPER_USER_AGENT, site.robots_url, url):
-                    print(f"Skipping {url} because it is disallowed by robots.txt")
-                    continue
-                html_content = scrape_html(SCRAPER_USER_AGENT, url)
-                recipe = schema_parser.parse(html_content)
-                if not recipe:
-                    continue
-                recipe.site_name = site.name
-                recipe.id = sha256(url.encode("utf-8")).hexdigest()
-                recipe.url = url
-                with requests.post(
-                    WEBHOOK_URL,
-                    json=recipe.model_dump(by_alias=True),
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {WEBHOOK_API_KEY}",
-                    },
-                ) as response:
-                    pass
-                links_scraped += 1
-            except Exception as e:
-                failed_attempts += 1
-                continue
-            if links_scraped == site.max_links:
-                break
-
-        total_attempts = links_scraped + failed_attempts
-        failure_rate = failed_attempts / total_attempts if total_attempts > 0 else 0
-
-        print(f"Benchmark for {site.name}:")
-        print(f"Total Links Found: {links_scraped}")
-        print(f"Failed Attempts: {failed_attempts}")
-        print(f"Failure Rate: {failure_rate:.2f}")
+    asyncio.run(scrape_sites(sites_to_crawl))
 
 
 if __name__ == "__main__":
@@ -7,10 +7,12 @@ from sklearn.metrics import f1_score, precision_score, recall_score, hamming_los
 from sklearn.model_selection import train_test_split
 from sklearn.multiclass import OneVsRestClassifier
 
+from app.ml import CompiledForest
 from app.models import AllergenGroup
 
 INPUT_CSV = "resources/datasets/allergens_expanded.csv"
 MODEL_PATH = "resources/models/allergen_model.pkl"
+COMPILED_MODEL_PATH = "resources/models/allergen_model"
 VECTORIZER_PATH = "resources/models/allergen_vectorizer.pkl"
 
 ALLERGEN_COLUMNS = AllergenGroup.to_list()
@@ -42,6 +44,8 @@ def main():
 
     # Save the model
     joblib.dump(model, MODEL_PATH)
+    # Save the model compiled into memory-mappable node tables, for faster inference
+    CompiledForest.from_sklearn(model).save(COMPILED_MODEL_PATH)
     # Save the fitted vectorizer
     joblib.dump(vectorizer, VECTORIZER_PATH)
 
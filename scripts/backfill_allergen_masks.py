@@ -0,0 +1,43 @@
+import argparse
+
+from pymongo import MongoClient
+
+from app.config import DATABASE_URI, DATABASE_NAME
+from app.models import AllergenGroup
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Store the allergen bitmask of recipes saved before it was, "
+        "so the allergen filter matches them."
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Recompute the bitmask of every recipe, not only those without one.",
+    )
+    args = parser.parse_args()
+
+    db = MongoClient(DATABASE_URI)[DATABASE_NAME]
+    query = {} if args.all else {"allergen_mask": {"$exists": False}}
+
+    # Compute the masks in the database, as AllergenGroup.to_mask would: each
+    # known allergen sets the bit at its position, and duplicates count once
+    allergens = AllergenGroup.to_list()
+    mask = {
+        "$sum": {
+            "$map": {
+                "input": {
+                    "$setIntersection": [{"$ifNull": ["$allergens", []]}, allergens]
+                },
+                "in": {"$pow": [2, {"$indexOfArray": [allergens, "$$this"]}]},
+            }
+        }
+    }
+    result = db.recipes.update_many(query, [{"$set": {"allergen_mask": mask}}])
+
+    print(f"Stored the allergen bitmask of {result.modified_count} recipes")
+
+
+if __name__ == "__main__":
+    main()
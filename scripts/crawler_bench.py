@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+from aiohttp import web
+from prettytable import PrettyTable
+
+from app.crawler import Crawler
+from app.parsers import SchemaOrgParser
+from app.utils import scrape_html
+
+USER_AGENT = "SafePlateBench/1.0"
+
+
+def recipe_page(n: int) -> str:
+    """Build a synthetic recipe page, like those the scraper parses."""
+    recipe = {
+        "@context": "https://schema.org",
+        "@type": "Recipe",
+        "name": f"Recipe {n}",
+        "description": f"<p>A synthetic recipe, number {n}.</p>",
+        "cookTime": "PT25M",
+        "recipeCuisine": "British, Italian",
+        "suitableForDiet": ["https://schema.org/VegetarianDiet"],
+        "image": [f"https://example.com/images/{n}.jpg"],
+        "recipeIngredient": [
+            "200g plain flour",
+            "2 large eggs",
+            "300ml whole milk",
+            "1 tbsp sunflower oil",
+            "<a href='/food/butter'>butter</a>, for frying",
+        ],
+    }
+    padding = "<p>Lorem ipsum dolor sit amet.</p>" * 200
+    return (
+        "<html><head><title>Recipe</title>"
+        f'<script type="application/ld+json">{json.dumps(recipe)}</script>'
+        f"</head><body>{padding}</body></html>"
+    )
+
+
+def start_stub_server(latency_ms: float) -> str:
+    """
+    Serve synthetic recipe pages from a thread, with a simulated latency.
+
+    :return: The base URL of the server.
+    """
+    started = threading.Event()
+    address = {}
+
+    async def page(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency_ms / 1000)
+        n = int(request.match_info["n"])
+        return web.Response(text=recipe_page(n), content_type="text/html")
+
+    async def sitemap(request: web.Request) -> web.Response:
+        # A sitemap of the first pages, as many as asked for
+        base_url = f"http://{request.host}"
+        urls = "".join(
+            f"<url><loc>{base_url}/recipes/{n}</loc></url>"
+            for n in range(int(request.query.get("pages", 100)))
+        )
+        return web.Response(text=f"<urlset>{urls}</urlset>", content_type="text/xml")
+
+    async def serve():
+        app = web.Application()
+        app.router.add_get("/recipes/{n}", page)
+        app.router.add_get("/sitemap.xml", sitemap)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        address["port"] = runner.addresses[0][1]
+        started.set()
+        await asyncio.Event().wait()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+    started.wait()
+    return f"http://127.0.0.1:{address['port']}"
+
+
+def scrape_serially(urls: list[str]) -> int:
+    """Scrape the pages one at a time, as the scraper used to."""
+    parser = SchemaOrgParser()
+    return sum(1 for url in urls if parser.parse(scrape_html(USER_AGENT, url)))
+
+
+async def scrape_concurrently(urls: list[str], concurrency: int) -> int:
+    """Scrape the pages with the crawler."""
+    parser = SchemaOrgParser()
+    parsed = 0
+    async with Crawler(
+        USER_AGENT, max_concurrency=concurrency, max_per_host=concurrency
+    ) as crawler:
+        async for _, html in crawler.crawl(urls):
+            if not isinstance(html, Exception) and parser.parse(html):
+                parsed += 1
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare scraping synthetic recipe pages one at a time with "
+        "the concurrent crawler, against a local stub server."
+    )
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 4, 16, 32, 64]
+    )
+    args = parser.parse_args()
+
+    base_url = start_stub_server(args.latency_ms)
+    urls = [f"{base_url}/recipes/{n}" for n in range(args.pages)]
+
+    table = PrettyTable()
+    table.field_names = ["Method", "Concurrency", "Parsed", "Time (s)", "Pages/s"]
+
+    def add_row(method: str, concurrency: int, parsed: int, elapsed: float):
+        table.add_row(
+            [
+                method,
+                concurrency,
+                parsed,
+                f"{elapsed:.2f}",
+                f"{args.pages / elapsed:.1f}",
+            ]
+        )
+
+    started = time.perf_counter()
+    parsed = scrape_serially(urls)
+    add_row("requests, serial", 1, parsed, time.perf_counter() - started)
+
+    for concurrency in args.concurrency:
+        started = time.perf_counter()
+        parsed = asyncio.run(scrape_concurrently(urls, concurrency))
+        add_row("Crawler", concurrency, parsed, time.perf_counter() - started)
+
+    print(table)
+
+
+if __name__ == "__main__":
+    main()
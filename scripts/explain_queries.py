@@ -0,0 +1,144 @@
+import argparse
+import sys
+
+from prettytable import PrettyTable
+from pymongo import MongoClient
+
+from app.config import DATABASE_URI, DATABASE_NAME
+from app.models import RecipeFilters
+from app.services import RecipeService, encode_cursor
+
+
+def find_stages(plan: dict) -> list[str]:
+    """Get the stages of a query plan, from the top down."""
+    stages = []
+    if "stage" in plan:
+        stages.append(plan["stage"])
+    for child in ["inputStage", "queryPlan"]:
+        if child in plan:
+            stages.extend(find_stages(plan[child]))
+    for child in plan.get("inputStages", []):
+        stages.extend(find_stages(child))
+    return stages
+
+
+def winning_plan(explained: dict) -> dict:
+    """Get the winning plan, wherever the aggregation put it."""
+    if "queryPlanner" in explained:
+        return explained["queryPlanner"]["winningPlan"]
+    for stage in explained.get("stages", []):
+        if "$cursor" in stage:
+            return stage["$cursor"]["queryPlanner"]["winningPlan"]
+    return {}
+
+
+def representative_filters(db) -> dict[str, RecipeFilters]:
+    """Build filters from values found in the recipes."""
+
+    def sample(field: str, count: int = 2) -> list[str]:
+        return [value for value in db.recipes.distinct(field) if value][:count]
+
+    site_names = sample("site_name")
+    cuisines = sample("cuisine")
+    diets = sample("diet")
+    cook_times = sample("cook_time")
+    allergens = sample("allergens")
+
+    return {
+        "none": RecipeFilters(),
+        "site_name": RecipeFilters(site_name=site_names),
+        "cuisine": RecipeFilters(cuisine=cuisines),
+        "diet": RecipeFilters(diet=diets),
+        "cook_time": RecipeFilters(cook_time=cook_times),
+        "allergen": RecipeFilters(allergen=allergens),
+        "allergen + cuisine": RecipeFilters(allergen=allergens, cuisine=cuisines),
+        "site_name + diet": RecipeFilters(site_name=site_names, diet=diets),
+        "all": RecipeFilters(
+            site_name=site_names,
+            cuisine=cuisines,
+            diet=diets,
+            cook_time=cook_times,
+            allergen=allergens,
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Explain the recipe queries for representative filters, and "
+        "fail if any of them scans the whole collection."
+    )
+    parser.add_argument("--limit", type=int, default=30)
+    parser.add_argument(
+        "--create-indexes",
+        action="store_true",
+        help="Create the indexes declared on RecipeService first.",
+    )
+    args = parser.parse_args()
+
+    db = MongoClient(DATABASE_URI)[DATABASE_NAME]
+    if args.create_indexes:
+        db.recipes.create_indexes(RecipeService.INDEXES)
+
+    # A cursor from the middle of the collection, to explain seeking to it,
+    # and the page number of the middle, to explain skipping to it
+    total = db.recipes.estimated_document_count()
+    middle = db.recipes.find_one({}, sort=[("_id", -1)], skip=total // 2)
+    middle_page = max(1, total // 2 // args.limit)
+    cursors = {"first page": None}
+    if middle:
+        cursors["next page"] = encode_cursor("after", middle["_id"])
+        cursors["previous page"] = encode_cursor("before", middle["_id"])
+
+    table = PrettyTable()
+    table.field_names = ["Filters", "Query", "Plan"]
+    table.align["Plan"] = "l"
+
+    def explain_pipeline(pipeline: list) -> dict:
+        return db.command(
+            "explain",
+            {"aggregate": "recipes", "pipeline": pipeline, "cursor": {}},
+            verbosity="queryPlanner",
+        )
+
+    collection_scans = 0
+    for name, filters in representative_filters(db).items():
+        matchers = RecipeService._matchers(filters)
+
+        queries = {
+            "count": db.command(
+                "explain",
+                {"count": "recipes", "query": matchers},
+                verbosity="queryPlanner",
+            )
+        }
+        for page, cursor in cursors.items():
+            _, pipeline = RecipeService._page_pipeline(matchers, cursor, args.limit)
+            queries[page] = explain_pipeline(pipeline)
+        # The page numbers of find_all, which skip the recipes before the page
+        for page in sorted({1, middle_page}):
+            queries[f"page {page}"] = explain_pipeline(
+                RecipeService._skip_pipeline(matchers, page, args.limit)
+            )
+        # Without filters, the facet counts are read from the facet cache or
+        # the facets collection, so only the filtered counts are queried
+        if matchers:
+            queries["facet counts"] = explain_pipeline(
+                RecipeService._facet_pipeline(matchers)
+            )
+
+        for query, explained in queries.items():
+            stages = find_stages(winning_plan(explained))
+            if "COLLSCAN" in stages:
+                collection_scans += 1
+            table.add_row([name, query, " <- ".join(stages)])
+
+    print(table)
+
+    if collection_scans:
+        print(f"FAIL: {collection_scans} queries scan the whole collection")
+    sys.exit(1 if collection_scans else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import subprocess
+import sys
+
+from prettytable import PrettyTable
+
+# Modules which belong to the ML stack, and must not be imported at startup
+DEFERRED_MODULES = ["sklearn", "joblib", "scipy", "pandas"]
+
+
+def measure_imports(module: str) -> dict[str, tuple[int, int]]:
+    """
+    Import a module in a fresh interpreter with ``-X importtime``.
+
+    :param module: The module to import.
+    :return: The self and cumulative import time in microseconds, by module.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    timings = {}
+    for line in result.stderr.splitlines():
+        # Lines look like "import time:       123 |       456 |   package.module"
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure how long importing the server takes, and fail if "
+        "it's over budget or imports the ML stack."
+    )
+    parser.add_argument("--module", default="server")
+    parser.add_argument("--budget-ms", type=float, default=750)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    timings = measure_imports(args.module)
+    total_ms = timings[args.module][1] / 1000
+
+    table = PrettyTable()
+    table.field_names = ["Module", "Self (ms)", "Cumulative (ms)"]
+    table.align["Module"] = "l"
+    slowest = sorted(timings.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (self_us, cumulative_us) in slowest[: args.top]:
+        table.add_row([name, f"{self_us / 1000:.1f}", f"{cumulative_us / 1000:.1f}"])
+    print(table)
+
+    print(f"Importing {args.module} took {total_ms:.1f}ms (budget {args.budget_ms}ms)")
+
+    failures = []
+    if total_ms > args.budget_ms:
+        failures.append(
+            f"import time is over budget by {total_ms - args.budget_ms:.1f}ms"
+        )
+    for deferred in DEFERRED_MODULES:
+        if deferred in timings:
+            failures.append(f"{deferred} is imported at startup")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
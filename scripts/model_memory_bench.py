@@ -0,0 +1,116 @@
+import argparse
+import json
+import subprocess
+import sys
+
+from prettytable import PrettyTable
+
+# Loads the model in a worker process, then reports its load time and memory
+# usage once every page of the model has been read, as serving it would
+WORKER = """
+import json, sys, time
+
+started = time.perf_counter()
+
+import numpy as np
+
+from app.ml import CompiledForest, load_model
+
+path, mmap_mode = sys.argv[1], sys.argv[2] or None
+model = load_model(path, mmap_mode=mmap_mode)
+loaded = time.perf_counter() - started
+
+if isinstance(model, CompiledForest):
+    for array in model.arrays().values():
+        np.sum(array)
+
+
+def read_kb(path, field):
+    with open(path) as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+print(
+    json.dumps(
+        {
+            "load_seconds": loaded,
+            "rss_kb": read_kb("/proc/self/status", "VmRSS"),
+            "pss_kb": read_kb("/proc/self/smaps_rollup", "Pss"),
+        }
+    ),
+    flush=True,
+)
+
+# Stay alive until every worker has reported, so they overlap in memory
+sys.stdin.read()
+"""
+
+
+def run_workers(path: str, mmap_mode: str, workers: int) -> list[dict]:
+    """Run the workers side by side, as server workers would be."""
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-c", WORKER, path, mmap_mode],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for _ in range(workers)
+    ]
+
+    reports = [json.loads(process.stdout.readline()) for process in processes]
+
+    for process in processes:
+        process.stdin.close()
+        process.wait()
+
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the startup time and memory of model formats "
+        "across several worker processes (Linux only)."
+    )
+    parser.add_argument(
+        "models",
+        nargs="+",
+        help="Model paths: a pickle, a compiled .npz, or a compiled directory.",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    table = PrettyTable()
+    table.field_names = [
+        "Model",
+        "mmap",
+        "Workers",
+        "Mean Load (s)",
+        "Total RSS (MB)",
+        "Total PSS (MB)",
+    ]
+
+    for path in args.models:
+        for mmap_mode in ["", "r"]:
+            reports = run_workers(path, mmap_mode, args.workers)
+            table.add_row(
+                [
+                    path,
+                    mmap_mode or "-",
+                    args.workers,
+                    f"{sum(r['load_seconds'] for r in reports) / len(reports):.3f}",
+                    f"{sum(r['rss_kb'] for r in reports) / 1024:.1f}",
+                    f"{sum(r['pss_kb'] for r in reports) / 1024:.1f}",
+                ]
+            )
+
+    # PSS splits shared pages between the processes sharing them, so it's
+    # the best measure of what the workers cost together
+    print(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,73 @@
-import subprocess
-import sys
+import argparse
+import asyncio
+import re
+import time
 
+from prettytable import PrettyTable
 
-def run_scraping_processes(site_names: list[str]):
-    processes = []
+from app.crawler import Crawler
+from app.models import Recipe, RecipeWebsite
+from app.pipeline import ScrapePipeline
+from scripts.crawler_bench import USER_AGENT, start_stub_server
 
-    for site_name in site_names:
-        print("Starting a new scraping process...")
-        process = subprocess.Popen(
-            [sys.executable, "-m", "bin.scrape_recipes", site_name]
+
+async def discard(recipes: list[Recipe]) -> list[Recipe]:
+    """Pretend to save the recipes."""
+    return []
+
+
+async def scrape(site: RecipeWebsite, workers: int, fast: bool) -> int:
+    """Scrape the site with the pipeline, parsing pages in a pool of processes."""
+    async with Crawler(USER_AGENT, max_concurrency=32, max_per_host=32) as crawler:
+        pipeline = ScrapePipeline.multiprocess(
+            crawler, discard, workers=workers, fast=fast
         )
-        processes.append(process)
+        try:
+            stats = await pipeline.run([site])
+        finally:
+            pipeline.shutdown()
+    return stats[site.name]["scraped"]
 
-    for process in processes:
-        process.wait()
 
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure how the scraping pipeline scales with the processes "
+        "parsing pages, against a local stub server."
+    )
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
 
-if __name__ == "__main__":
-    sites_names = ["NYTimes Cooking", "BBCFood", "BBCGoodFood", "Food", "BonAppetit"]
+    base_url = start_stub_server(args.latency_ms)
+    site = RecipeWebsite(
+        name="Stub",
+        host=base_url,
+        sitemap_url=f"{base_url}/sitemap.xml?pages={args.pages}",
+        recipe_url_pattern=re.compile(r".*/recipes/\d+$"),
+        max_links=args.pages,
+    )
+
+    table = PrettyTable()
+    table.field_names = ["Parser", "Processes", "Scraped", "Time (s)", "Pages/s"]
 
-    print(f"Running {len(sites_names)} concurrent scraping processes...")
-    run_scraping_processes(sites_names)
-    print("All scraping processes have completed.")
+    for name, fast in [("BeautifulSoup", False), ("Scan", True)]:
+        for workers in args.workers:
+            started = time.perf_counter()
+            scraped = asyncio.run(scrape(site, workers, fast))
+            elapsed = time.perf_counter() - started
+            table.add_row(
+                [
+                    name,
+                    workers,
+                    scraped,
+                    f"{elapsed:.2f}",
+                    f"{args.pages / elapsed:.1f}",
+                ]
+            )
+
+    print(table)
+
+
+if __name__ == "__main__":
+    main()
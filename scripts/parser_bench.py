@@ -0,0 +1,119 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+from prettytable import PrettyTable
+
+from app.parsers import SchemaOrgParser
+
+SAMPLES_PATH = "resources/datasets/recipe_samples.json"
+
+
+def sample_page(recipe: dict, paragraphs: int) -> str:
+    """Build a page for a sample recipe, padded out like a real recipe page."""
+    schema = {
+        "@context": "https://schema.org",
+        "@type": "Recipe",
+        "name": recipe["name"],
+        "description": f"<p>{recipe['description']}</p>",
+        "cookTime": "PT45M",
+        "recipeCuisine": ", ".join(recipe["cuisine"]),
+        "image": [recipe["image_url"]],
+        "recipeIngredient": [
+            f"<a href='/food/{n}'>{ingredient}</a>"
+            for n, ingredient in enumerate(recipe["ingredients"])
+        ],
+    }
+    navigation = "".join(
+        f'<li><a class="nav-link" href="/recipes/{n}">Recipe {n}</a></li>'
+        for n in range(paragraphs // 10)
+    )
+    body = "".join(
+        f'<div class="step"><p data-step="{n}">Stir the mixture, then season '
+        f"to taste &amp; leave it to rest for {n} minutes.</p></div>"
+        for n in range(paragraphs)
+    )
+    return (
+        "<!DOCTYPE html><html><head><title>Recipe</title>"
+        "<style>.step { margin: 1em; }</style>"
+        "<script>window.dataLayer = window.dataLayer || [];</script>"
+        f"</head><body><nav><ul>{navigation}</ul></nav>{body}"
+        f'<script type="application/ld+json">{json.dumps(schema)}</script>'
+        "</body></html>"
+    )
+
+
+def load_pages(pages_dir: str | None, paragraphs: int) -> list[str]:
+    """Load the saved pages, or build pages for the sample recipes."""
+    if pages_dir:
+        return [
+            path.read_text(encoding="utf-8", errors="replace")
+            for path in sorted(Path(pages_dir).glob("*.htm*"))
+        ]
+    with open(SAMPLES_PATH) as file:
+        samples = json.load(file)
+    return [sample_page(sample, paragraphs) for sample in samples]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare how fast the schema.org parser parses recipe pages "
+        "by scanning them, and by building a BeautifulSoup tree."
+    )
+    parser.add_argument(
+        "--pages-dir",
+        help="A directory of saved .html pages. Pages are built from the sample "
+        "recipes if not given.",
+    )
+    parser.add_argument(
+        "--paragraphs",
+        type=int,
+        default=2000,
+        help="The paragraphs of padding in each built page.",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pages = load_pages(args.pages_dir, args.paragraphs)
+    if not pages:
+        parser.error("No pages to parse")
+    megabytes = sum(len(page.encode("utf-8")) for page in pages) / 1024 / 1024
+
+    table = PrettyTable()
+    table.field_names = ["Parser", "Pages", "Recipes", "Time (s)", "Pages/s", "MB/s"]
+
+    results = {}
+    for name, fast in [("BeautifulSoup", False), ("Scan", True)]:
+        schema_parser = SchemaOrgParser(fast=fast)
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            recipes = [schema_parser.parse(page) for page in pages]
+        elapsed = (time.perf_counter() - started) / args.repeat
+        results[name] = [recipe.model_dump() if recipe else None for recipe in recipes]
+        table.add_row(
+            [
+                name,
+                len(pages),
+                sum(1 for recipe in recipes if recipe),
+                f"{elapsed:.3f}",
+                f"{len(pages) / elapsed:.1f}",
+                f"{megabytes / elapsed:.1f}",
+            ]
+        )
+
+    print(f"{len(pages)} pages, {megabytes:.1f}MB")
+    print(table)
+
+    mismatches = sum(
+        1
+        for tree, scan in zip(results["BeautifulSoup"], results["Scan"])
+        if tree != scan
+    )
+    if mismatches:
+        print(f"{mismatches} pages were parsed differently")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import asyncio
+
+from prettytable import PrettyTable
+
+from app.config import DATABASE_URI, DATABASE_NAME
+from app.factories import get_db_connection
+from app.services import RecipeService
+
+
+async def main():
+    recipe_service = RecipeService(get_db_connection(DATABASE_URI, DATABASE_NAME))
+
+    # Rebuild the facets collection read when FACET_SOURCE is "materialized"
+    counts = await recipe_service.rebuild_facets()
+
+    table = PrettyTable()
+    table.field_names = ["Filter", "Values"]
+    for key, count in counts.items():
+        table.add_row([key, count])
+    print(table)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,16 +1,49 @@
+import asyncio
+import contextlib
+import functools
 import logging
 
-import joblib
 from starlette.applications import Starlette
 from starlette.routing import Route, Mount
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 
-from app.config import DATABASE_URI, DATABASE_NAME, LOG_LEVEL, DEBUG
+from app.config import (
+    DATABASE_URI,
+    DATABASE_NAME,
+    LOG_LEVEL,
+    DEBUG,
+    ALLERGEN_CACHE_SIZE,
+    ALLERGEN_MODEL_PATH,
+    ALLERGEN_VECTORIZER_PATH,
+    ALLERGEN_MMAP_MODE,
+    DETECTOR_EXECUTOR,
+    DETECTOR_WORKERS,
+    DETECTOR_MAX_PENDING,
+    DETECTOR_BATCH_SIZE,
+    DETECTOR_BATCH_WAIT_MS,
+    DETECTOR_BATCH_MAX_PENDING,
+    DETECTOR_MODE,
+    ALLERGEN_LEXICON_PATH,
+    FACET_CACHE_TTL,
+    FACET_SOURCE,
+    FACET_REBUILD_INTERVAL,
+    RECIPE_QUERY_MODE,
+    APPROXIMATE_COUNTS,
+    WRITE_BEHIND,
+    WRITE_BEHIND_MAX_ITEMS,
+    WRITE_BEHIND_MAX_WAIT_MS,
+)
 from app.endpoints import Endpoints
 from app.factories import get_db_connection
-from app.ml import AllergenDetector
-from app.services import RecipeService
+from app.ml import (
+    DetectorPool,
+    BatchScheduler,
+    LazyDetector,
+    detector_version,
+    load_detector,
+)
+from app.services import RecipeService, FacetCache, WriteBehindBuffer
 
 # Configure logging
 logging.basicConfig()
@@ -19,23 +52,121 @@ logging.getLogger().setLevel(LOG_LEVEL)
 # Initialize database connection
 db = get_db_connection(DATABASE_URI, DATABASE_NAME)
 
-# Initialize the recipe service
-recipe_service = RecipeService(db)
+# Initialize the recipe service, caching the filters shown on the homepage
+recipe_service = RecipeService(
+    db,
+    facet_cache=FacetCache(FACET_CACHE_TTL) if FACET_CACHE_TTL > 0 else None,
+    materialized_facets=FACET_SOURCE == "materialized",
+    approximate_counts=APPROXIMATE_COUNTS,
+)
+
+# In hybrid mode, lines of known ingredients are resolved without the model
+lexicon_path = ALLERGEN_LEXICON_PATH if DETECTOR_MODE == "hybrid" else None
 
-# Load the model and vectorizer
-model = joblib.load("resources/models/allergen_model.pkl")
-vectorizer = joblib.load("resources/models/allergen_vectorizer.pkl")
-if not model or not vectorizer:
-    raise Exception("Failed to load model or vectorizer")
+# Initialize the allergen detector pool, so detection runs off the event loop.
+# The detector is loaded in the background once the server has started.
+if DETECTOR_EXECUTOR == "process":
+    # Each worker process loads its own model and vectorizer
+    detector_pool = DetectorPool.multiprocess(
+        ALLERGEN_MODEL_PATH,
+        ALLERGEN_VECTORIZER_PATH,
+        cache_size=ALLERGEN_CACHE_SIZE,
+        lexicon_path=lexicon_path,
+        mmap_mode=ALLERGEN_MMAP_MODE,
+        workers=DETECTOR_WORKERS,
+        max_pending=DETECTOR_MAX_PENDING,
+    )
+else:
+    # The detector caches predictions per ingredient line
+    detector = LazyDetector(
+        functools.partial(
+            load_detector,
+            ALLERGEN_MODEL_PATH,
+            ALLERGEN_VECTORIZER_PATH,
+            cache_size=ALLERGEN_CACHE_SIZE,
+            lexicon_path=lexicon_path,
+            mmap_mode=ALLERGEN_MMAP_MODE,
+        )
+    )
+    detector_pool = DetectorPool.threaded(
+        detector,
+        workers=DETECTOR_WORKERS,
+        max_pending=DETECTOR_MAX_PENDING,
+    )
 
-# Initialize the allergen detector
-allergen_detector = AllergenDetector(model, vectorizer)
+# Coalesce recipes arriving close together into a single detection
+if DETECTOR_BATCH_SIZE > 1:
+    allergen_detector = BatchScheduler(
+        detector_pool,
+        max_batch_size=DETECTOR_BATCH_SIZE,
+        max_wait_ms=DETECTOR_BATCH_WAIT_MS,
+        max_pending=DETECTOR_BATCH_MAX_PENDING,
+    )
+else:
+    allergen_detector = detector_pool
+
+# Save single recipes in bulk writes, rather than one write each
+write_buffer = None
+if WRITE_BEHIND:
+    write_buffer = WriteBehindBuffer(
+        recipe_service,
+        max_items=WRITE_BEHIND_MAX_ITEMS,
+        max_wait_ms=WRITE_BEHIND_MAX_WAIT_MS,
+    )
 
 # Initialize the Jinja2 templates
 templates = Jinja2Templates(directory="app/views")
 
 # Initialize HTTP endpoints
-endpoints = Endpoints(recipe_service, allergen_detector, templates)
+endpoints = Endpoints(
+    recipe_service,
+    allergen_detector,
+    templates,
+    query_mode=RECIPE_QUERY_MODE,
+    write_buffer=write_buffer,
+)
+
+
+async def create_recipe_indexes():
+    try:
+        await recipe_service.create_indexes()
+    except Exception:
+        logging.exception("Failed to create the recipe indexes")
+
+
+async def rebuild_facets_periodically():
+    while True:
+        await asyncio.sleep(FACET_REBUILD_INTERVAL)
+        try:
+            await recipe_service.rebuild_facets()
+        except Exception:
+            logging.exception("Failed to rebuild the facets collection")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    # Recipes labelled by another version of the detector are labelled again.
+    # The version only stats the detector's files, so it doesn't wait on the model
+    recipe_service.detector_version = detector_version(
+        ALLERGEN_MODEL_PATH, ALLERGEN_VECTORIZER_PATH, lexicon_path
+    )
+    # Load the detector without holding up the pages being served meanwhile
+    warm_up = asyncio.create_task(allergen_detector.warm_up())
+    create_indexes = asyncio.create_task(create_recipe_indexes())
+    rebuild_facets = None
+    if recipe_service.materialized_facets and FACET_REBUILD_INTERVAL > 0:
+        rebuild_facets = asyncio.create_task(rebuild_facets_periodically())
+    yield
+    warm_up.cancel()
+    create_indexes.cancel()
+    if rebuild_facets:
+        rebuild_facets.cancel()
+    if isinstance(allergen_detector, BatchScheduler):
+        await allergen_detector.drain()
+    if write_buffer:
+        await write_buffer.drain()
+    detector_pool.shutdown()
+
 
 # Initialize the Starlette application
 app = Starlette(
@@ -43,6 +174,12 @@ app = Starlette(
     routes=[
         Route(path="/", endpoint=endpoints.index, methods=["GET"]),
         Route(path="/api/recipes", endpoint=endpoints.sync_recipe, methods=["POST"]),
+        Route(
+            path="/api/recipes/bulk", endpoint=endpoints.sync_recipes, methods=["POST"]
+        ),
+        Route(path="/api/metrics", endpoint=endpoints.metrics, methods=["GET"]),
+        Route(path="/health/ready", endpoint=endpoints.ready, methods=["GET"]),
         Mount(path="/static", app=StaticFiles(directory="app/static")),
     ],
+    lifespan=lifespan,
 )
@@ -1,21 +1,518 @@
+import asyncio
 import json
+import os
+import tempfile
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
-from app.services import AllergenDetector
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.multiclass import OneVsRestClassifier
 
+from app.ml import (
+    AllergenDetector,
+    IngredientCache,
+    KeywordMatcher,
+    DetectorPool,
+    DetectorSaturated,
+    BatchScheduler,
+    Histogram,
+    CompiledForest,
+    LazyDetector,
+    detector_version,
+    resolve_model_path,
+)
+from app.models import AllergenGroup
 
+MODEL_PATH = "./resources/models/allergen_model.pkl"
+VECTORIZER_PATH = "./resources/models/allergen_vectorizer.pkl"
+
+
+def train_small_model(vectorizer):
+    """Train a small allergen model, for tests which don't need the real one."""
+    df = pd.read_csv("resources/datasets/allergens.csv")
+    allergen_columns = AllergenGroup.to_list()
+    model = OneVsRestClassifier(
+        RandomForestClassifier(n_estimators=10, random_state=42)
+    )
+    model.fit(vectorizer.transform(df["Ingredient"]), df[allergen_columns].astype(int))
+    return model
+
+
+def load_recipe_samples() -> list[dict]:
+    with open("resources/datasets/recipe_samples.json") as f:
+        return json.load(f)
+
+
+@unittest.skipUnless(os.path.exists(MODEL_PATH), "allergen model has not been trained")
 class TestAllergenDetector(unittest.TestCase):
     def setUp(self):
         self.detector = AllergenDetector(
-            "./resources/models/allergen_model.pkl",
-            "./resources/models/allergen_vectorizer.pkl",
+            joblib.load(MODEL_PATH),
+            joblib.load(VECTORIZER_PATH),
         )
 
     def test_detector(self):
-        with open("resources/datasets/recipe_samples.json") as f:
-            recipes = json.load(f)
+        recipes = load_recipe_samples()
+
+        for recipe in recipes:
+            ingredients = recipe["ingredients"]
+            detected_allergens = self.detector.detect(ingredients)
+            self.assertListEqual(recipe["allergens"], detected_allergens)
+
+
+class TestDetectMany(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        vectorizer = joblib.load(VECTORIZER_PATH)
+        cls.detector = AllergenDetector(train_small_model(vectorizer), vectorizer)
+
+    def test_matches_per_recipe_predictions(self):
+        """Batched detection agrees with predicting each recipe on its own."""
+        recipes = [recipe["ingredients"] for recipe in load_recipe_samples()]
+        allergen_columns = AllergenGroup.to_list()
+
+        batched = self.detector.detect_many(recipes)
+
+        self.assertEqual(len(batched), len(recipes))
+        for ingredients, allergens in zip(recipes, batched):
+            predictions = self.detector.model.predict(
+                self.detector.vectorizer.transform(ingredients)
+            )
+            expected = {
+                allergen_columns[i]
+                for prediction in predictions
+                for i in range(len(allergen_columns))
+                if prediction[i] == 1
+            }
+            self.assertListEqual(sorted(expected), allergens)
+
+    def test_empty_recipes(self):
+        """Recipes without ingredients have no allergens, wherever they appear."""
+        ingredients = ["2 eggs", "100ml milk"]
+        batched = self.detector.detect_many([[], ingredients, []])
+
+        self.assertListEqual(batched[0], [])
+        self.assertListEqual(batched[1], self.detector.detect(ingredients))
+        self.assertIn("Milk", batched[1])
+        self.assertListEqual(batched[2], [])
+        self.assertListEqual(self.detector.detect_many([]), [])
+        self.assertListEqual(self.detector.detect([]), [])
+
+    def test_sorted(self):
+        allergens = self.detector.detect(["plain flour", "2 eggs", "butter", "prawns"])
+        self.assertListEqual(allergens, sorted(allergens))
+
+    def test_masks(self):
+        """The bitmasks hold the same allergens as the lists of names."""
+        recipes = [recipe["ingredients"] for recipe in load_recipe_samples()] + [[]]
+        masks = self.detector.detect_masks(recipes)
+
+        self.assertEqual(masks[-1], 0)
+        for mask, allergens in zip(masks, self.detector.detect_many(recipes)):
+            self.assertIsInstance(mask, int)
+            self.assertEqual(mask, AllergenGroup.to_mask(allergens))
+
+
+class TestIngredientCache(unittest.TestCase):
+    def test_normalise(self):
+        self.assertEqual(
+            IngredientCache.normalise("  1 Tbsp   Olive\tOil "), "1 tbsp olive oil"
+        )
+
+    def test_lru_eviction(self):
+        cache = IngredientCache(max_size=2)
+        cache.put("2 eggs", 4)
+        cache.put("butter", 64)
+        self.assertEqual(cache.get("2 eggs"), 4)
+
+        # "butter" is now the least recently used entry
+        cache.put("prawns", 2)
+        self.assertIsNone(cache.get("butter"))
+        self.assertEqual(cache.get("2 eggs"), 4)
+        self.assertEqual(cache.get("prawns"), 2)
+        self.assertEqual(len(cache), 2)
+
+    def test_stats(self):
+        cache = IngredientCache(max_size=10)
+        cache.put("2 eggs", 4)
+        cache.get("2 eggs")
+        cache.get("butter")
+        self.assertDictEqual(
+            cache.stats(), {"size": 1, "max_size": 10, "hits": 1, "misses": 1}
+        )
+
+
+class TestCachedDetector(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.vectorizer = joblib.load(VECTORIZER_PATH)
+        cls.model = train_small_model(cls.vectorizer)
+
+    def test_matches_uncached(self):
+        recipes = [recipe["ingredients"] for recipe in load_recipe_samples()]
+        uncached = AllergenDetector(self.model, self.vectorizer)
+        cached = AllergenDetector(
+            self.model, self.vectorizer, cache=IngredientCache(max_size=50)
+        )
+
+        # Run twice so the second pass is served partly from the cache
+        for _ in range(2):
+            self.assertListEqual(
+                cached.detect_many(recipes), uncached.detect_many(recipes)
+            )
+        self.assertGreater(cached.cache.hits, 0)
+
+    def test_only_unseen_lines_are_predicted(self):
+        detector = AllergenDetector(
+            self.model, self.vectorizer, cache=IngredientCache()
+        )
+        detector.detect(["2 eggs", "2 Eggs ", "butter"])
+        self.assertEqual(len(detector.cache), 2)
+        self.assertEqual(detector.cache.misses, 2)
+
+        detector.detect(["butter", "100ml milk"])
+        self.assertEqual(detector.cache.hits, 1)
+        self.assertEqual(detector.cache.misses, 3)
+
+
+class TestDetectorPool(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        vectorizer = joblib.load(VECTORIZER_PATH)
+        cls.detector = AllergenDetector(train_small_model(vectorizer), vectorizer)
+
+    async def test_matches_detector(self):
+        pool = DetectorPool.threaded(self.detector, workers=2)
+        ingredients = ["2 eggs", "100ml milk"]
+        try:
+            self.assertListEqual(
+                await pool.detect(ingredients), self.detector.detect(ingredients)
+            )
+            self.assertEqual(pool.pending, 0)
+        finally:
+            pool.shutdown()
+
+    async def test_warm_up(self):
+        loads = []
+
+        def load():
+            loads.append(True)
+            return self.detector
+
+        detector = LazyDetector(load)
+        pool = DetectorPool.threaded(detector, workers=2)
+        try:
+            self.assertFalse(pool.ready)
+            self.assertFalse(detector.loaded)
+
+            await pool.warm_up()
+
+            self.assertTrue(pool.ready)
+            self.assertTrue(detector.loaded)
+            self.assertEqual(len(loads), 1)
+        finally:
+            pool.shutdown()
+
+    async def test_failed_warm_up(self):
+        def load():
+            raise FileNotFoundError("allergen_model")
+
+        pool = DetectorPool.threaded(LazyDetector(load))
+        try:
+            with self.assertLogs(level="ERROR"):
+                await pool.warm_up()
+            self.assertFalse(pool.ready)
+        finally:
+            pool.shutdown()
+
+    async def test_saturated(self):
+        """Calls beyond the pending limit are rejected rather than queued."""
+        release = threading.Event()
+
+        def blocking_detect_many(recipes):
+            release.wait()
+            return [[] for _ in recipes]
+
+        pool = DetectorPool(
+            ThreadPoolExecutor(max_workers=1), blocking_detect_many, max_pending=2
+        )
+        try:
+            running = [asyncio.create_task(pool.detect(["2 eggs"])) for _ in range(2)]
+            await asyncio.sleep(0)
+            with self.assertRaises(DetectorSaturated):
+                await pool.detect(["2 eggs"])
+
+            release.set()
+            self.assertListEqual(await asyncio.gather(*running), [[], []])
+            self.assertEqual(pool.pending, 0)
+        finally:
+            release.set()
+            pool.shutdown()
+
+    async def test_cancelled_callers_stay_pending(self):
+        """A cancelled call's job still runs, so it counts until it finishes."""
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking_detect_many(recipes):
+            started.set()
+            release.wait()
+            return [[] for _ in recipes]
+
+        pool = DetectorPool(
+            ThreadPoolExecutor(max_workers=1), blocking_detect_many, max_pending=1
+        )
+        try:
+            cancelled = asyncio.create_task(pool.detect(["2 eggs"]))
+            await asyncio.to_thread(started.wait)
+            cancelled.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await cancelled
+
+            self.assertEqual(pool.pending, 1)
+            with self.assertRaises(DetectorSaturated):
+                await pool.detect(["2 eggs"])
+
+            release.set()
+            while pool.pending:
+                await asyncio.sleep(0.01)
+            self.assertListEqual(await pool.detect(["2 eggs"]), [])
+        finally:
+            release.set()
+            pool.shutdown()
+
+
+class TestBatchScheduler(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.batches = []
 
-            for recipe in recipes:
-                ingredients = recipe["ingredients"]
-                detected_allergens = self.detector.detect(ingredients)
-                self.assertListEqual(recipe["allergens"], detected_allergens)
+        def detect_many(recipes):
+            self.batches.append(recipes)
+            return [sorted(ingredients) for ingredients in recipes]
+
+        self.pool = DetectorPool(ThreadPoolExecutor(max_workers=1), detect_many)
+
+    async def asyncTearDown(self):
+        self.pool.shutdown()
+
+    async def test_coalesces_concurrent_requests(self):
+        scheduler = BatchScheduler(self.pool, max_batch_size=10, max_wait_ms=20)
+
+        results = await asyncio.gather(
+            scheduler.detect(["b", "a"]),
+            scheduler.detect(["d", "c"]),
+            scheduler.detect([]),
+        )
+
+        self.assertListEqual(results, [["a", "b"], ["c", "d"], []])
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(scheduler.batch_sizes.count, 1)
+        self.assertEqual(scheduler.batch_sizes.sum, 3)
+        self.assertEqual(scheduler.latencies_ms.count, 3)
+
+    async def test_max_batch_size(self):
+        scheduler = BatchScheduler(self.pool, max_batch_size=2, max_wait_ms=1000)
+
+        results = await asyncio.gather(*[scheduler.detect([f"{i}"]) for i in range(5)])
+
+        self.assertListEqual(results, [[f"{i}"] for i in range(5)])
+        self.assertListEqual([len(batch) for batch in self.batches], [2, 2, 1])
+
+    async def test_errors_reach_every_caller(self):
+        def failing_detect_many(recipes):
+            raise ValueError("model failure")
+
+        pool = DetectorPool(ThreadPoolExecutor(max_workers=1), failing_detect_many)
+        scheduler = BatchScheduler(pool, max_batch_size=10, max_wait_ms=1)
+        try:
+            results = await asyncio.gather(
+                scheduler.detect(["a"]),
+                scheduler.detect(["b"]),
+                return_exceptions=True,
+            )
+            self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        finally:
+            pool.shutdown()
+
+    async def test_saturated(self):
+        scheduler = BatchScheduler(
+            self.pool, max_batch_size=10, max_wait_ms=1000, max_pending=1
+        )
+
+        queued = asyncio.create_task(scheduler.detect(["a"]))
+        await asyncio.sleep(0)
+        with self.assertRaises(DetectorSaturated):
+            await scheduler.detect(["b"])
+
+        await scheduler.drain()
+        self.assertListEqual(await queued, ["a"])
+
+
+class TestHistogram(unittest.TestCase):
+    def test_observe(self):
+        histogram = Histogram([1, 5, 10])
+        for value in [0.5, 1, 3, 10, 50]:
+            histogram.observe(value)
+
+        self.assertDictEqual(
+            histogram.to_dict(),
+            {
+                "buckets": {"1": 2, "5": 1, "10": 1, "+Inf": 1},
+                "count": 5,
+                "sum": 64.5,
+            },
+        )
+
+
+class TestCompiledForest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.vectorizer = joblib.load(VECTORIZER_PATH)
+        cls.model = train_small_model(cls.vectorizer)
+        cls.compiled = CompiledForest.from_sklearn(cls.model)
+
+    def test_parity_with_sklearn(self):
+        """The compiled forest predicts exactly what scikit-learn does."""
+        lines = [
+            ingredient
+            for recipe in load_recipe_samples()
+            for ingredient in recipe["ingredients"]
+        ]
+        input_tfidf = self.vectorizer.transform(lines + ["", "unknown words"])
+
+        np.testing.assert_array_equal(
+            self.compiled.predict(input_tfidf), self.model.predict(input_tfidf)
+        )
+        np.testing.assert_allclose(
+            self.compiled.predict_proba(input_tfidf),
+            np.column_stack(
+                [e.predict_proba(input_tfidf)[:, 1] for e in self.model.estimators_]
+            ),
+        )
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "allergen_model.npz")
+            self.compiled.save(path)
+            loaded = CompiledForest.load(path)
+
+        input_tfidf = self.vectorizer.transform(["2 eggs", "100ml milk", "prawns"])
+        np.testing.assert_array_equal(
+            loaded.predict(input_tfidf), self.model.predict(input_tfidf)
+        )
+
+    def test_memory_mapped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "allergen_model")
+            self.compiled.save(path)
+            loaded = CompiledForest.load(path, mmap_mode="r")
+
+            self.assertIsInstance(loaded.feature, np.memmap)
+            input_tfidf = self.vectorizer.transform(["2 eggs", "prawns", "milk"])
+            np.testing.assert_array_equal(
+                loaded.predict(input_tfidf), self.model.predict(input_tfidf)
+            )
+
+    def test_resolve_model_path(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pickled = os.path.join(directory, "allergen_model.pkl")
+            compiled = os.path.join(directory, "allergen_model")
+            # Only the pickle, as deployed before models were compiled
+            self.assertEqual(resolve_model_path(pickled), pickled)
+
+            self.compiled.save(f"{compiled}.npz")
+            self.assertEqual(resolve_model_path(pickled), f"{compiled}.npz")
+            self.compiled.save(compiled)
+            self.assertEqual(resolve_model_path(pickled), compiled)
+            self.assertEqual(resolve_model_path(f"{compiled}.npz"), f"{compiled}.npz")
+
+    def test_detector_version(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pickled = os.path.join(directory, "allergen_model.pkl")
+            joblib.dump(self.model, pickled)
+            version = detector_version(pickled, VECTORIZER_PATH)
+            self.assertEqual(detector_version(pickled, VECTORIZER_PATH), version)
+
+            # Retraining the model changes the version
+            stat = os.stat(pickled)
+            os.utime(pickled, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+            retrained = detector_version(pickled, VECTORIZER_PATH)
+            self.assertNotEqual(retrained, version)
+            version = retrained
+
+            # Compiling the model swaps the model loaded, which changes the version
+            self.compiled.save(os.path.join(directory, "allergen_model"))
+            self.assertNotEqual(detector_version(pickled, VECTORIZER_PATH), version)
+
+    def test_drop_in_for_detector(self):
+        recipes = [recipe["ingredients"] for recipe in load_recipe_samples()]
+        self.assertListEqual(
+            AllergenDetector(self.compiled, self.vectorizer).detect_many(recipes),
+            AllergenDetector(self.model, self.vectorizer).detect_many(recipes),
+        )
+
+
+class TestKeywordMatcher(unittest.TestCase):
+    def setUp(self):
+        self.matcher = KeywordMatcher(
+            {"butter": 64, "peanut butter": 16, "butter beans": 0, "egg": 4, "eggs": 4}
+        )
+
+    def test_match(self):
+        self.assertEqual(self.matcher.match("2 eggs"), 4)
+        self.assertEqual(self.matcher.match("100g Butter, softened"), 64)
+        self.assertEqual(self.matcher.match("2 eggs and 50g butter"), 68)
+
+    def test_longest_match(self):
+        self.assertEqual(self.matcher.match("1 tbsp peanut butter"), 16)
+        self.assertEqual(self.matcher.match("1 tin butter beans"), 0)
+
+    def test_unknown_words_are_left_for_the_model(self):
+        self.assertIsNone(self.matcher.match("2 duck eggs"))
+        self.assertIsNone(self.matcher.match("eggplant"))
+        self.assertIsNone(self.matcher.match("2 tbsp"))
+        self.assertDictEqual(self.matcher.stats(), {"hits": 0, "misses": 3})
+
+    def test_counts_across_threads(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(self.matcher.match, ["2 eggs", "2 duck eggs"] * 5000))
+        self.assertDictEqual(self.matcher.stats(), {"hits": 5000, "misses": 5000})
+
+    def test_from_csv(self):
+        matcher = KeywordMatcher.from_csv("resources/datasets/allergens_expanded.csv")
+        self.assertEqual(matcher.match("200ml milk"), 1 << 6)
+        self.assertEqual(matcher.match("1 tbsp olive oil"), 0)
+        # Listed with different allergens, so it is ambiguous
+        self.assertIsNone(matcher.match("balsamic vinegar"))
+
+
+class TestHybridDetector(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.vectorizer = joblib.load(VECTORIZER_PATH)
+        cls.model = train_small_model(cls.vectorizer)
+
+    def test_matched_lines_skip_the_model(self):
+        detector = AllergenDetector(
+            self.model,
+            self.vectorizer,
+            cache=IngredientCache(),
+            matcher=KeywordMatcher({"eggs": 4, "butter": 64}),
+        )
+
+        allergens = detector.detect(["2 eggs", "50g butter", "1 tbsp olive oil"])
+
+        self.assertIn("Eggs", allergens)
+        self.assertIn("Milk", allergens)
+        self.assertDictEqual(detector.stats()["matcher"], {"hits": 2, "misses": 1})
+        self.assertEqual(len(detector.cache), 3)
+
+    def test_without_cache(self):
+        detector = AllergenDetector(
+            self.model, self.vectorizer, matcher=KeywordMatcher({"prawns": 2})
+        )
+        self.assertIn("Crustaceans", detector.detect(["200g prawns", "1 lemon"]))
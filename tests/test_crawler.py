@@ -0,0 +1,321 @@
+import asyncio
+import contextlib
+import gzip
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app.crawler import Crawler, FetchError
+from app.utils import CircuitOpen, FetchPolicy, HttpCache
+
+
+class TestCrawler(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        async def page(request: web.Request) -> web.Response:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.02)
+            self.in_flight -= 1
+            return web.Response(text=f"page {request.match_info['n']}")
+
+        async def missing(request: web.Request) -> web.Response:
+            return web.Response(status=404)
+
+        self.robots_fetched = 0
+
+        async def robots(request: web.Request) -> web.Response:
+            self.robots_fetched += 1
+            return web.Response(
+                text="User-agent: *\nDisallow: /private/\nRequest-rate: 20/1"
+            )
+
+        app = web.Application()
+        app.router.add_get("/pages/{n}", page)
+        app.router.add_get("/missing", missing)
+        app.router.add_get("/robots.txt", robots)
+        app.router.add_get("/sitemap.xml", self.sitemap_index)
+        app.router.add_get("/recipes.xml.gz", self.recipes_sitemap)
+        app.router.add_get("/slow.xml", self.slow_sitemap)
+        app.router.add_get("/cached/{n}", self.cached_page)
+        app.router.add_get("/flaky", self.flaky)
+        app.router.add_get("/flaky.xml", self.flaky_sitemap)
+        app.router.add_get("/down", self.down)
+        self.flaky_requests = 0
+        self.cached_requests = []
+        self.slow_sitemap_finished = asyncio.Event()
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+    async def sitemap_index(self, request: web.Request) -> web.Response:
+        sitemaps = "".join(
+            f"<sitemap><loc>{self.url(path)}</loc></sitemap>"
+            for path in ["/recipes.xml.gz", "/missing", "/sitemap.xml"]
+        )
+        return web.Response(
+            body=f"<sitemapindex>{sitemaps}</sitemapindex>".encode("utf-8")
+        )
+
+    async def recipes_sitemap(self, request: web.Request) -> web.Response:
+        locs = [self.url(f"/recipes/{n}") for n in range(3)] + [self.url("/about")]
+        urls = "".join(f"<url><loc>{loc}</loc></url>" for loc in locs)
+        return web.Response(
+            body=gzip.compress(f"<urlset>{urls}</urlset>".encode("utf-8")),
+            content_type="application/x-gzip",
+        )
+
+    async def slow_sitemap(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse()
+        await response.prepare(request)
+        await response.write(b"<urlset><url><loc>https://example.com/1</loc></url>")
+        await self.slow_sitemap_finished.wait()
+        await response.write(b"</urlset>")
+        return response
+
+    async def cached_page(self, request: web.Request) -> web.Response:
+        etag = f'"{request.match_info["n"]}"'
+        if request.headers.get("If-None-Match") == etag:
+            self.cached_requests.append(304)
+            return web.Response(status=304, headers={"ETag": etag})
+        self.cached_requests.append(200)
+        return web.Response(
+            text=f"<urlset></urlset><!-- {etag} -->", headers={"ETag": etag}
+        )
+
+    async def flaky(self, request: web.Request) -> web.Response:
+        self.flaky_requests += 1
+        if self.flaky_requests < 3:
+            return web.Response(status=503, headers={"Retry-After": "0"})
+        return web.Response(text="finally")
+
+    async def flaky_sitemap(self, request: web.Request) -> web.Response:
+        self.flaky_requests += 1
+        if self.flaky_requests < 3:
+            return web.Response(status=503, headers={"Retry-After": "0"})
+        return web.Response(
+            text="<urlset><url><loc>https://example.com/1</loc></url></urlset>"
+        )
+
+    async def down(self, request: web.Request) -> web.Response:
+        return web.Response(status=502)
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    def url(self, path: str) -> str:
+        return str(self.server.make_url(path))
+
+    async def test_fetch(self):
+        async with Crawler("test") as crawler:
+            self.assertEqual(await crawler.fetch(self.url("/pages/1")), "page 1")
+            with self.assertRaises(FetchError) as raised:
+                await crawler.fetch(self.url("/missing"))
+            self.assertEqual(raised.exception.status, 404)
+
+    async def test_crawl_limits_concurrency(self):
+        urls = [self.url(f"/pages/{n}") for n in range(20)]
+        async with Crawler("test", max_concurrency=8, max_per_host=3) as crawler:
+            results = {url: result async for url, result in crawler.crawl(urls)}
+
+        self.assertEqual(set(results), set(urls))
+        self.assertEqual(results[urls[7]], "page 7")
+        self.assertEqual(self.max_in_flight, 3)
+
+    async def test_crawl_yields_exceptions(self):
+        urls = [self.url("/pages/1"), self.url("/missing")]
+        async with Crawler("test") as crawler:
+            results = {url: result async for url, result in crawler.crawl(urls)}
+
+        self.assertEqual(results[urls[0]], "page 1")
+        self.assertIsInstance(results[urls[1]], FetchError)
+
+    async def test_crawl_stops_early(self):
+        urls = (self.url(f"/pages/{n}") for n in range(100))
+        async with Crawler("test", max_concurrency=4, max_per_host=4) as crawler:
+            async with contextlib.aclosing(crawler.crawl(urls)) as results:
+                async for _ in results:
+                    break
+
+        # Only the URLs being scraped were taken from the generator
+        self.assertEqual(len(list(urls)), 96)
+
+    @staticmethod
+    def record_turns(crawler: Crawler) -> list[float]:
+        """Record when each request's turn comes, as the crawler sees it."""
+        turns = []
+        wait_turn = crawler._wait_turn
+
+        async def record(host: str):
+            await wait_turn(host)
+            turns.append(asyncio.get_running_loop().time())
+
+        crawler._wait_turn = record
+        return turns
+
+    def assertSpacedOut(self, turns: list[float], delay: float):
+        gaps = [b - a for a, b in zip(turns, turns[1:])]
+        # Timers may fire up to the loop's clock resolution early
+        resolution = time.get_clock_info("monotonic").resolution
+        self.assertTrue(all(gap >= delay - resolution for gap in gaps), gaps)
+
+    async def test_host_delay(self):
+        urls = [self.url(f"/pages/{n}") for n in range(4)]
+        async with Crawler("test", max_per_host=4, host_delay=0.05) as crawler:
+            turns = self.record_turns(crawler)
+            async for _ in crawler.crawl(urls):
+                pass
+
+        self.assertEqual(len(turns), 4)
+        self.assertSpacedOut(turns, 0.05)
+
+    async def test_allowed(self):
+        async with Crawler("test") as crawler:
+            checks = await asyncio.gather(
+                *(crawler.allowed(self.url(f"/pages/{n}")) for n in range(10)),
+                crawler.allowed(self.url("/private/1")),
+            )
+
+        self.assertEqual(checks, [True] * 10 + [False])
+        self.assertEqual(self.robots_fetched, 1)
+
+    async def test_robots_delay(self):
+        urls = [self.url(f"/pages/{n}") for n in range(4)]
+        async with Crawler("test", max_per_host=4) as crawler:
+            await crawler.allowed(urls[0])
+            turns = self.record_turns(crawler)
+            async for _ in crawler.crawl(urls):
+                pass
+
+        self.assertEqual(len(turns), 4)
+        # The robots.txt asks for a request every 1/20 seconds
+        self.assertSpacedOut(turns, 0.05)
+
+    async def test_walk_sitemap(self):
+        pattern = re.compile(r".*/recipes/\d+$")
+        async with Crawler("test") as crawler:
+            with self.assertLogs(level="WARNING"):
+                urls = [
+                    url
+                    async for url in crawler.walk_sitemap(
+                        self.url("/sitemap.xml"), pattern
+                    )
+                ]
+
+        self.assertEqual(urls, [self.url(f"/recipes/{n}") for n in range(3)])
+
+    async def test_walk_sitemap_streams(self):
+        async with Crawler("test") as crawler:
+            urls = crawler.walk_sitemap(self.url("/slow.xml"))
+            first = await asyncio.wait_for(anext(urls), timeout=1)
+            self.assertEqual(first, "https://example.com/1")
+            self.slow_sitemap_finished.set()
+            self.assertEqual([url async for url in urls], [])
+
+    async def test_sitemap_turns_and_retries(self):
+        policy = FetchPolicy(base_delay=0.01)
+        async with Crawler("test", host_delay=0.05, policy=policy) as crawler:
+            turns = self.record_turns(crawler)
+            urls = [url async for url in crawler.walk_sitemap(self.url("/flaky.xml"))]
+
+        self.assertEqual(urls, ["https://example.com/1"])
+        self.assertEqual(policy.counts["retries"], 2)
+        self.assertEqual(len(turns), 3)
+        self.assertSpacedOut(turns, 0.05)
+
+    async def test_sitemap_circuit_breaker(self):
+        policy = FetchPolicy(base_delay=0.01, failure_threshold=3)
+        async with Crawler("test", policy=policy) as crawler:
+            with self.assertRaises(FetchError):
+                await crawler.fetch(self.url("/down"))
+            with self.assertLogs(level="WARNING"):
+                urls = [
+                    url async for url in crawler.walk_sitemap(self.url("/flaky.xml"))
+                ]
+
+        self.assertEqual(urls, [])
+        self.assertEqual(self.flaky_requests, 0)
+
+    async def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = HttpCache(directory)
+            async with Crawler("test", cache=cache) as crawler:
+                first = await crawler.fetch(self.url("/cached/1"))
+                second = await crawler.fetch(self.url("/cached/1"))
+                sitemaps = [
+                    [url async for url in crawler.walk_sitemap(self.url("/cached/2"))]
+                    for _ in range(2)
+                ]
+            cache.close()
+
+        self.assertEqual(first, second)
+        self.assertEqual(sitemaps, [[], []])
+        self.assertEqual(self.cached_requests, [200, 304, 200, 304])
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    async def test_cache_evicted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = HttpCache(directory)
+            async with Crawler("test", cache=cache) as crawler:
+                await crawler.fetch(self.url("/cached/1"))
+                [url async for url in crawler.walk_sitemap(self.url("/cached/2"))]
+                # The bodies are evicted after their validators are read
+                shutil.rmtree(os.path.join(directory, "bodies"))
+                os.makedirs(os.path.join(directory, "bodies"))
+                text = await crawler.fetch(self.url("/cached/1"))
+                sitemap = [
+                    url async for url in crawler.walk_sitemap(self.url("/cached/2"))
+                ]
+            cache.close()
+
+        self.assertEqual(text, '<urlset></urlset><!-- "1" -->')
+        self.assertEqual(sitemap, [])
+        self.assertEqual(self.cached_requests, [200, 200, 304, 200, 304, 200])
+        self.assertEqual(crawler.failed, 0)
+
+    async def test_retries(self):
+        policy = FetchPolicy(base_delay=0.01)
+        async with Crawler("test", policy=policy) as crawler:
+            self.assertEqual(await crawler.fetch(self.url("/flaky")), "finally")
+
+        self.assertEqual(self.flaky_requests, 3)
+        self.assertEqual(policy.counts["retries"], 2)
+
+    async def test_circuit_breaker(self):
+        policy = FetchPolicy(base_delay=0.01, failure_threshold=3)
+        async with Crawler("test", policy=policy) as crawler:
+            with self.assertRaises(FetchError) as raised:
+                await crawler.fetch(self.url("/down"))
+            self.assertEqual(raised.exception.status, 502)
+            with self.assertRaises(CircuitOpen):
+                await crawler.fetch(self.url("/pages/1"))
+
+        self.assertEqual(policy.counts["failures"], 3)
+        self.assertEqual(crawler.failed, 2)
+
+    async def test_cancelled_trial(self):
+        now = 0
+        policy = FetchPolicy(
+            base_delay=0.01, failure_threshold=3, reset_after=30, clock=lambda: now
+        )
+        async with Crawler("test", policy=policy) as crawler:
+            with self.assertRaises(FetchError):
+                await crawler.fetch(self.url("/down"))
+
+            # The trial request is cancelled while the page downloads
+            now = 31
+            trial = asyncio.create_task(crawler.fetch(self.url("/slow.xml")))
+            await asyncio.sleep(0.05)
+            trial.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await trial
+
+            self.assertEqual(await crawler.fetch(self.url("/pages/1")), "page 1")
+        self.assertEqual(policy.stats()["open_circuits"], [])
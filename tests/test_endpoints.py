@@ -0,0 +1,179 @@
+import json
+import unittest
+from unittest import mock
+
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from app.config import WEBHOOK_API_KEY
+from app.endpoints import Endpoints
+from app.models import Recipe
+
+
+def recipe_item(recipe_id: str, **fields) -> dict:
+    return {
+        "_id": recipe_id,
+        "site_name": "BBCFood",
+        "url": f"https://www.bbc.co.uk/food/recipes/{recipe_id}",
+        "image_url": "",
+        "name": "Pancakes",
+        "description": "",
+        "cook_time": "PT10M",
+        "cuisine": [],
+        "diet": [],
+        "ingredients": ["2 eggs", "100ml milk"],
+        "allergens": [],
+        **fields,
+    }
+
+
+class FakeRecipeService:
+    """Saves recipes in memory, failing the given IDs."""
+
+    def __init__(self, unchanged: dict = None, failing: set[str] = frozenset()):
+        self.unchanged = unchanged or {}
+        self.failing = failing
+        self.saved = []
+
+    async def find_unchanged(self, recipes: list[Recipe]) -> dict[str, list[str]]:
+        return {
+            recipe.id: self.unchanged[recipe.id]
+            for recipe in recipes
+            if recipe.id in self.unchanged
+        }
+
+    async def upsert_many(self, recipes: list[Recipe]) -> dict[int, str]:
+        self.saved.append(recipes)
+        return {
+            i: "write failed"
+            for i, recipe in enumerate(recipes)
+            if recipe.id in self.failing
+        }
+
+
+class FakeDetector:
+    """Detects eggs in every recipe."""
+
+    async def detect_many(self, recipes: list[list[str]]) -> list[list[str]]:
+        return [["Eggs"] for _ in recipes]
+
+
+class TestSyncRecipes(unittest.TestCase):
+    def client(self, service: FakeRecipeService) -> TestClient:
+        endpoints = Endpoints(service, FakeDetector(), templates=None)
+        app = Starlette(
+            routes=[Route("/bulk", endpoints.sync_recipes, methods=["POST"])]
+        )
+        return TestClient(app)
+
+    def post(self, service, body: str, content_type: str = "application/json"):
+        return self.client(service).post(
+            "/bulk",
+            content=body,
+            headers={
+                "Authorization": f"Bearer {WEBHOOK_API_KEY}",
+                "Content-Type": content_type,
+            },
+        )
+
+    def test_json(self):
+        service = FakeRecipeService()
+        response = self.post(service, json.dumps([recipe_item("a"), recipe_item("b")]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["results"],
+            [
+                {"_id": "a", "status": "saved", "allergens": ["Eggs"]},
+                {"_id": "b", "status": "saved", "allergens": ["Eggs"]},
+            ],
+        )
+
+    def test_ndjson(self):
+        service = FakeRecipeService()
+        body = "\n".join(json.dumps(recipe_item(i)) for i in ["a", "b"]) + "\n\n"
+        response = self.post(service, body, "application/x-ndjson")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([recipe.id for recipe in service.saved[0]], ["a", "b"])
+
+    def test_not_an_array(self):
+        service = FakeRecipeService()
+        for body in [json.dumps(recipe_item("a")), "not json"]:
+            response = self.post(service, body)
+            self.assertEqual(response.status_code, 400)
+        response = self.post(service, "{not json", "application/x-ndjson")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(service.saved, [])
+
+    def test_too_many(self):
+        service = FakeRecipeService()
+        with mock.patch("app.endpoints.BULK_MAX_RECIPES", 2):
+            response = self.post(
+                service, json.dumps([recipe_item(i) for i in ["a", "b", "c"]])
+            )
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(service.saved, [])
+
+    def test_invalid_items(self):
+        service = FakeRecipeService()
+        item_without_id = recipe_item("c")
+        del item_without_id["_id"]
+        item_without_name = recipe_item("b")
+        del item_without_name["name"]
+        response = self.post(
+            service,
+            json.dumps(["a", item_without_name, item_without_id, recipe_item("d")]),
+        )
+
+        results = response.json()["results"]
+        self.assertEqual(
+            [result["status"] for result in results],
+            ["invalid", "invalid", "invalid", "saved"],
+        )
+        self.assertEqual(results[1]["error"], "Invalid fields: name")
+        self.assertEqual([recipe.id for recipe in service.saved[0]], ["d"])
+
+    def test_unchanged_and_errors(self):
+        service = FakeRecipeService(unchanged={"a": ["Milk"]}, failing={"c"})
+        response = self.post(
+            service, json.dumps([recipe_item(i) for i in ["a", "b", "c"]])
+        )
+
+        self.assertEqual(
+            response.json()["results"],
+            [
+                {"_id": "a", "status": "unchanged", "allergens": ["Milk"]},
+                {"_id": "b", "status": "saved", "allergens": ["Eggs"]},
+                {"_id": "c", "status": "error", "error": "write failed"},
+            ],
+        )
+        self.assertEqual([recipe.id for recipe in service.saved[0]], ["b", "c"])
+
+    def test_duplicates(self):
+        service = FakeRecipeService()
+        items = [
+            recipe_item("a", name="Pancakes"),
+            recipe_item("b"),
+            recipe_item("a", name="Crepes"),
+        ]
+        response = self.post(service, json.dumps(items))
+
+        self.assertEqual(
+            response.json()["results"],
+            [
+                {"_id": "a", "status": "duplicate"},
+                {"_id": "b", "status": "saved", "allergens": ["Eggs"]},
+                {"_id": "a", "status": "saved", "allergens": ["Eggs"]},
+            ],
+        )
+        self.assertEqual(
+            [(recipe.id, recipe.name) for recipe in service.saved[0]],
+            [("b", "Pancakes"), ("a", "Crepes")],
+        )
+
+    def test_unauthorized(self):
+        response = self.client(FakeRecipeService()).post("/bulk", content="[]")
+        self.assertEqual(response.status_code, 401)
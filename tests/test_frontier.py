@@ -0,0 +1,77 @@
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from app.frontier import Frontier, url_id
+
+
+class TestFrontier(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "frontier.sqlite")
+        self.frontier = Frontier(self.path, recrawl_after=3600, max_attempts=2)
+
+    def tearDown(self):
+        self.frontier.close()
+        self.directory.cleanup()
+
+    def test_url_id(self):
+        self.assertEqual(
+            url_id("https://example.com/"),
+            "0f115db062b7c0dd030b16878c99dea5c354b49dc37b38eb8846179c7783e9d7",
+        )
+
+    def test_posted_is_settled(self):
+        url = "https://example.com/1"
+        self.assertIsNone(self.frontier.settled(url))
+
+        for state in ["seen", "fetched", "parsed"]:
+            self.frontier.mark(url, state, "Example")
+            self.assertIsNone(self.frontier.settled(url))
+
+        self.frontier.mark_many([url], "posted")
+        self.assertEqual(self.frontier.settled(url), "posted")
+        self.assertEqual(self.frontier.counts("Example")["posted"], 1)
+
+    def test_failures_are_retried(self):
+        url = "https://example.com/1"
+        self.frontier.mark(url, "failed", "Example", error="Timed out")
+        self.assertIsNone(self.frontier.settled(url))
+
+        self.frontier.mark(url, "seen")
+        self.frontier.mark(url, "failed", error="Timed out")
+        self.assertEqual(self.frontier.settled(url), "failed")
+
+    def test_recrawls(self):
+        url = "https://example.com/1"
+        self.frontier.mark(url, "posted")
+
+        later = time.time() + 3601
+        with mock.patch("app.frontier.time.time", return_value=later):
+            self.assertIsNone(self.frontier.settled(url))
+
+    def test_persists(self):
+        self.frontier.mark("https://example.com/1", "posted", "Example")
+        self.frontier.close()
+
+        self.frontier = Frontier(self.path, recrawl_after=3600)
+
+        self.assertEqual(self.frontier.settled("https://example.com/1"), "posted")
+        self.assertEqual(
+            self.frontier.counts(),
+            {"seen": 0, "fetched": 0, "parsed": 0, "posted": 1, "failed": 0},
+        )
+
+    def test_unknown_state(self):
+        with self.assertRaises(ValueError):
+            self.frontier.mark("https://example.com/1", "done")
+
+    def test_threads(self):
+        urls = [f"https://example.com/{n}" for n in range(40)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda url: self.frontier.mark(url, "posted"), urls))
+
+        self.assertEqual(self.frontier.counts()["posted"], 40)
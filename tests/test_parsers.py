@@ -1,3 +1,4 @@
+import json
 import unittest
 
 from app.parsers import SchemaOrgParser
@@ -46,3 +47,80 @@ class TestSchemaOrgParser(unittest.TestCase):
         parser = SchemaOrgParser()
         recipe = parser.parse(content)
         self.assertIsNone(recipe)
+
+
+def recipe_page(recipe: dict) -> str:
+    """Build a page for a sample recipe, with the clutter of a real one."""
+    schema = {
+        "@context": "https://schema.org",
+        "@type": "Recipe",
+        "name": recipe["name"].lower().replace("'", "&#39;"),
+        "description": f"<p>{recipe['description']}</p>",
+        "cookTime": "PT1H5M",
+        "recipeCuisine": ", ".join(recipe["cuisine"]),
+        "suitableForDiet": ["https://schema.org/VegetarianDiet"],
+        "image": {"url": recipe["image_url"]},
+        "recipeIngredient": [
+            f"<a href='/food/{n}'>{ingredient}</a> &amp; more"
+            for n, ingredient in enumerate(recipe["ingredients"])
+        ],
+    }
+    return f"""<!DOCTYPE html>
+        <html><head>
+            <title>{recipe["name"]} | Recipes</title>
+            <style>body {{ font-family: serif; }}</style>
+            <!-- <script type="application/ld+json">{{"@type": "Recipe"}}</script> -->
+            <script>document.write("<script type='application/ld+json'></script>")</script>
+            <SCRIPT TYPE="application/json">{{"@type": "Recipe"}}</SCRIPT>
+        </head><body>
+            <div class="banner" data-html='<script type="application/ld+json">'>
+            <p>{"Lorem ipsum dolor sit amet. " * 50}</p>
+            <Script
+                data-id="recipe" type="application/ld+json">{json.dumps(schema)}</Script >
+        </body></html>"""
+
+
+class TestSchemaOrgParserParity(unittest.TestCase):
+    def setUp(self):
+        self.fast_parser = SchemaOrgParser()
+        self.tree_parser = SchemaOrgParser(fast=False)
+
+    def assertParity(self, content: str):
+        fast_recipe = self.fast_parser.parse(content)
+        tree_recipe = self.tree_parser.parse(content)
+        self.assertEqual(
+            fast_recipe.model_dump() if fast_recipe else None,
+            tree_recipe.model_dump() if tree_recipe else None,
+        )
+        return fast_recipe
+
+    def test_sample_recipes(self):
+        with open("resources/datasets/recipe_samples.json") as file:
+            samples = json.load(file)
+
+        for sample in samples:
+            with self.subTest(sample["name"]):
+                recipe = self.assertParity(recipe_page(sample))
+                self.assertIsNotNone(recipe)
+                self.assertEqual(len(recipe.ingredients), len(sample["ingredients"]))
+
+    def test_edge_cases(self):
+        recipe = '{"@type": "Recipe", "name": "a", "description": "b", "recipeIngredient": []}'
+        pages = [
+            "",
+            "<script type='application/ld+json'>",
+            f"<script type='application/ld+json'>{recipe}",
+            f"<script type='application/ld+json'>  </script>{recipe}",
+            f"<script type='application/ld+json'/><script type='application/ld+json'>{recipe}</script>",
+            f"<script type='application/ld&#43;json'>{recipe}</script>",
+            f"<script type='application/ld+json' type='text/plain'>{recipe}</script>",
+            f"<script type=application/ld+json>{recipe}</script>",
+            f"<!-- unclosed <script type='application/ld+json'>{recipe}</script>",
+            f"<![CDATA[<script type='application/ld+json'>]]>{recipe}</script>",
+            f"<style><script type='application/ld+json'>{recipe}</script></style>",
+            f"<p title='<script type=\"application/ld+json\">'>{recipe}</script>",
+            f"<scripts type='application/ld+json'>{recipe}</scripts>",
+        ]
+        for page in pages:
+            with self.subTest(page):
+                self.assertParity(page)
@@ -0,0 +1,138 @@
+import json
+import os
+import re
+import tempfile
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app.crawler import Crawler
+from app.frontier import Frontier
+from app.models import RecipeWebsite
+from app.pipeline import ScrapePipeline
+
+
+def recipe_page(n: int) -> str:
+    recipe = {
+        "@type": "Recipe",
+        "name": f"recipe {n}",
+        "description": "A recipe",
+        "recipeIngredient": ["200g flour", "2 eggs"],
+    }
+    return f'<script type="application/ld+json">{json.dumps(recipe)}</script>'
+
+
+class TestScrapePipeline(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        async def sitemap(request: web.Request) -> web.Response:
+            site = request.match_info["site"]
+            urls = "".join(
+                f"<url><loc>{self.url(f'/{site}/recipes/{n}')}</loc></url>"
+                for n in range(int(request.query["pages"]))
+            )
+            return web.Response(body=f"<urlset>{urls}</urlset>".encode("utf-8"))
+
+        async def page(request: web.Request) -> web.Response:
+            n = int(request.match_info["n"])
+            self.fetched.append(n)
+            if n == 3:
+                return web.Response(status=404)
+            if n == 4:
+                return web.Response(text="<html>Not a recipe</html>")
+            return web.Response(text=recipe_page(n))
+
+        app = web.Application()
+        app.router.add_get("/{site}/sitemap.xml", sitemap)
+        app.router.add_get("/{site}/recipes/{n}", page)
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+        self.batches = []
+        self.fetched = []
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    def url(self, path: str) -> str:
+        return str(self.server.make_url(path))
+
+    def site(self, name: str, pages: int, max_links: int = 100) -> RecipeWebsite:
+        return RecipeWebsite(
+            name=name,
+            host=self.url(f"/{name}"),
+            sitemap_url=self.url(f"/{name}/sitemap.xml?pages={pages}"),
+            robots_url=self.url("/robots.txt"),
+            recipe_url_pattern=re.compile(".*"),
+            max_links=max_links,
+        )
+
+    async def sink(self, recipes):
+        self.batches.append(recipes)
+        # Every fifth recipe can't be saved
+        return [recipe for recipe in recipes if recipe.name.endswith("5")]
+
+    async def test_run(self):
+        async with Crawler("test") as crawler:
+            pipeline = ScrapePipeline.multiprocess(
+                crawler, self.sink, workers=2, batch_size=4
+            )
+            try:
+                stats = await pipeline.run([self.site("a", 10), self.site("b", 6)])
+            finally:
+                pipeline.shutdown()
+
+        self.assertEqual(stats["a"], {"parsed": 8, "scraped": 7, "failed": 2})
+        self.assertEqual(stats["b"], {"parsed": 4, "scraped": 3, "failed": 2})
+        self.assertTrue(all(len(batch) <= 4 for batch in self.batches))
+
+        recipes = {recipe.url: recipe for batch in self.batches for recipe in batch}
+        self.assertEqual(len(recipes), 12)
+        recipe = recipes[self.url("/a/recipes/7")]
+        self.assertEqual(recipe.name, "Recipe 7")
+        self.assertEqual(recipe.site_name, "a")
+        self.assertEqual(len(recipe.id), 64)
+
+    async def test_max_links(self):
+        async with Crawler("test", max_concurrency=4) as crawler:
+            pipeline = ScrapePipeline.multiprocess(
+                crawler, self.sink, workers=2, batch_size=4
+            )
+            try:
+                stats = await pipeline.run([self.site("a", 200, max_links=10)])
+            finally:
+                pipeline.shutdown()
+
+        # Recipe 5 couldn't be saved, so another was scraped in its place
+        self.assertEqual(stats["a"]["scraped"], 10)
+        self.assertEqual(stats["a"]["parsed"], 11)
+        self.assertEqual(sum(len(batch) for batch in self.batches), 11)
+
+    async def test_resumes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            frontier = Frontier(os.path.join(directory, "frontier.sqlite"))
+            stats = []
+            for max_links in [5, 8]:
+                self.fetched = []
+                async with Crawler("test", max_concurrency=1) as crawler:
+                    pipeline = ScrapePipeline.multiprocess(
+                        crawler, self.sink, workers=1, frontier=frontier
+                    )
+                    try:
+                        site = self.site("a", 20, max_links=max_links)
+                        stats.append(await pipeline.run([site]))
+                    finally:
+                        pipeline.shutdown()
+            counts = frontier.counts("a")
+            frontier.close()
+
+        # The first run saved recipes 0, 1, 2, 6 and 7, but not 5
+        self.assertEqual(stats[0]["a"]["parsed"], 6)
+        self.assertEqual(stats[0]["a"]["scraped"], 5)
+        # The second skipped the saved recipes, counting them towards its
+        # max_links, but tried the failed pages again
+        self.assertEqual(stats[1]["a"]["skipped"], 5)
+        self.assertEqual(stats[1]["a"]["scraped"], 3)
+        self.assertEqual(self.fetched[:6], [3, 4, 5, 8, 9, 10])
+        self.assertEqual(counts["posted"], 8)
+        self.assertEqual(counts["failed"], 3)
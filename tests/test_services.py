@@ -0,0 +1,716 @@
+import asyncio
+import datetime
+import unittest
+from typing import Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from app.services import (
+    encode_cursor,
+    decode_cursor,
+    FacetCache,
+    FACET_FIELDS,
+    RecipeService,
+    WriteBehindBuffer,
+    WriteBufferFull,
+)
+from app.models import AllergenGroup, Recipe, RecipeFilters
+
+
+class TestCursors(unittest.TestCase):
+    def test_round_trip(self):
+        recipe_id = "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
+        for direction in ["after", "before"]:
+            cursor = encode_cursor(direction, recipe_id)
+            self.assertEqual(decode_cursor(cursor), (direction, recipe_id))
+
+    def test_cursor_is_url_safe(self):
+        cursor = encode_cursor("after", "a?b&c=d/e+f")
+        self.assertRegex(cursor, r"^[A-Za-z0-9_-]+$")
+
+    def test_invalid_cursors(self):
+        self.assertIsNone(decode_cursor("not a cursor"))
+        self.assertIsNone(decode_cursor(""))
+        self.assertIsNone(decode_cursor(encode_cursor("sideways", "abc")))
+        self.assertIsNone(decode_cursor("WzEsIDJd"))  # [1, 2]
+
+
+class TestFacetCache(unittest.TestCase):
+    def test_expires(self):
+        cache = FacetCache(ttl=60)
+        self.assertIsNone(cache.get())
+        self.assertIsNone(cache.age)
+
+        cache.put({"cuisines": ["Italian"]})
+        self.assertEqual(cache.get(), {"cuisines": ["Italian"]})
+
+        cache.fetched_at -= 61
+        self.assertIsNone(cache.get())
+
+    def test_add(self):
+        cache = FacetCache()
+        cache.add({"cuisines": {"Thai"}})
+        self.assertIsNone(cache.get())
+
+        cache.put({"cuisines": ["Italian"], "diets": []})
+        cache.add({"cuisines": {"Italian", "Thai"}, "diets": {"Vegan"}})
+        filters = cache.get()
+        self.assertCountEqual(filters["cuisines"], ["Italian", "Thai"])
+        self.assertEqual(filters["diets"], ["Vegan"])
+
+    def test_counts(self):
+        cache = FacetCache(ttl=60)
+        cache.put({"cuisines": ["Italian"]})
+        self.assertIsNone(cache.get_counts())
+
+        cache.put({"cuisines": ["Italian"]}, {"cuisines": {"Italian": 2}}, 3)
+        self.assertEqual(cache.get_counts(), {"cuisines": {"Italian": 2}})
+        self.assertEqual(cache.get_total(), 3)
+
+        cache.fetched_at -= 61
+        self.assertIsNone(cache.get_counts())
+        self.assertIsNone(cache.get_total())
+
+    def test_invalidate(self):
+        cache = FacetCache()
+        cache.put({"cuisines": ["Italian"]}, {"cuisines": {"Italian": 2}})
+        cache.invalidate()
+        self.assertIsNone(cache.get())
+        self.assertIsNone(cache.get_counts())
+
+
+class TestFacetValues(unittest.TestCase):
+    def test_facet_values(self):
+        values = RecipeService._facet_values(
+            {
+                "site_name": "BBC Food",
+                "cuisine": ["Italian", None],
+                "cook_time": None,
+                "diet": [],
+            }
+        )
+        self.assertEqual(
+            values,
+            {
+                "site_names": {"BBC Food"},
+                "cuisines": {"Italian"},
+                "cook_times": set(),
+                "diets": set(),
+            },
+        )
+
+    def test_missing_recipe(self):
+        values = RecipeService._facet_values(None)
+        self.assertEqual(values, {key: set() for key in FACET_FIELDS})
+
+
+class TestCursorPages(unittest.TestCase):
+    def setUp(self):
+        self.recipes = [{"_id": f"{i:03d}"} for i in range(25)]
+
+    def find(self, cursor, limit=10):
+        """Find a page of the recipes, as the database would."""
+        direction, seek, sort = RecipeService._seek(cursor)
+        recipes = sorted(self.recipes, key=lambda r: r["_id"], reverse=sort < 0)
+        if "$lt" in seek.get("_id", {}):
+            recipes = [r for r in recipes if r["_id"] < seek["_id"]["$lt"]]
+        if "$gt" in seek.get("_id", {}):
+            recipes = [r for r in recipes if r["_id"] > seek["_id"]["$gt"]]
+        return RecipeService._cursor_page(
+            recipes[: limit + 1], len(self.recipes), direction, limit
+        )
+
+    def ids(self, page):
+        return [recipe["_id"] for recipe in page.results]
+
+    def test_pages_forwards_and_backwards(self):
+        first = self.find(None)
+        self.assertEqual(self.ids(first), [f"{i:03d}" for i in range(24, 14, -1)])
+        self.assertIsNone(first.prev_cursor)
+
+        second = self.find(first.next_cursor)
+        self.assertEqual(self.ids(second), [f"{i:03d}" for i in range(14, 4, -1)])
+
+        last = self.find(second.next_cursor)
+        self.assertEqual(self.ids(last), [f"{i:03d}" for i in range(4, -1, -1)])
+        self.assertIsNone(last.next_cursor)
+
+        back = self.find(last.prev_cursor)
+        self.assertEqual(self.ids(back), self.ids(second))
+        self.assertIsNotNone(back.next_cursor)
+
+        start = self.find(back.prev_cursor)
+        self.assertEqual(self.ids(start), self.ids(first))
+        self.assertIsNone(start.prev_cursor)
+        self.assertEqual(start.next_cursor, first.next_cursor)
+
+    def test_invalid_cursor(self):
+        first = self.find(None)
+        for cursor in ["garbage", encode_cursor("after", "024")[:-3], "WzEsIDJd"]:
+            page = self.find(cursor)
+            self.assertEqual(self.ids(page), self.ids(first))
+            self.assertIsNone(page.prev_cursor)
+
+    def test_single_page(self):
+        page = self.find(None, limit=30)
+        self.assertEqual(len(page.results), 25)
+        self.assertIsNone(page.next_cursor)
+        self.assertIsNone(page.prev_cursor)
+
+
+class FakeCursor:
+    """A database cursor over a list of documents."""
+
+    def __init__(self, documents: list):
+        self.documents = documents
+
+    async def to_list(self, length=None):
+        return self.documents[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            yield document
+
+
+class FakeCollection:
+    """
+    Records the pipelines aggregated, answering each with the given documents,
+    or those ending in ``$facet`` with the given facets.
+    """
+
+    def __init__(self, results: list = (), facet_results: Optional[list] = None):
+        self.results = list(results)
+        self.facet_results = facet_results
+        self.pipelines = []
+        self.requests = []
+        # The errors of the writes a bulk write fails, by index
+        self.write_errors = []
+        # The IDs of the documents whose single writes fail
+        self.failing = set()
+
+    def aggregate(self, pipeline: list) -> FakeCursor:
+        self.pipelines.append(pipeline)
+        if self.facet_results is not None and "$facet" in pipeline[-1]:
+            return FakeCursor(self.facet_results)
+        return FakeCursor(self.results)
+
+    async def count_documents(self, query: dict) -> int:
+        return len(self.results)
+
+    def find(self, query: dict = None, projection: dict = None) -> FakeCursor:
+        return FakeCursor(self.results)
+
+    async def bulk_write(self, requests: list, ordered: bool = True):
+        self.requests.extend(requests)
+        if self.write_errors:
+            raise BulkWriteError({"writeErrors": self.write_errors})
+
+    async def create_indexes(self, indexes: list) -> list[str]:
+        self.indexes = indexes
+        return [index.document["name"] for index in indexes]
+
+    async def find_one_and_update(self, query: dict, update: dict, **kwargs):
+        """Upsert a document from the given ones, returning it as it was."""
+        self.requests.append((query, update))
+        documents = {document["_id"]: document for document in self.results}
+        if query["_id"] in self.failing:
+            raise OperationFailure(f"{query['_id']} failed")
+        previous = documents.get(query["_id"])
+        self.results = [d for d in self.results if d["_id"] != query["_id"]]
+        self.results.append({"_id": query["_id"], **update["$set"]})
+        return previous
+
+
+class TestIndexes(unittest.IsolatedAsyncioTestCase):
+    async def test_create_indexes(self):
+        recipes = FakeCollection()
+        names = await RecipeService({"recipes": recipes}).create_indexes()
+
+        self.assertEqual(
+            [index.document["key"] for index in recipes.indexes],
+            [
+                {"site_name": 1, "_id": -1},
+                {"cuisine": 1, "_id": -1},
+                {"diet": 1, "_id": -1},
+                {"cook_time": 1, "_id": -1},
+                {"_id": -1, "allergen_mask": 1},
+            ],
+        )
+        self.assertEqual(names[0], "site_name_1__id_-1")
+
+    def test_every_filter_is_indexed(self):
+        """Each filtered field leads an index, followed by the sort key."""
+        filters = RecipeFilters(
+            site_name=["BBCFood"],
+            cuisine=["Thai"],
+            diet=["Vegan"],
+            cook_time=["PT10M"],
+            allergen=["Eggs"],
+        )
+        keys = [list(index.document["key"]) for index in RecipeService.INDEXES]
+        for field in RecipeService._matchers(filters):
+            self.assertTrue([field, "_id"] in keys or ["_id", field] in keys, field)
+
+
+class TestInvalidCursor(unittest.IsolatedAsyncioTestCase):
+    async def test_find_page(self):
+        recipes = FakeCollection([{"_id": "b"}, {"_id": "a"}])
+        service = RecipeService({"recipes": recipes})
+
+        page = await service.find_page(RecipeFilters(), limit=10, cursor="garbage")
+
+        self.assertEqual(recipes.pipelines[0][0], {"$match": {}})
+        self.assertEqual(page.results, [{"_id": "b"}, {"_id": "a"}])
+        self.assertIsNone(page.prev_cursor)
+
+    async def test_find_page_with_facets(self):
+        recipes = FakeCollection(
+            [{"_id": "a"}],
+            [{"total": [{"count": 1}], **{key: [] for key in FACET_FIELDS}}],
+        )
+        service = RecipeService({"recipes": recipes})
+
+        page = await service.find_page_with_facets(
+            RecipeFilters(cuisine=["Thai"]), limit=10, cursor="garbage"
+        )
+
+        self.assertEqual(
+            recipes.pipelines[0][0], {"$match": {"cuisine": {"$in": ["Thai"]}}}
+        )
+        self.assertEqual(page.results, [{"_id": "a"}])
+
+
+class TestUnfilteredFacetCounts(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.counts = {key: {} for key in FACET_FIELDS} | {"cuisines": {"Thai": 3}}
+        self.recipes = FakeCollection(
+            [{"_id": "a"}],
+            [
+                {
+                    "total": [{"count": 3}],
+                    **{key: [] for key in FACET_FIELDS},
+                    "cuisines": [{"_id": "Thai", "count": 3}],
+                }
+            ],
+        )
+
+    def counted(self) -> bool:
+        """Check if the last request counted the filter values."""
+        return "$facet" in self.recipes.pipelines[-1][-1]
+
+    def assertSeeksWithIndex(self):
+        """Check the page was found by the outer match, sort and limit."""
+        page = self.recipes.pipelines[0]
+        self.assertEqual(
+            [list(stage) for stage in page], [["$match"], ["$sort"], ["$limit"]]
+        )
+
+    async def test_counts_once_then_cached(self):
+        cache = FacetCache()
+        service = RecipeService({"recipes": self.recipes}, facet_cache=cache)
+
+        first = await service.find_page_with_facets(RecipeFilters(), limit=10)
+        self.assertTrue(self.counted())
+        self.assertSeeksWithIndex()
+        self.assertEqual(cache.get_counts(), self.counts)
+        self.assertEqual(cache.get_total(), 3)
+
+        second = await service.find_page_with_facets(RecipeFilters(), limit=10)
+        self.assertFalse(self.counted())
+        self.assertEqual(first.facets, self.counts)
+        self.assertEqual(second.facets, self.counts)
+        self.assertEqual(second.results, [{"_id": "a"}])
+        self.assertEqual(second.total, 3)
+
+    async def test_materialized(self):
+        facets = FakeCollection(
+            [
+                {"_id": "_meta", "rebuilt_at": datetime.datetime.now(), "total": 4},
+                {
+                    "_id": "cuisines:Thai",
+                    "key": "cuisines",
+                    "value": "Thai",
+                    "count": 3,
+                },
+            ]
+        )
+        service = RecipeService(
+            {"recipes": self.recipes, "facets": facets}, materialized_facets=True
+        )
+
+        page = await service.find_page_with_facets(RecipeFilters(), limit=10)
+        self.assertFalse(self.counted())
+        self.assertEqual(len(self.recipes.pipelines), 1)
+        self.assertEqual(page.facets, self.counts)
+        self.assertEqual(page.total, 4)
+
+    async def test_filtered(self):
+        cache = FacetCache()
+        cache.put({"cuisines": ["Thai"]}, self.counts)
+        service = RecipeService({"recipes": self.recipes}, facet_cache=cache)
+
+        await service.find_page_with_facets(RecipeFilters(cuisine=["Thai"]), limit=10)
+        self.assertTrue(self.counted())
+        self.assertSeeksWithIndex()
+
+
+class TestMaterializedFacets(unittest.IsolatedAsyncioTestCase):
+    def service(self, facets: list) -> RecipeService:
+        aggregated = {"site_names": ["BBCFood", "Food"], "cuisines": ["Thai"]}
+        return RecipeService(
+            {"recipes": FakeCollection([aggregated]), "facets": FakeCollection(facets)},
+            materialized_facets=True,
+        )
+
+    async def test_upserted_before_rebuild(self):
+        # Upserts have counted a single recipe, but the collection isn't built
+        service = self.service(
+            [
+                {"_id": "_meta", "updated_at": datetime.datetime.now()},
+                {
+                    "_id": "site_names:Food",
+                    "key": "site_names",
+                    "value": "Food",
+                    "count": 1,
+                },
+            ]
+        )
+        with self.assertLogs(level="WARNING"):
+            filters = await service.find_available_filters()
+
+        self.assertEqual(filters["site_names"], ["BBCFood", "Food"])
+
+    async def test_rebuilt(self):
+        now = datetime.datetime.now()
+        service = self.service(
+            [
+                {"_id": "_meta", "rebuilt_at": now, "updated_at": now, "total": 1},
+                {
+                    "_id": "site_names:Food",
+                    "key": "site_names",
+                    "value": "Food",
+                    "count": 1,
+                },
+                {
+                    "_id": "cuisines:Thai",
+                    "key": "cuisines",
+                    "value": "Thai",
+                    "count": 0,
+                },
+            ]
+        )
+        filters = await service.find_available_filters()
+
+        self.assertEqual(filters["site_names"], ["Food"])
+        self.assertEqual(filters["cuisines"], [])
+
+    async def test_counts_new_recipes(self):
+        service = self.service([])
+        document = {"site_name": "Food", "cuisine": ["Thai"]}
+        await service._update_facets([(None, document), (document, document)])
+
+        meta = service.db["facets"].requests[-1]
+        self.assertEqual(meta._filter, {"_id": "_meta"})
+        self.assertEqual(meta._doc["$inc"], {"total": 1})
+
+
+class TestAllergenMask(unittest.TestCase):
+    def test_round_trip(self):
+        allergens = ["Sesame", "Eggs", "Milk", "Eggs", "Unknown"]
+        mask = AllergenGroup.to_mask(allergens)
+        self.assertEqual(mask, (1 << 2) | (1 << 6) | (1 << 10))
+        self.assertEqual(AllergenGroup.from_mask(mask), ["Eggs", "Milk", "Sesame"])
+
+    def test_every_allergen(self):
+        mask = AllergenGroup.to_mask(AllergenGroup.to_list())
+        self.assertEqual(mask, (1 << 14) - 1)
+        self.assertEqual(AllergenGroup.to_mask([]), 0)
+
+    def test_matchers(self):
+        filters = RecipeFilters(allergen=["Gluten", "Milk"], cuisine=["Italian"])
+        self.assertEqual(
+            RecipeService._matchers(filters),
+            {
+                "allergen_mask": {"$bitsAllClear": (1 << 0) | (1 << 6)},
+                "cuisine": {"$in": ["Italian"]},
+            },
+        )
+
+
+def make_recipe(recipe_id: str, name: str = "Pancakes") -> Recipe:
+    return Recipe(
+        _id=recipe_id,
+        site_name="BBCFood",
+        url=f"https://www.bbc.co.uk/food/recipes/{recipe_id}",
+        image_url="",
+        name=name,
+        description="",
+        cook_time="PT10M",
+        cuisine=[],
+        diet=[],
+        ingredients=["2 eggs", "100ml milk"],
+        allergens=[],
+    )
+
+
+class RecordingRecipeService:
+    """Records the recipes of each bulk write, failing the given IDs."""
+
+    def __init__(self, failing: set[str] = frozenset()):
+        self.writes = []
+        self.failing = failing
+
+    async def upsert_many(self, recipes: list[Recipe]) -> dict[int, str]:
+        self.writes.append(recipes)
+        await asyncio.sleep(0)
+        return {
+            i: "failed" for i, recipe in enumerate(recipes) if recipe.id in self.failing
+        }
+
+
+class TestWriteBehindBuffer(unittest.IsolatedAsyncioTestCase):
+    async def test_writes_when_full(self):
+        service = RecordingRecipeService()
+        buffer = WriteBehindBuffer(service, max_items=3, max_wait_ms=10000)
+
+        for recipe_id in ["a", "b", "c", "d"]:
+            await buffer.upsert(make_recipe(recipe_id))
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(
+            [[recipe.id for recipe in write] for write in service.writes],
+            [["a", "b", "c"]],
+        )
+        self.assertEqual(buffer.stats()["buffered"], 1)
+
+        await buffer.drain()
+        self.assertEqual([recipe.id for recipe in service.writes[-1]], ["d"])
+        self.assertEqual(buffer.stats()["saved"], 4)
+
+    async def test_writes_after_waiting(self):
+        service = RecordingRecipeService()
+        buffer = WriteBehindBuffer(service, max_items=100, max_wait_ms=10)
+
+        await buffer.upsert(make_recipe("a"))
+        self.assertEqual(service.writes, [])
+
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(service.writes), 1)
+
+    async def test_keeps_latest_version(self):
+        service = RecordingRecipeService()
+        buffer = WriteBehindBuffer(service, max_items=100, max_wait_ms=10000)
+
+        await buffer.upsert(make_recipe("a", "Pancakes"))
+        await buffer.upsert(make_recipe("b"))
+        await buffer.upsert(make_recipe("a", "Crepes"))
+        await buffer.drain()
+
+        (write,) = service.writes
+        self.assertEqual(
+            [(recipe.id, recipe.name) for recipe in write],
+            [("b", "Pancakes"), ("a", "Crepes")],
+        )
+        self.assertEqual(buffer.stats()["replaced"], 1)
+
+    async def test_counts_failures(self):
+        service = RecordingRecipeService(failing={"b"})
+        buffer = WriteBehindBuffer(service, max_items=100, max_wait_ms=10000)
+
+        for recipe_id in ["a", "b", "c"]:
+            await buffer.upsert(make_recipe(recipe_id))
+        with self.assertLogs(level="ERROR"):
+            await buffer.drain()
+
+        self.assertEqual(buffer.stats()["saved"], 2)
+        self.assertEqual(buffer.stats()["failed"], 1)
+
+    async def test_full(self):
+        buffer = WriteBehindBuffer(
+            RecordingRecipeService(), max_items=100, max_wait_ms=10000, max_buffered=2
+        )
+        await buffer.upsert(make_recipe("a"))
+        await buffer.upsert(make_recipe("b"))
+        await buffer.upsert(make_recipe("a"))
+
+        with self.assertRaises(WriteBufferFull):
+            await buffer.upsert(make_recipe("c"))
+        await buffer.drain()
+
+
+class TestUpsertMany(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.recipes = FakeCollection()
+        self.service = RecipeService({"recipes": self.recipes})
+
+    async def test_keeps_last_of_each_id(self):
+        recipes = [
+            make_recipe("a", "Pancakes"),
+            make_recipe("b"),
+            make_recipe("a", "Crepes"),
+        ]
+        errors = await self.service.upsert_many(recipes)
+
+        self.assertEqual(errors, {})
+        self.assertEqual(
+            self.recipes.requests,
+            [
+                UpdateOne(
+                    {"_id": "a"},
+                    {"$set": self.service._document(recipes[2])},
+                    upsert=True,
+                ),
+                UpdateOne(
+                    {"_id": "b"},
+                    {"$set": self.service._document(recipes[1])},
+                    upsert=True,
+                ),
+            ],
+        )
+
+    async def test_maps_errors_to_positions(self):
+        recipes = [make_recipe(recipe_id) for recipe_id in ["a", "b", "a", "c"]]
+        # The writes are of a, then b, then c, so index 1 is b and 2 is c
+        self.recipes.write_errors = [
+            {"index": 1, "errmsg": "b failed"},
+            {"index": 2, "errmsg": "c failed"},
+        ]
+        errors = await self.service.upsert_many(recipes)
+
+        self.assertEqual(errors, {1: "b failed", 3: "c failed"})
+
+    async def test_nothing_to_write(self):
+        self.assertEqual(await self.service.upsert_many([]), {})
+        self.assertEqual(self.recipes.requests, [])
+
+
+class TestUpsertManyMaterialized(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.recipes = FakeCollection(
+            [{"_id": "a", "site_name": "BBCFood", "cuisine": ["Thai"]}]
+        )
+        self.facets = FakeCollection()
+        self.service = RecipeService(
+            {"recipes": self.recipes, "facets": self.facets},
+            materialized_facets=True,
+        )
+
+    def increments(self) -> dict:
+        return {
+            request._filter["_id"]: request._doc["$inc"]
+            for request in self.facets.requests
+        }
+
+    async def test_moves_counts_from_the_replaced_recipes(self):
+        recipes = [make_recipe("a"), make_recipe("b")]
+        errors = await self.service.upsert_many(recipes)
+
+        self.assertEqual(errors, {})
+        # Each recipe is written alone, returning the recipe it replaced
+        self.assertEqual(
+            [query for query, _ in self.recipes.requests], [{"_id": "a"}, {"_id": "b"}]
+        )
+        increments = self.increments()
+        self.assertEqual(increments["cuisines:Thai"], {"count": -1})
+        self.assertEqual(increments["site_names:BBCFood"], {"count": 1})
+        self.assertEqual(increments["_meta"], {"total": 1})
+
+    async def test_concurrent_upserts_count_once(self):
+        await asyncio.gather(
+            self.service.upsert_many([make_recipe("b")]),
+            self.service.upsert_many([make_recipe("b")]),
+        )
+
+        totals = [
+            request._doc["$inc"]["total"]
+            for request in self.facets.requests
+            if request._filter["_id"] == "_meta"
+        ]
+        self.assertEqual(sum(totals), 1)
+
+    async def test_maps_errors_to_positions(self):
+        self.recipes.failing = {"b"}
+        recipes = [make_recipe(recipe_id) for recipe_id in ["b", "c", "b"]]
+        errors = await self.service.upsert_many(recipes)
+
+        self.assertEqual(errors, {2: "b failed"})
+        self.assertEqual(self.increments()["_meta"], {"total": 1})
+
+
+class BlockedRecipeService(RecordingRecipeService):
+    """Records the recipes of each bulk write, which wait until released."""
+
+    def __init__(self):
+        super().__init__()
+        self.released = asyncio.Event()
+
+    async def upsert_many(self, recipes: list[Recipe]) -> dict[int, str]:
+        await self.released.wait()
+        return await super().upsert_many(recipes)
+
+
+class TestWriteBehindBackpressure(unittest.IsolatedAsyncioTestCase):
+    async def test_full_while_writing(self):
+        service = BlockedRecipeService()
+        buffer = WriteBehindBuffer(
+            service, max_items=2, max_wait_ms=10000, max_buffered=5
+        )
+        for recipe_id in ["a", "b", "c", "d", "e"]:
+            await buffer.upsert(make_recipe(recipe_id))
+        await asyncio.sleep(0.01)
+        self.assertEqual(buffer.stats()["buffered"], 1)
+        self.assertEqual(buffer.stats()["writing"], 4)
+
+        # The writes waiting on the database count against the limit
+        with self.assertRaises(WriteBufferFull):
+            await buffer.upsert(make_recipe("f"))
+
+        service.released.set()
+        await buffer.drain()
+        self.assertEqual(buffer.stats()["writing"], 0)
+        self.assertEqual(buffer.stats()["saved"], 5)
+        await buffer.upsert(make_recipe("f"))
+        await buffer.drain()
+
+
+class TestContentHash(unittest.TestCase):
+    def test_ignores_detected_fields(self):
+        recipe = make_recipe("a")
+        detected = recipe.model_copy(update={"id": "b", "allergens": ["Milk"]})
+        self.assertEqual(recipe.content_hash(), detected.content_hash())
+
+    def test_changes_with_content(self):
+        recipe = make_recipe("a")
+        changed = recipe.model_copy(update={"ingredients": ["2 eggs", "oat milk"]})
+        self.assertNotEqual(recipe.content_hash(), changed.content_hash())
+
+    def test_changes_with_detector(self):
+        recipe = make_recipe("a")
+        self.assertNotEqual(recipe.content_hash("1"), recipe.content_hash("2"))
+        self.assertNotEqual(recipe.content_hash(), recipe.content_hash("1"))
+
+    def test_stored_with_recipe(self):
+        recipe = make_recipe("a")
+        document = RecipeService(None, detector_version="1")._document(recipe)
+        self.assertEqual(document["content_hash"], recipe.content_hash("1"))
+
+
+class TestFindUnchanged(unittest.IsolatedAsyncioTestCase):
+    async def test_relabels_after_detector_changes(self):
+        recipe = make_recipe("a")
+        saved = {
+            "_id": "a",
+            "content_hash": recipe.content_hash("1"),
+            "allergens": ["Eggs"],
+        }
+        service = RecipeService(
+            {"recipes": FakeCollection([saved])}, detector_version="1"
+        )
+        self.assertEqual(await service.find_unchanged([recipe]), {"a": ["Eggs"]})
+
+        service.detector_version = "2"
+        self.assertEqual(await service.find_unchanged([recipe]), {})
@@ -1,3 +1,6 @@
+import gzip
+import os
+import tempfile
 import unittest
 
 from app.utils import (
@@ -5,6 +8,14 @@ from app.utils import (
     strip_html,
     toggle_plural,
     iso_duration_to_text,
+    RobotsCache,
+    robots_delay,
+    robots_url_for,
+    SitemapParser,
+    HttpCache,
+    FetchPolicy,
+    CircuitOpen,
+    retry_after_seconds,
 )
 
 
@@ -31,6 +42,29 @@ class TestStripHTML(unittest.TestCase):
         stripped_content = strip_html(html_content)
         self.assertEqual(stripped_content, "Lorem ipsum dolor sit amet")
 
+    def test_matches_beautifulsoup(self):
+        from bs4 import BeautifulSoup
+
+        for html_content in [
+            "",
+            "plain text",
+            " \n ",
+            "Fish &amp; chips &amp",
+            "AT&T &unknown; &nbsp;&#39;&#x27;&#150;&#0;&#12",
+            "<a href='/food/butter'>butter</a>, for frying",
+            "<p>One</p>\n  <p>Two</p><br/><img src=a.jpg>",
+            "<script>alert(1)</script><style>p {}</style>text",
+            "<rt>hidden</rt><template>hidden</template><b>shown</b>",
+            "<b><template></b>shown",
+            "<pre>  </pre><textarea>\n</textarea>",
+            "<!-- comment --><!DOCTYPE html><?pi?><![CDATA[cdata]]>",
+            "a < b > c",
+            "<unclosed",
+        ]:
+            with self.subTest(html_content):
+                soup = BeautifulSoup(html_content, "html.parser")
+                self.assertEqual(strip_html(html_content), soup.get_text())
+
 
 class TestTogglePlural(unittest.TestCase):
     def setUp(self):
@@ -59,3 +93,299 @@ class TestIsoDurationToText(unittest.TestCase):
         """Test that spaces are removed from the beginning and end of the string."""
         self.assertEqual(iso_duration_to_text(" PT1H"), "Over 1 hour")
         self.assertEqual(iso_duration_to_text("PT1H "), "Over 1 hour")
+
+
+class TestRobotsCache(unittest.TestCase):
+    ROBOTS = "\n".join(
+        [
+            "User-agent: *",
+            "Disallow: /private/",
+            "Crawl-delay: 2",
+            "Request-rate: 1/5",
+        ]
+    )
+
+    def test_parses(self):
+        cache = RobotsCache()
+        rp = cache.put("https://example.com/robots.txt", 200, self.ROBOTS)
+
+        self.assertTrue(rp.can_fetch("bot", "https://example.com/recipes/1"))
+        self.assertFalse(rp.can_fetch("bot", "https://example.com/private/1"))
+        self.assertIs(cache.get("https://example.com/robots.txt"), rp)
+
+    def test_expires(self):
+        cache = RobotsCache(ttl=0)
+        cache.put("https://example.com/robots.txt", 200, self.ROBOTS)
+        self.assertIsNone(cache.get("https://example.com/robots.txt"))
+
+    def test_statuses(self):
+        cache = RobotsCache()
+        url = "https://example.com/page"
+        for status, allowed in [(404, True), (403, False), (500, False)]:
+            rp = cache.put("https://example.com/robots.txt", status, "")
+            self.assertEqual(rp.can_fetch("bot", url), allowed, status)
+        rp = cache.put("https://example.com/robots.txt", None, None)
+        self.assertFalse(rp.can_fetch("bot", url))
+
+    def test_delay(self):
+        cache = RobotsCache()
+        rp = cache.put("https://example.com/robots.txt", 200, self.ROBOTS)
+        self.assertEqual(robots_delay(rp, "bot"), 5)
+
+        rp = cache.put("https://example.com/robots.txt", 200, "User-agent: *")
+        self.assertIsNone(robots_delay(rp, "bot"))
+
+    def test_robots_url_for(self):
+        self.assertEqual(
+            robots_url_for("https://www.bbc.co.uk/food/recipes/a_1?b=c"),
+            "https://www.bbc.co.uk/robots.txt",
+        )
+
+
+def make_urlset(locs: list[str]) -> bytes:
+    entries = "".join(f"<url><loc>{loc}</loc></url>" for loc in locs)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+        f"{entries}</urlset>"
+    ).encode("utf-8")
+
+
+class TestSitemapParser(unittest.TestCase):
+    def parse(self, content: bytes, chunk_size: int) -> list[tuple[str, str]]:
+        parser = SitemapParser()
+        entries = []
+        for i in range(0, len(content), chunk_size):
+            entries.extend(parser.feed(content[i : i + chunk_size]))
+        entries.extend(parser.close())
+        return entries
+
+    def test_urlset(self):
+        locs = [f"https://example.com/recipes/{n}" for n in range(50)]
+        for chunk_size in [1, 7, 1024, 1 << 20]:
+            entries = self.parse(make_urlset(locs), chunk_size)
+            self.assertEqual(entries, [("url", loc) for loc in locs], chunk_size)
+
+    def test_gzipped(self):
+        locs = [f"https://example.com/recipes/{n}" for n in range(50)]
+        content = gzip.compress(make_urlset(locs))
+        for chunk_size in [1, 7, 1024]:
+            entries = self.parse(content, chunk_size)
+            self.assertEqual(entries, [("url", loc) for loc in locs], chunk_size)
+
+    def test_index(self):
+        content = (
+            b'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            b"<sitemap><loc> https://example.com/a.xml </loc>"
+            b"<lastmod>2024-01-01</lastmod></sitemap>"
+            b"<sitemap><loc>https://example.com/b.xml.gz</loc></sitemap>"
+            b"</sitemapindex>"
+        )
+        self.assertEqual(
+            self.parse(content, 16),
+            [
+                ("sitemap", "https://example.com/a.xml"),
+                ("sitemap", "https://example.com/b.xml.gz"),
+            ],
+        )
+
+    def test_entries_arrive_before_the_end(self):
+        content = make_urlset(["https://example.com/1", "https://example.com/2"])
+        parser = SitemapParser()
+        half = content.index(b"</url>") + len(b"</url>")
+        self.assertEqual(
+            parser.feed(content[:half]), [("url", "https://example.com/1")]
+        )
+        self.assertEqual(
+            parser.feed(content[half:]), [("url", "https://example.com/2")]
+        )
+
+
+class TestHttpCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = HttpCache(self.directory.name, max_bytes=10_000)
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def bodies(self) -> list[str]:
+        return [
+            name
+            for _, _, names in os.walk(os.path.join(self.directory.name, "bodies"))
+            for name in names
+        ]
+
+    def test_put_and_get(self):
+        self.assertIsNone(self.cache.get("https://example.com/1"))
+        self.assertEqual(self.cache.validators("https://example.com/1"), {})
+
+        self.cache.put(
+            "https://example.com/1",
+            "Crème brûlée".encode("latin-1"),
+            {"ETag": '"v1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"},
+            "latin-1",
+        )
+
+        self.assertEqual(self.cache.get("https://example.com/1").text, "Crème brûlée")
+        self.assertEqual(
+            self.cache.validators("https://example.com/1"),
+            {
+                "If-None-Match": '"v1"',
+                "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT",
+            },
+        )
+
+    def test_revalidated(self):
+        self.cache.put("https://example.com/1", b"page", {"ETag": '"v1"'})
+
+        response = self.cache.revalidated("https://example.com/1", {"ETag": '"v2"'})
+
+        self.assertEqual(response.body, b"page")
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(
+            self.cache.validators("https://example.com/1"), {"If-None-Match": '"v2"'}
+        )
+        self.assertIsNone(self.cache.revalidated("https://example.com/2", {}))
+
+    def test_streamed(self):
+        content = b"<url><loc>https://example.com/</loc></url>" * 10_000
+        body = self.cache.body()
+        for start in range(0, len(content), 50_000):
+            body.write(content[start : start + 50_000])
+        self.cache.put_body("https://example.com/1", body, {"ETag": '"v1"'})
+
+        chunks = list(self.cache.stream("https://example.com/1", chunk_size=1024))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), content)
+        self.assertEqual(self.cache.get("https://example.com/1").body, content)
+        chunks = self.cache.revalidated_stream("https://example.com/1", {})
+        self.assertEqual(b"".join(chunks), content)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertIsNone(self.cache.stream("https://example.com/2"))
+
+        # A body which isn't stored leaves nothing behind
+        body = self.cache.body()
+        body.write(b"partial")
+        body.discard()
+        self.assertEqual(len(self.bodies()), 1)
+
+    def test_content_addressed(self):
+        self.cache.put("https://example.com/1", b"same", {})
+        self.cache.put("https://example.com/2", b"same", {})
+        self.assertEqual(len(self.bodies()), 1)
+
+        # The body is kept until no response has it
+        self.cache.put("https://example.com/1", b"changed", {})
+        self.assertEqual(len(self.bodies()), 2)
+        self.cache.put("https://example.com/2", b"changed", {})
+        self.assertEqual(len(self.bodies()), 1)
+
+    def test_evicts_least_recently_used(self):
+        for n in range(4):
+            self.cache.put(f"https://example.com/{n}", os.urandom(3000), {})
+            # Using the first page keeps it
+            self.cache.get("https://example.com/0")
+
+        self.assertLessEqual(self.cache.size, 10_000)
+        self.assertIsNotNone(self.cache.get("https://example.com/0"))
+        self.assertIsNone(self.cache.get("https://example.com/1"))
+        self.assertIsNotNone(self.cache.get("https://example.com/3"))
+        self.assertEqual(len(self.bodies()), 3)
+
+    def test_persists(self):
+        self.cache.put("https://example.com/1", b"page", {"ETag": '"v1"'})
+        self.cache.close()
+
+        self.cache = HttpCache(self.directory.name, max_bytes=10_000)
+
+        self.assertEqual(self.cache.get("https://example.com/1").body, b"page")
+        self.assertGreater(self.cache.size, 0)
+
+
+class TestFetchPolicy(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.policy = FetchPolicy(
+            max_retries=3,
+            base_delay=1,
+            max_delay=10,
+            retry_ratio=0.5,
+            max_retry_tokens=2,
+            failure_threshold=3,
+            reset_after=30,
+            clock=lambda: self.now,
+            jitter=lambda: 1,
+        )
+        self.url = "https://example.com/recipes/1"
+
+    def test_backoff(self):
+        delays = []
+        for attempt in range(1, 6):
+            self.policy.admit(self.url, attempt)
+            delays.append(self.policy.failed(self.url, attempt))
+            # Succeed in between, so the circuit stays closed
+            self.policy.succeeded("https://example.com/")
+
+        self.assertEqual(delays, [1, 2, None, None, None])
+        self.assertEqual(self.policy.counts["budget_exhausted"], 1)
+
+    def test_capped(self):
+        policy = FetchPolicy(base_delay=4, max_delay=10, jitter=lambda: 1)
+        policy.admit(self.url)
+        self.assertEqual(policy.failed(self.url, 3), 10)
+
+    def test_retry_after(self):
+        self.policy.admit(self.url)
+        self.assertEqual(self.policy.failed(self.url, 1, "5"), 5)
+        self.policy.admit(self.url, 2)
+        self.assertIsNone(self.policy.failed(self.url, 2, "120"))
+
+        self.assertEqual(retry_after_seconds("7"), 7)
+        self.assertEqual(retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        self.assertIsNone(retry_after_seconds("soon"))
+
+    def test_circuit_breaker(self):
+        for _ in range(3):
+            self.policy.admit(self.url)
+            self.policy.failed(self.url, 1)
+
+        with self.assertRaises(CircuitOpen):
+            self.policy.admit(self.url)
+        # Other hosts are still fetched from
+        self.policy.admit("https://example.org/")
+        self.assertEqual(self.policy.stats()["open_circuits"], ["example.com"])
+
+        # A single trial is let through after a while
+        self.now = 31
+        self.policy.admit(self.url)
+        with self.assertRaises(CircuitOpen):
+            self.policy.admit(self.url)
+
+        # And its failure opens the circuit again
+        self.assertIsNone(self.policy.failed(self.url, 1))
+        with self.assertRaises(CircuitOpen):
+            self.policy.admit(self.url)
+
+        self.now = 62
+        self.policy.admit(self.url)
+        self.policy.succeeded(self.url)
+        self.policy.admit(self.url)
+        self.assertEqual(self.policy.stats()["open_circuits"], [])
+        self.assertEqual(self.policy.counts["circuits_opened"], 1)
+        self.assertEqual(self.policy.counts["shed"], 3)
+
+    def test_abandoned_trial(self):
+        for _ in range(3):
+            self.policy.admit(self.url)
+            self.policy.failed(self.url, 1)
+
+        self.now = 31
+        self.policy.admit(self.url)
+        self.policy.abandoned(self.url)
+
+        # Another trial is let through, rather than the host being shed for good
+        self.policy.admit(self.url)
+        with self.assertRaises(CircuitOpen):
+            self.policy.admit(self.url)